@@ -0,0 +1,432 @@
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+import zlib
+
+import tcod as libtcod
+import tcod.console
+
+from engine import GameSession, MAP_WIDTH, MAP_HEIGHT, MAX_LIGHT_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO
+from gid import render_background, TcodRenderer, SCREEN_WIDTH, SCREEN_HEIGHT, PANEL_HEIGHT, MSG_HEIGHT
+from map import make_map
+from model.character import Character, Fighter, make_enemy
+from model.object import Object
+from model.item import Item
+from rng import RunSeed
+from savegame import encode_floor
+
+# benchmarks for the hot paths. run with a fixed seed, compare against a saved baseline:
+#   python bench.py --out bench.json
+#   python bench.py --baseline bench.json
+DEFAULT_SEED = 7
+DEFAULT_REPEAT = 200
+DEFAULT_THRESHOLD = 0.10  # a p50 more than 10% slower than the baseline is flagged
+
+QUERY_BATCH = 1000
+MEMORY_COUNT = 10000
+MEMORY_MONSTERS = 500
+OBJECT_COUNTS = (100, 1000, 10000)
+MONSTER_COUNTS = (10, 100, 500)
+ENTITY_COUNTS = (100, 1000)
+MAPGEN_SCALES = (1, 2, 4, 8)  # map width and height as multiples of the standard map's
+LARGE_MAP = (1000, 1000)  # scrolled through the camera, kept in chunks
+ENTITY_RADIUS = 8
+
+
+def make_player():
+    return Character(0, 0, '@', 'bench', libtcod.white, fighter=Fighter(hp=10, defense=1, power=2, xp=0),
+                     player=True)
+
+
+def open_cells(floor, rng):
+    cells = [(x, y) for x in range(floor.width) for y in range(floor.height) if not floor.blocked[x, y]]
+    rng.shuffle(cells)
+    return cells
+
+
+def timed(fn, repeat, per=1):
+    # run fn repeat times and return the seconds each run took, divided over the per calls it makes
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) / per)
+    return samples
+
+
+def percentile(ordered, p):
+    # nearest rank
+    index = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    return {'n': len(ordered),
+            'mean': mean,
+            'min': ordered[0],
+            'p50': percentile(ordered, 50),
+            'p90': percentile(ordered, 90),
+            'p99': percentile(ordered, 99),
+            'max': ordered[-1]}
+
+
+# benchmarks. each returns a list of (label, samples in seconds)
+def bench_mapgen(seed, repeat):
+    run_seed = RunSeed(seed)
+    player = make_player()
+    samples = timed(lambda: make_map(MAP_WIDTH, MAP_HEIGHT, player, 1, run_seed), repeat)
+    results = [('mapgen floor', samples)]
+    # time per tile as maps grow: flat when generation is linear in the area
+    for scale in MAPGEN_SCALES:
+        width, height = MAP_WIDTH * scale, MAP_HEIGHT * scale
+        floors = iter(range(1, repeat + 1))
+        samples = timed(lambda: make_map(width, height, None, next(floors), run_seed),
+                        max(1, repeat // (scale * scale)), width * height)
+        results.append(('mapgen per tile %dx%d' % (width, height), samples))
+    width, height = LARGE_MAP
+    floors = iter(range(1, repeat + 1))
+    samples = timed(lambda: make_map(width, height, None, next(floors), run_seed, generator='cave'),
+                    max(1, repeat // 10))
+    results.append(('mapgen cave %dx%d' % LARGE_MAP, samples))
+    return results
+
+
+def bench_queries(seed, repeat):
+    results = []
+    for count in OBJECT_COUNTS:
+        rng = random.Random(seed)
+        floor = make_map(MAP_WIDTH, MAP_HEIGHT, make_player(), 1, RunSeed(seed))
+        cells = open_cells(floor, rng)
+        for i in range(count):
+            x, y = cells[i % len(cells)]
+            floor.add_object(Object(x, y, '!', 'junk', libtcod.white, blocks=(i % 4 == 0)))
+        points = [(rng.randrange(floor.width), rng.randrange(floor.height)) for i in range(QUERY_BATCH)]
+
+        def is_blocked():
+            for x, y in points:
+                floor.is_blocked(x, y)
+
+        def get_stuff():
+            for x, y in points:
+                floor.get_stuff(x, y)
+
+        results.append(('is_blocked objects=%d' % count, timed(is_blocked, repeat, QUERY_BATCH)))
+        results.append(('get_stuff objects=%d' % count, timed(get_stuff, repeat, QUERY_BATCH)))
+    return results
+
+
+def populated_floor(seed, monsters):
+    # a floor with the player in the first room and monsters on random open tiles
+    rng = random.Random(seed)
+    player = make_player()
+    floor = make_map(MAP_WIDTH, MAP_HEIGHT, player, 1, RunSeed(seed))
+    cells = [c for c in open_cells(floor, rng) if not floor.is_blocked(*c)]
+    for x, y in cells[:monsters]:
+        floor.add_object(make_enemy(x, y, floor, rng))
+    return player, floor
+
+
+def bench_ai(seed, repeat):
+    player, floor = populated_floor(seed, 50)
+    monsters = [o for o in floor.objects if o.ai]
+    starts = [(m.x, m.y) for m in monsters]
+    rng = random.Random(seed)
+
+    def reset():
+        for m, (x, y) in zip(monsters, starts):
+            floor.move_object(m, x, y)
+
+    def astar_turn():
+        for m in monsters:
+            m.move_astar(player, floor, rng)
+
+    def chase_turn():
+        floor.chase.invalidate()
+        for m in monsters:
+            m.move_chase(player, floor, rng)
+
+    results = []
+    for label, turn in (('move_astar per monster', astar_turn), ('move_chase per monster', chase_turn)):
+        samples = []
+        for i in range(repeat):
+            reset()
+            samples.extend(timed(turn, 1, len(monsters)))
+        results.append((label, samples))
+    return results
+
+
+def bench_render(seed, repeat):
+    rng = random.Random(seed)
+    floor = make_map(MAP_WIDTH, MAP_HEIGHT, make_player(), 1, RunSeed(seed))
+    con = tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT, order="F")
+    cells = open_cells(floor, rng)
+    spots = iter(cells * (repeat // len(cells) + 1))
+
+    def frame():
+        x, y = next(spots)
+        floor.compute_fov(x, y, MAX_LIGHT_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        floor.explore()
+        render_background(con, floor.visible_in(0, 0, floor.width, floor.height), floor)
+
+    results = [('fov + background', timed(frame, repeat))]
+
+    # whole frames through the renderer, onto offscreen consoles
+    renderer = TcodRenderer(tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT, order="F"),
+                            tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT, order="F"),
+                            tcod.console.Console(SCREEN_WIDTH, PANEL_HEIGHT, order="F"),
+                            tcod.console.Console(SCREEN_WIDTH, MSG_HEIGHT, order="F"))
+    # no floors built in the background while the frames are timed
+    session = GameSession('bench', renderer, seed=seed, pregenerate=False)
+    touched = []
+    steps = iter([(1, 0), (-1, 0)] * repeat)
+
+    def step_frame():
+        session.move(*next(steps))
+        session.render()
+        touched.append(renderer.touched)
+
+    try:
+        session.player.fighter.death_function = None
+        session.render()
+        results.append(('frame idle', timed(session.render, repeat)))
+        results.append(('turn + frame after a step', timed(step_frame, repeat)))
+    finally:
+        session.close()
+    print("cells touched per frame after a step: mean %.1f, max %d" % (sum(touched) / len(touched), max(touched)))
+
+    # the same on a floor far bigger than the screen: should cost about the same
+    session = GameSession('bench', renderer, seed=seed, map_width=LARGE_MAP[0], map_height=LARGE_MAP[1],
+                          pregenerate=False)
+    try:
+        session.player.fighter.death_function = None
+        session.render()
+        results.append(('turn + frame after a step %dx%d' % LARGE_MAP, timed(step_frame, repeat)))
+    finally:
+        session.close()
+    return results
+
+
+def bench_turn(seed, repeat):
+    results = []
+    for count in MONSTER_COUNTS:
+        session = GameSession('bench', seed=seed, pregenerate=False)
+        try:
+            floor = session.floor
+            player = session.player
+            player.fighter.death_function = None  # keep the run going however badly it goes
+            rng = random.Random(seed)
+            cells = [c for c in open_cells(floor, rng) if not floor.is_blocked(*c)]
+            for x, y in cells[:count]:
+                monster = make_enemy(x, y, floor, rng)
+                floor.add_object(monster)
+                floor.scheduler.add(monster)
+
+            samples = []
+            for i in range(repeat):
+                player.fighter.hp = player.fighter.max_hp
+                samples.extend(timed(session.wait, 1))
+        finally:
+            session.close()
+        results.append(('turn monsters=%d' % count, samples))
+    return results
+
+
+def bench_descend(seed, repeat):
+    # what the player waits for at the stairs: the floor built on the spot, or one built ahead of time
+    results = []
+    for label, pregenerate in (('descend wait sync', False), ('descend wait pregen', True)):
+        session = GameSession('bench', seed=seed, pregenerate=pregenerate)
+        session.player.fighter.death_function = None
+        for i in range(repeat):
+            session.player.fighter.hp = session.player.fighter.max_hp
+            stairs = session.floor.stairs_down
+            session.floor.move_object(session.player, stairs.x, stairs.y)
+            if session.pregen:
+                # the player spends a while on every floor, long enough for the next one to be ready
+                for future in list(session.pregen.pending.values()):
+                    future.result()
+            session.descend()
+        session.close()
+        results.append((label, session.descend_waits))
+    return results
+
+
+def bench_entities(seed, repeat):
+    # questions about every monster on a floor: walking floor.objects against asking its EntityStore
+    results = []
+    for count in ENTITY_COUNTS:
+        player, floor = populated_floor(seed, count)
+        rng = random.Random(seed)
+        for o in floor.objects:
+            if o.ai and rng.random() < 0.5:
+                floor.scheduler.add(o)
+        store = floor.use_entities()
+        cells = open_cells(floor, rng)
+        spots = iter(cells * (repeat // len(cells) + 1))
+
+        def within_walk():
+            x, y = next(spots)
+            r2 = ENTITY_RADIUS * ENTITY_RADIUS
+            return [o for o in floor.objects if o.fighter and (o.x - x) ** 2 + (o.y - y) ** 2 <= r2]
+
+        def within_store():
+            x, y = next(spots)
+            return store.get(store.within(x, y, ENTITY_RADIUS))
+
+        def awake_walk():
+            return [o for o in floor.objects if o.ai and o in floor.scheduler]
+
+        def awake_store():
+            return store.get(store.awake_ids())
+
+        n = len(floor.objects)
+        results.append(('within radius walk objects=%d' % n, timed(within_walk, repeat)))
+        results.append(('within radius store objects=%d' % n, timed(within_store, repeat)))
+        results.append(('awake walk objects=%d' % n, timed(awake_walk, repeat)))
+        results.append(('awake store objects=%d' % n, timed(awake_store, repeat)))
+    return results
+
+
+def allocated(make):
+    # bytes make() allocates that are still alive afterwards, and what it made
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    made = make()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, made
+
+
+def memory_report(seed, count=MEMORY_COUNT):
+    # bytes per entity, per tile and per populated floor, live and encoded
+    report = {}
+    size, made = allocated(lambda: [Object(i % MAP_WIDTH, 1, '!', 'junk', libtcod.white, item=Item())
+                                    for i in range(count)])
+    report['bytes per item'] = size / count
+    floor = make_map(MAP_WIDTH, MAP_HEIGHT, None, 1, RunSeed(seed))
+    rng = random.Random(seed)
+    size, made = allocated(lambda: [make_enemy(i % MAP_WIDTH, 1, floor, rng) for i in range(count)])
+    report['bytes per monster'] = size / count
+    size, made = allocated(lambda: make_map(MAP_WIDTH, MAP_HEIGHT, None, 1, RunSeed(seed)))
+    report['bytes per tile (floor as generated)'] = size / (MAP_WIDTH * MAP_HEIGHT)
+
+    def populated():
+        floor = make_map(MAP_WIDTH, MAP_HEIGHT, None, 1, RunSeed(seed))
+        rng = random.Random(seed)
+        cells = [c for c in open_cells(floor, rng) if not floor.is_blocked(*c)]
+        for x, y in cells[:MEMORY_MONSTERS]:
+            floor.add_object(make_enemy(x, y, floor, rng))
+        return floor
+    size, floor = allocated(populated)
+    report['bytes per floor with %d monsters' % MEMORY_MONSTERS] = size
+    data = encode_floor(floor)
+    report['bytes per encoded floor'] = len(data)
+    report['bytes per cached floor (compressed)'] = len(zlib.compress(data, 6))
+    return report
+
+
+def print_memory(report):
+    print('%-40s %12s' % ('memory', 'bytes'))
+    for label, size in report.items():
+        print('%-40s %12.1f' % (label, size))
+
+
+BENCHMARKS = {
+    'mapgen': bench_mapgen,
+    'queries': bench_queries,
+    'ai': bench_ai,
+    'render': bench_render,
+    'turn': bench_turn,
+    'descend': bench_descend,
+    'entities': bench_entities,
+}
+
+
+def print_table(results):
+    print('%-32s %6s %10s %10s %10s %10s %12s' % ('benchmark', 'n', 'mean us', 'p50 us', 'p90 us', 'p99 us', 'per sec'))
+    for label, stats in results.items():
+        per_sec = 1.0 / stats['mean'] if stats['mean'] > 0 else float('inf')
+        print('%-32s %6d %10.2f %10.2f %10.2f %10.2f %12.1f' % (
+            label, stats['n'], stats['mean'] * 1e6, stats['p50'] * 1e6, stats['p90'] * 1e6, stats['p99'] * 1e6,
+            per_sec))
+
+
+def compare(results, baseline, threshold):
+    # returns the labels whose p50 got slower than the baseline by more than threshold
+    regressions = []
+    print()
+    print('%-32s %10s %10s %8s' % ('benchmark', 'base us', 'p50 us', 'change'))
+    for label, stats in results.items():
+        if label not in baseline:
+            continue
+        before = baseline[label]['p50']
+        after = stats['p50']
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(label)
+        print('%-32s %10.2f %10.2f %+7.1f%%%s' % (label, before * 1e6, after * 1e6, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark map generation, FOV, AI turns and rendering.")
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help="benchmarks to run (default: all of %s)" % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="samples per benchmark")
+    parser.add_argument('--out', help="save the results as JSON")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative p50 slowdown that counts as a regression")
+    parser.add_argument('--memory', action='store_true', help="also report bytes per entity, tile and floor")
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+
+    names = args.names
+    if not names and not args.memory:
+        names = sorted(BENCHMARKS)
+    results = {}
+    for name in names:
+        gc.collect()
+        for label, samples in BENCHMARKS[name](args.seed, args.repeat):
+            results[label] = summarize(samples)
+    if results:
+        print_table(results)
+    memory = {}
+    if args.memory:
+        memory = memory_report(args.seed)
+        print_memory(memory)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'meta': {'seed': args.seed,
+                                'repeat': args.repeat,
+                                'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'time': time.time()},
+                       'results': results,
+                       'memory': memory}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
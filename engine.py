@@ -0,0 +1,364 @@
+import os
+import time
+
+import tcod as libtcod
+
+from map import make_map
+from model.character import Character, Fighter
+from model.death import Death
+from model.item import Equipment
+from model.object import Object
+from floorcache import FloorCache, DEFAULT_MAX_LIVE
+from msg import Message, MessageLog
+from pregen import FloorPregen
+from savegame import load_session, save_session
+from rng import RunSeed, COMBAT
+from scheduler import action_delay
+from storage import MemmapStorage
+
+# map size
+MAP_WIDTH = 80
+MAP_HEIGHT = 43
+
+# message log
+MSG_WIDTH = 76
+MSG_HEIGHT = 5
+
+# fov
+FOV_ALGO = 0  # default FOV algorithm
+FOV_LIGHT_WALLS = True
+MAX_LIGHT_RADIUS = 10
+
+# game state strings
+GS_PLAYING = 'playing'
+GS_DEAD = 'dead'
+
+# experience and level-ups
+LEVEL_UP_BASE = 200
+LEVEL_UP_FACTOR = 150
+DLEVEL_SCORE = 100
+DLEVEL_XP = 10
+
+INVENTORY_MAX = 26
+WALL_DMG = 10
+OBAMA_CHANCE = 0.1
+
+
+class GameState:
+
+    def __init__(self):
+        self.score = 0
+        self.time = 0
+        self.discovered = {}
+
+
+class NullRenderer:
+    # draws nothing, so the rules can run without a window (tests, benchmarks, bots)
+    def new_floor(self, session):
+        pass
+
+    def render(self, session):
+        pass
+
+
+class GameSession:
+    # one run of the game: the player, the floor they're on and everything that has happened so far.
+    # the action methods return True when they used up the player's turn, after the monsters have had theirs
+    def __init__(self, name, renderer=None, on_death=None, map_width=MAP_WIDTH, map_height=MAP_HEIGHT,
+                 msg_width=MSG_WIDTH, msg_height=MSG_HEIGHT, seed=None,
+                 pregenerate=True, max_live_floors=DEFAULT_MAX_LIVE, floor_policy='lru', entity_store=False,
+                 floor_dir=None, load_from=None):
+        if renderer is None:
+            renderer = NullRenderer()
+        self.renderer = renderer
+        self.on_death = on_death  # called with the session when the player dies, e.g. to save the score
+        self.map_width = map_width
+        self.map_height = map_height
+        self.msg_width = msg_width
+        self.msg_height = msg_height
+        # the same seed gives the same floors, whatever happens during play
+        self.seed = RunSeed(seed)
+        self.combat_rng = self.seed.stream(COMBAT)
+        # with a floor_dir, every floor keeps its tile layers in a memory mapped file there instead of in memory.
+        # the files outlive the session, so a saved run picks its floors' tiles back up from them
+        self.floor_dir = floor_dir
+        storage_for = self.tile_storage if floor_dir is not None else None
+        # builds the floor below in the background. without it, floors are built when the player gets there
+        self.pregen = None
+        if pregenerate:
+            self.pregen = FloorPregen(map_width, map_height, self.seed, storage_for)
+        self.descend_waits = []  # seconds each trip down the stairs spent waiting for the new floor
+        # the floors the player has left, for when they come back
+        self.floors = FloorCache(max_live_floors, floor_policy, storage_for=storage_for)
+        self.deepest = 1
+        # keep every floor's objects in an EntityStore as well, for floors crowded enough to want array queries
+        self.entity_store = entity_store
+
+        self.game = GameState()
+        self.game_state = GS_PLAYING
+        self.messages = MessageLog()
+        self.inventory = []
+        self.floor = None
+        self.fov_recompute = False
+        self.fov_version = 0  # goes up every time the FOV changes, so renderers know to repaint
+        if load_from is not None:
+            # carry on a saved run, player and all
+            load_session(self, load_from)
+            return
+
+        # player
+        fighter_component = Fighter(hp=10, defense=1, power=2, xp=0, death_function=self.player_death)
+        self.player = Character(0, 0, '@', name, libtcod.white, fighter=fighter_component,
+                                inventory=self.inventory, player=True)
+        equipment_component = Equipment(slot='right hand', power_bonus=2)
+        obj = Object(0, 0, '/', 'rolled-up newspaper', libtcod.light_grey, equipment=equipment_component)
+        self.inventory.append(obj)
+        equipment_component.equip(self.player)
+        obj.always_visible = True
+
+        # generate map (at this point it's not drawn to the screen)
+        self.enter_floor(make_map(self.map_width, self.map_height, self.player, 1, self.seed, self.tile_storage(1)))
+
+        self.message("Go, " + self.player.name + "! Recover the Golden Pigeon of Nyan!", libtcod.white)
+        self.message("Press '?' for help", libtcod.grey)
+
+    # messages
+    def message(self, new_msg, color=libtcod.white):
+        self.messages.add(new_msg, color)
+
+    def log(self, msgs):
+        for msg in msgs:
+            self.message(*msg.as_args())
+
+    # turns
+    def end_turn(self):
+        self.game.time += 1
+        if self.game.time % 10 == 0:  # Score from time survived
+            self.game.score += 1
+        # npc turns: every awake monster whose time comes up while the player acts
+        floor = self.floor
+        floor.chase.invalidate()
+        for entity in floor.scheduler.advance(action_delay(self.player)):
+            self.log(entity.ai.take_turn(self.player, floor, self.combat_rng))
+        self.update_fov()
+        return True
+
+    def update_fov(self):
+        if not self.fov_recompute:
+            return
+        # recompute FOV if needed (the player moved or something)
+        self.fov_recompute = False
+        self.floor.compute_fov(self.player.x, self.player.y, MAX_LIGHT_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        # whatever is visible right now becomes explored
+        self.floor.explore()
+        # monsters the player can see can see the player too
+        self.floor.wake_visible()
+        self.fov_version += 1
+
+    def enter_floor(self, floor):
+        self.floor = floor
+        if self.entity_store:
+            floor.use_entities()
+        if self.pregen and floor.dungeon_level + 1 not in self.floors:
+            self.pregen.request(floor.dungeon_level + 1)
+        self.fov_recompute = True
+        self.renderer.new_floor(self)
+        self.update_fov()
+
+    def render(self):
+        self.renderer.render(self)
+
+    def tile_storage(self, dlevel, reuse=False):
+        # where floor dlevel keeps its tiles: a file of its own under floor_dir, if there is one.
+        # None leaves it to the floor
+        if self.floor_dir is None:
+            return None
+        return MemmapStorage(os.path.join(self.floor_dir, 'floor-%d.tiles' % dlevel), reuse)
+
+    def save(self, path):
+        # tiles in files get onto the disk as their floors are encoded (see MemmapStorage.seal)
+        save_session(self, path)
+
+    def close(self):
+        # the run is over, stop building floors for it
+        if self.pregen:
+            self.pregen.close()
+        self.floors.close()
+
+    # player actions
+    def move(self, dx, dy):
+        # move by the given amount if not blocked
+        floor = self.floor
+        player = self.player
+        target_x = player.x + dx
+        target_y = player.y + dy
+        if not floor.is_blocked(target_x, target_y):
+            floor.move_object(player, target_x, target_y)
+        else:
+            possible_blockers = floor.get_stuff(target_x, target_y)
+            blocker = None
+            if len(possible_blockers) > 0:
+                blocker = possible_blockers[0]
+            blocker_name = "a wall"
+            if blocker is not None:
+                blocker_name = str(blocker)
+            self.message("Ouch! You blunder into " + blocker_name + ".", libtcod.orange)
+            self.log(player.fighter.take_damage(self.combat_rng.randint(1, 5), "running into " + blocker_name))
+        self.fov_recompute = True
+        return self.end_turn()
+
+    def attack_targets(self):
+        # everything next to the player that can be hit
+        targets = []
+        for i in range(-1, 2):
+            for j in range(-1, 2):
+                stuff = self.floor.get_stuff(self.player.x + i, self.player.y + j)
+                targets += filter(lambda o: o.fighter and o != self.player, stuff)
+        return targets
+
+    def attack(self, target):
+        self.log(self.player.fighter.attack(self.player, target, self.combat_rng))
+        return self.end_turn()
+
+    def pickup(self):
+        # pick up an item
+        for object in self.floor.get_stuff(self.player.x, self.player.y):  # look for an item in the player's tile
+            if object.item:
+                self.pick_up(object.item)
+                return self.end_turn()
+        return False
+
+    def pick_up(self, item):
+        player = self.player
+        # add to the player's inventory and remove from the map
+        if len(self.inventory) >= INVENTORY_MAX:
+            self.message('You attempt to pick up ' + item.owner.name +
+                         ', but are crushed under the weight of your load.', libtcod.orange)
+            self.log(player.fighter.take_damage(111, "crushed to death"))
+        else:
+            self.inventory.append(item.owner)
+            self.floor.remove_object(item.owner)
+            self.message('You picked up ' + item.owner.name + '.', libtcod.white)
+
+            # special case: automatically equip, if the corresponding equipment slot is unused
+            equipment = item.owner.equipment
+            if equipment and player.get_equipped_in_slot(equipment.slot) is None:
+                self.log(equipment.equip(player))
+
+    def drop(self, item):
+        # special case: if the object has the Equipment component, dequip it before dropping
+        if item.owner.equipment:
+            self.log(item.owner.equipment.dequip())
+
+        # add to the map and remove from the player's inventory. also, place it at the player's coordinates
+        self.inventory.remove(item.owner)
+        item.owner.x = self.player.x
+        item.owner.y = self.player.y
+        self.floor.add_object(item.owner)
+        self.message('You dropped a ' + item.owner.name + '.', libtcod.yellow)
+        return self.end_turn()
+
+    def use(self, item):
+        # special case: if the object has the Equipment component, the "use" action is to equip/dequip
+        if item.owner.equipment:
+            self.log(item.owner.equipment.toggle_equip(self.player))
+            return self.end_turn()
+
+        # just call the "use_function" if it is defined
+        if item.use_function is None:
+            self.message('The ' + item.owner.name + ' cannot be used.')
+        else:
+            result = item.use_function(self.player)
+            if result != 'cancelled':
+                self.inventory.remove(item.owner)  # destroy after use, unless it was cancelled for some reason
+                self.log(result)
+        return self.end_turn()
+
+    def descend(self):
+        # go down stairs, if the player is on them
+        stairs = self.floor.stairs_down
+        if stairs.x == self.player.x and stairs.y == self.player.y:
+            self.next_level()
+            return self.end_turn()
+        self.message("You can't go down on that.", libtcod.white)
+        return False
+
+    def ascend(self):
+        stairs = self.floor.stairs_up
+        if stairs.x == self.player.x and stairs.y == self.player.y:
+            if self.floor.dungeon_level > 1:
+                self.previous_level()
+                return self.end_turn()
+            self.message("You attempt to climb the stairs but the effort destroys your already frail body.",
+                         libtcod.yellow)
+            self.log(self.player.fighter.take_damage(100, "collapsed from over-exertion"))
+            return self.end_turn()
+        self.message("You can't get high here.", libtcod.white)
+        return False
+
+    def wait(self):
+        return self.end_turn()
+
+    def quit(self):
+        self.log([self.player_death(self.player, "quit")])
+
+    def next_level(self):
+        # advance to the next level
+        player = self.player
+        floor = self.floor
+        next_dlevel = floor.dungeon_level + 1
+        if next_dlevel > self.deepest:
+            # only getting somewhere new counts
+            self.deepest = next_dlevel
+            player.fighter.xp += DLEVEL_XP * floor.dungeon_level
+            self.game.score += DLEVEL_SCORE * floor.dungeon_level
+        if self.combat_rng.random() < 0.1:
+            self.message("You tumble down the stairs.", libtcod.orange)
+            self.log(player.fighter.take_damage(self.combat_rng.randint(1, 4), "fell down the stairs"))
+        else:
+            self.message('You manage to avoid falling down the stairs.', libtcod.white)
+        self.leave_floor()
+        start = time.perf_counter()
+        new_floor = self.floors.get(next_dlevel)
+        if new_floor is not None:
+            waited = time.perf_counter() - start
+        elif self.pregen:
+            new_floor, waited = self.pregen.take(next_dlevel)
+        else:
+            new_floor = make_map(self.map_width, self.map_height, None, next_dlevel, self.seed,
+                                 self.tile_storage(next_dlevel))
+            waited = time.perf_counter() - start
+        self.descend_waits.append(waited)
+        up = new_floor.stairs_up
+        new_floor.enter(player, (up.x, up.y))
+        self.enter_floor(new_floor)
+
+    def previous_level(self):
+        # back up to a floor the player has already been on
+        self.message("You climb the stairs, wheezing.", libtcod.white)
+        self.leave_floor()
+        new_floor = self.floors.get(self.floor.dungeon_level - 1)
+        down = new_floor.stairs_down
+        new_floor.enter(self.player, (down.x, down.y))
+        self.enter_floor(new_floor)
+
+    def leave_floor(self):
+        # take the player off the floor and keep it for later
+        self.floor.remove_object(self.player)
+        self.floors.put(self.floor)
+
+    def player_death(self, pc, death_text):
+        # the game ended!
+        died_txt = 'You died!'
+        if self.combat_rng.random() < OBAMA_CHANCE:
+            died_txt = "THANKS OBAMA"
+        self.game_state = GS_DEAD
+        pc.death = Death(pc, death_text, self.game, self.floor)
+        # corpse time
+        pc.char = '%'
+        pc.color = libtcod.dark_red
+        if pc.floor:
+            pc.floor.touch(pc.x, pc.y)
+        if self.on_death:
+            self.on_death(self)
+        return Message(died_txt, libtcod.red)
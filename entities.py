@@ -0,0 +1,141 @@
+import numpy as np
+
+from model.object import Layer
+
+INITIAL_CAPACITY = 64
+
+# what an entity store keeps about each object, one array per field
+FIELDS = (('x', np.int32),
+          ('y', np.int32),
+          ('hp', np.int32),
+          ('power', np.int32),
+          ('defense', np.int32),
+          ('blocks', bool),
+          ('layer', np.int8),
+          ('has_ai', bool),
+          ('awake', bool),
+          ('used', bool))
+
+
+class EntityStore:
+    # the objects of a floor as parallel arrays, so questions about all of them ("who is within 5 tiles",
+    # "who is awake") are array operations instead of a walk over floor.objects. every object on the floor
+    # gets an id (o.eid) that stays the same while it's there; ids of objects that leave get reused.
+    # the objects stay the real thing. the floor copies them in as they're indexed (see Floor.index) and woken
+    # up, fighters as their hp is set and their equipment changes (see Fighter.hp and Character.add_equipped)
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.capacity = capacity
+        for name, dtype in FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.objects = [None] * capacity  # id -> object
+        self.free = []  # ids given back by remove(), reused first
+        self.count = 0  # ids handed out so far
+
+    def __len__(self):
+        return self.count - len(self.free)
+
+    def grow(self):
+        capacity = self.capacity * 2
+        for name, dtype in FIELDS:
+            array = np.zeros(capacity, dtype=dtype)
+            array[:self.capacity] = getattr(self, name)
+            setattr(self, name, array)
+        self.objects.extend([None] * (capacity - self.capacity))
+        self.capacity = capacity
+
+    def add(self, o):
+        if self.free:
+            eid = self.free.pop()
+        else:
+            if self.count == self.capacity:
+                self.grow()
+            eid = self.count
+            self.count += 1
+        self.objects[eid] = o
+        self.used[eid] = True
+        o.eid = eid
+        self.update(o)
+        return eid
+
+    def remove(self, o):
+        eid = o.eid
+        self.objects[eid] = None
+        self.used[eid] = False
+        self.awake[eid] = False
+        self.has_ai[eid] = False
+        self.free.append(eid)
+        o.eid = None
+
+    def update(self, o):
+        # copy one object's state into the arrays
+        eid = o.eid
+        self.x[eid] = o.x
+        self.y[eid] = o.y
+        self.blocks[eid] = o.blocks
+        self.layer[eid] = o.layer
+        self.set_stats(o)
+        self.has_ai[eid] = o.ai is not None
+        self.awake[eid] = o.ai is not None and o.floor is not None and o in o.floor.scheduler
+
+    def set_stats(self, o):
+        fighter = o.fighter
+        if fighter:
+            self.hp[o.eid] = fighter.hp
+            self.power[o.eid] = fighter.power
+            self.defense[o.eid] = fighter.defense
+        else:
+            self.hp[o.eid] = self.power[o.eid] = self.defense[o.eid] = 0
+
+    def set_awake(self, o, awake):
+        self.awake[o.eid] = awake
+
+    # queries. each returns ids; get() turns them into the objects
+    def get(self, ids):
+        return [self.objects[eid] for eid in ids.tolist()]
+
+    def fighters(self):
+        n = self.count
+        return self.used[:n] & (self.layer[:n] == Layer.CHARACTER)
+
+    def within(self, x, y, radius, mask=None):
+        # ids of the fighters at most radius tiles away (straight line, like Object.distance_to)
+        n = self.count
+        dx = self.x[:n] - x
+        dy = self.y[:n] - y
+        near = (dx * dx + dy * dy <= radius * radius) & self.fighters()
+        if mask is not None:
+            near &= mask
+        return np.flatnonzero(near)
+
+    def awake_ids(self):
+        return np.flatnonzero(self.awake[:self.count] & self.used[:self.count])
+
+    def dormant_in(self, view, x, y):
+        # ids of the monsters not yet awake on a cell that's set in view, a window of the map whose top left
+        # corner is x, y. in the order of their cells, column by column, like walking the window would give
+        n = self.count
+        dx = self.x[:n] - x
+        dy = self.y[:n] - y
+        w, h = view.shape
+        ids = np.flatnonzero(self.used[:n] & self.has_ai[:n] & ~self.awake[:n] &
+                             (dx >= 0) & (dx < w) & (dy >= 0) & (dy < h))
+        ids = ids[view[dx[ids], dy[ids]]]
+        return ids[np.lexsort((dy[ids], dx[ids]))]
+
+    # changes
+    def damage(self, ids, amount, death_text="died", killer=None):
+        # hit every fighter in ids for amount, less its defense, like Fighter.take_damage would one at a time.
+        # the hp of all of them is worked out in the arrays at once; only the ones hurt get it back, and only
+        # the ones killed go through their death function
+        ids = np.asarray(ids, dtype=np.intp)
+        ids = ids[self.used[ids] & (self.layer[ids] == Layer.CHARACTER)]
+        dealt = amount - self.defense[ids]
+        ids = ids[dealt > 0]
+        self.hp[ids] -= dealt[dealt > 0]
+        msgs = []
+        for eid, hp in zip(ids.tolist(), self.hp[ids].tolist()):
+            fighter = self.objects[eid].fighter
+            fighter.hp = hp
+            if hp <= 0:
+                msgs.extend(fighter.die(death_text, killer))
+        return msgs
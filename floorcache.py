@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import zlib
+from collections import OrderedDict
+
+from savegame import encode_floor, decode_floor
+
+DEFAULT_MAX_LIVE = 3  # floors kept around as objects, the rest go to disk
+COMPRESS_LEVEL = 6
+
+
+# eviction policies: given the live floors (least recently used first) and the level the player is on,
+# pick the level to send to disk
+def evict_lru(live, current):
+    return next(iter(live))
+
+
+def evict_farthest(live, current):
+    # the floor the most stairs away, since it's the one the player gets back to last
+    return max(live, key=lambda dlevel: (abs(dlevel - current), -dlevel))
+
+
+POLICIES = {
+    'lru': evict_lru,
+    'farthest': evict_farthest,
+}
+
+
+class FloorCache:
+    # the floors of a run the player isn't on. the most recent ones stay live, older ones are encoded like
+    # in a save file, compressed and spilled to disk, then restored when the player comes back
+    def __init__(self, max_live=DEFAULT_MAX_LIVE, policy='lru', spill_dir=None, storage_for=None):
+        if policy not in POLICIES:
+            raise ValueError("unknown eviction policy %r" % policy)
+        self.max_live = max_live
+        self.evict = POLICIES[policy]
+        self.spill_dir = spill_dir
+        self.own_dir = False  # a spill dir we made ourselves gets removed again by close()
+        self.live = OrderedDict()  # dungeon level -> Floor, least recently used first
+        self.spilled = {}  # dungeon level -> path of its file
+        # (dungeon level, reuse) -> where a restored floor keeps its layers, if not the default. floors whose
+        # tiles live in files of their own come back with them as they were, without reading them back in
+        self.storage_for = storage_for
+        self.current = 1
+
+    def __contains__(self, dlevel):
+        return dlevel in self.live or dlevel in self.spilled
+
+    def __len__(self):
+        return len(self.live) + len(self.spilled)
+
+    def put(self, floor):
+        # keep a floor the player just left
+        self.current = floor.dungeon_level
+        self.live[floor.dungeon_level] = floor
+        self.live.move_to_end(floor.dungeon_level)
+        while len(self.live) > self.max_live:
+            dlevel = self.evict(self.live, self.current)
+            self.spill(self.live.pop(dlevel))
+
+    def get(self, dlevel):
+        # take a floor back out, or None if it was never kept
+        self.current = dlevel
+        floor = self.live.pop(dlevel, None)
+        if floor is None and dlevel in self.spilled:
+            floor = self.restore(dlevel)
+        return floor
+
+    def spill(self, floor):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='floors-')
+            self.own_dir = True
+        path = os.path.join(self.spill_dir, 'floor-%d.bin' % floor.dungeon_level)
+        data = zlib.compress(encode_floor(floor), COMPRESS_LEVEL)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.spilled[floor.dungeon_level] = path
+
+    def restore(self, dlevel):
+        path = self.spilled.pop(dlevel)
+        storage = self.storage_for(dlevel, reuse=True) if self.storage_for else None
+        floor = decode_floor(self.read(path), storage=storage)
+        os.remove(path)
+        return floor
+
+    @staticmethod
+    def read(path):
+        with open(path, 'rb') as f:
+            return zlib.decompress(f.read())
+
+    def encoded(self):
+        # (dungeon level, encoded floor) for every floor kept, least recently used first
+        for dlevel, path in self.spilled.items():
+            yield dlevel, self.read(path)
+        for dlevel, floor in self.live.items():
+            yield dlevel, encode_floor(floor)
+
+    def close(self):
+        for path in self.spilled.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.spilled.clear()
+        self.live.clear()
+        if self.own_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self.own_dir = False
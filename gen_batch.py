@@ -0,0 +1,184 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tcod.path
+
+from engine import MAP_WIDTH, MAP_HEIGHT
+from map import make_map, GENERATORS
+from rng import RunSeed
+
+# generates lots of floors over all the cores and writes down what each one came out like, to check a change
+# to a generator for both quality and speed:
+#   python gen_batch.py --count 5000 --out floors.csv
+#   python gen_batch.py --generator cave --width 200 --height 200 --out caves.jsonl
+# floor i of a batch is dungeon level --dlevel of run seed --seed + i, so any floor in the output can be made
+# again with make_map(width, height, None, dlevel, RunSeed(seed), generator=generator)
+DEFAULT_COUNT = 1000
+DEFAULT_SEED = 1
+CHUNKSIZE = 16  # floors handed to a worker at a time
+
+# per floor, in this order
+COLUMNS = ('generator', 'seed', 'dlevel', 'width', 'height', 'rooms', 'open_ratio', 'corridor_tiles',
+           'monsters', 'items', 'stairs_distance', 'gen_seconds')
+
+
+def floor_stats(floor):
+    walkable = ~np.asarray(floor.blocked, dtype=bool)
+    # corridors are the open tiles outside every room. a floor without rooms (a cave) is all corridor
+    in_rooms = np.zeros_like(walkable)
+    for room in floor.rooms:
+        in_rooms[room.x1 + 1:room.x2, room.y1 + 1:room.y2] = True
+    monsters = sum(1 for o in floor.objects if o.fighter)
+    items = sum(1 for o in floor.objects if o.item)
+    # steps from where the player comes in to the stairs down, moving like the player does (diagonals too).
+    # -1 if there are no stairs down or they can't be reached
+    stairs_distance = -1
+    stairs = getattr(floor, 'stairs_down', None)
+    if floor.start is not None and stairs is not None:
+        unreached = np.iinfo(np.int32).max
+        distance = np.full(walkable.shape, unreached, dtype=np.int32)
+        distance[floor.start] = 0
+        tcod.path.dijkstra2d(distance, walkable.view(np.int8), 1, 1, out=distance)
+        steps = int(distance[stairs.x, stairs.y])
+        if steps != unreached:
+            stairs_distance = steps
+    return {'rooms': len(floor.rooms),
+            'open_ratio': round(float(walkable.mean()), 4),
+            'corridor_tiles': int((walkable & ~in_rooms).sum()),
+            'monsters': monsters,
+            'items': items,
+            'stairs_distance': stairs_distance}
+
+
+def build_floor(task):
+    # runs in a worker process
+    generator, seed, dlevel, width, height = task
+    start = time.perf_counter()
+    floor = make_map(width, height, None, dlevel, RunSeed(seed), generator=generator)
+    seconds = time.perf_counter() - start
+    row = {'generator': generator, 'seed': seed, 'dlevel': dlevel, 'width': width, 'height': height}
+    row.update(floor_stats(floor))
+    row['gen_seconds'] = round(seconds, 6)
+    return row
+
+
+def make_tasks(generators, count, seed, dlevel, width, height):
+    # every generator gets the same seeds, so their floors can be compared one for one
+    for generator in generators:
+        for i in range(count):
+            yield generator, seed + i, dlevel, width, height
+
+
+class CsvWriter:
+    def __init__(self, f):
+        self.writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + '\n')
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'jsonl': JsonlWriter,
+}
+
+
+class Totals:
+    # running sums of one generator's floors, for the summary at the end
+    def __init__(self):
+        self.floors = 0
+        self.seconds = 0.0
+        self.sums = dict.fromkeys(('rooms', 'open_ratio', 'corridor_tiles', 'monsters', 'items'), 0)
+        self.stairs = 0  # sum of stairs_distance over the floors where the stairs can be reached
+        self.unreachable = 0
+
+    def add(self, row):
+        self.floors += 1
+        self.seconds += row['gen_seconds']
+        for key in self.sums:
+            self.sums[key] += row[key]
+        if row['stairs_distance'] < 0:
+            self.unreachable += 1
+        else:
+            self.stairs += row['stairs_distance']
+
+
+def print_summary(totals, elapsed, workers):
+    floors = sum(t.floors for t in totals.values())
+    print("%d floors in %.2fs on %d workers: %.1f floors/sec, %.1f floors/sec per core"
+          % (floors, elapsed, workers, floors / elapsed, floors / elapsed / workers))
+    print('%-10s %8s %10s %9s %7s %7s %9s %8s %8s %7s' % ('generator', 'floors', 'floors/s', 'ms/floor',
+                                                          'rooms', 'open', 'corridor', 'monsters', 'items',
+                                                          'stairs'))
+    for generator, t in totals.items():
+        reached = t.floors - t.unreachable
+        print('%-10s %8d %10.1f %9.2f %7.1f %7.3f %9.1f %8.1f %8.1f %7.1f'
+              % (generator, t.floors, t.floors / t.seconds, t.seconds / t.floors * 1000,
+                 t.sums['rooms'] / t.floors, t.sums['open_ratio'] / t.floors,
+                 t.sums['corridor_tiles'] / t.floors, t.sums['monsters'] / t.floors,
+                 t.sums['items'] / t.floors, t.stairs / reached if reached else -1))
+        if t.unreachable:
+            print('  %d floors with no way to the stairs down' % t.unreachable)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate floors in parallel and collect statistics on them.")
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT, help="floors per generator")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="run seed of the first floor")
+    parser.add_argument('--dlevel', type=int, default=1, help="dungeon level of every floor")
+    parser.add_argument('--width', type=int, default=MAP_WIDTH)
+    parser.add_argument('--height', type=int, default=MAP_HEIGHT)
+    parser.add_argument('--generator', action='append', choices=sorted(GENERATORS),
+                        help="generator to run, may be given more than once (default: all of them)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: one per core; 1 runs in this process)")
+    parser.add_argument('--out', help="file to stream the per-floor statistics to")
+    parser.add_argument('--format', choices=sorted(WRITERS),
+                        help="format of --out (default: from its extension, else jsonl)")
+    args = parser.parse_args(argv)
+    if args.count < 1 or args.workers < 1:
+        parser.error("--count and --workers must be at least 1")
+    generators = args.generator or sorted(GENERATORS)
+    out_format = args.format
+    if out_format is None:
+        out_format = 'csv' if args.out and args.out.endswith('.csv') else 'jsonl'
+
+    tasks = make_tasks(generators, args.count, args.seed, args.dlevel, args.width, args.height)
+    totals = {generator: Totals() for generator in generators}
+    out = open(args.out, 'w', newline='') if args.out else None
+    writer = WRITERS[out_format](out) if out else None
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    start = time.perf_counter()
+    try:
+        rows = executor.map(build_floor, tasks, chunksize=CHUNKSIZE) if executor else map(build_floor, tasks)
+        # rows come back in the order of the tasks, and are written as they do
+        for row in rows:
+            totals[row['generator']].add(row)
+            if writer:
+                writer.write(row)
+    finally:
+        if executor:
+            executor.shutdown()
+        if out:
+            out.close()
+    print_summary(totals, time.perf_counter() - start, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
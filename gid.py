@@ -1,15 +1,15 @@
-import random
-import shelve
 import textwrap
 from enum import Enum, auto
 
+import numpy as np
 import tcod as libtcod
+import tcod.console
 import tcod.event
 
-from map import make_map, cardinal_names
-from model.character import Character, Fighter
-from model.death import Death
-from model.object import Object
+from engine import GameSession, GS_PLAYING, GS_DEAD, MAP_WIDTH, MAP_HEIGHT, LEVEL_UP_BASE, LEVEL_UP_FACTOR
+from map import cardinal_names
+from savegame import SaveError
+from scores import ScoreStore, record_from_session, words, import_shelf
 from util import pad
 
 import os
@@ -29,15 +29,18 @@ MSG_X = 2
 MSG_WIDTH = SCREEN_WIDTH - 4
 MSG_HEIGHT = 5
 
-# map size
-MAP_WIDTH = 80
-MAP_HEIGHT = 43
+# where the map goes on screen. its size comes from the engine
 MAP_Y = MSG_HEIGHT
 
 # GUI
 PANEL_HEIGHT = 4
 BAR_WIDTH = 20
 PANEL_Y = SCREEN_HEIGHT - PANEL_HEIGHT
+STATS_WIDTH = 32  # the renderer's counters, bottom right of the panel when switched on
+
+# how much of the floor fits on screen, between the messages and the panel. bigger floors scroll
+VIEW_WIDTH = SCREEN_WIDTH
+VIEW_HEIGHT = PANEL_Y - MAP_Y
 
 INVENTORY_WIDTH = 50
 CHARACTER_SCREEN_WIDTH = 30
@@ -45,11 +48,6 @@ LEVEL_SCREEN_WIDTH = 40
 
 MENU_WIDTH = 24
 
-# fov
-FOV_ALGO = 0  # default FOV algorithm
-FOV_LIGHT_WALLS = True
-MAX_LIGHT_RADIUS = 10
-
 LIMIT_FPS = 20  # 20 frames-per-second maximum
 
 # action strings
@@ -57,40 +55,31 @@ STRING_EXIT = 'exit'
 STRING_NO_ACTION = 'didnt-take-turn'
 STRING_ACTION = 'took-turn'
 
-# game state strings
-
-GS_PLAYING = 'playing'
-GS_DEAD = 'dead'
-
-# experience and level-ups
-LEVEL_UP_BASE = 200
-LEVEL_UP_FACTOR = 150
-DLEVEL_SCORE = 100
-DLEVEL_XP = 10
-
 # colors
 color_dark_wall = libtcod.Color(0, 0, 100)
 color_dark_ground = libtcod.Color(50, 50, 150)
 color_light_wall = libtcod.Color(200, 180, 50)
 color_light_ground = libtcod.Color(130, 110, 50)
-
-INVENTORY_MAX = 26
-WALL_DMG = 10
-OBAMA_CHANCE = 0.1
-
-SCORES_FILE_NAME = "scores.json"
-SCORE_KEY = "score"
+# map background colors, indexed by visible * 2 + wall
+background_palette = np.array([color_dark_ground, color_dark_wall, color_light_ground, color_light_wall],
+                              dtype=np.uint8)
+
+SCORES_FILE_NAME = "scores.dat"
+LEGACY_SCORES_FILE_NAME = "scores.json"  # the shelve high scores were kept in before scores.dat
+SAVE_FILE_NAME = "savegame.dat"
+# leaderboard keys -> (query filter, what to ask for)
+SCORE_FILTERS = {'n': ('name', 'name'), 'd': ('dlevel', 'deepest dungeon level'), 'e': ('epitaph', 'epitaph text')}
 ACHEIVEMENTS_FILE_NAME = "acheive.json"
 
 # game state
-game_msgs = []
-inventory = []
-player = None
-fov_recompute = None
-game_state = None
-fov_map = None
-game = None
-dungeon_map = None
+session = None
+screen = None
+
+# consoles, created by main()
+root = None
+con = None
+panel = None
+msg_panel = None
 
 bundle_dir = os.path.dirname(os.path.abspath(__file__))
 if getattr(sys, 'frozen', False):
@@ -106,26 +95,14 @@ class Screen(Enum):
     GAME = auto()
     TOMBSTONE = auto()
     SCORES = auto()
-
-
-class GameState:
-
-    def __init__(self):
-        self.score = 0
-        self.time = 0
-        self.discovered = {}
+    CONTINUE = auto()
 
 
 # player, inventory
 def attack_menu(pc):
-    global dungeon_map, player
-    targets = []
-    for i in range(-1, 2):
-        for j in range(-1, 2):
-            stuff = dungeon_map.get_stuff(pc.x + i, pc.y + j)
-            targets += filter(lambda o: o.fighter and o != player, stuff)
+    targets = session.attack_targets()
     if len(targets) == 0:
-        message("You can't hit that.", libtcod.white)
+        session.message("You can't hit that.", libtcod.white)
     else:
         target_choice = menu("Attack:",
                              list(map(lambda o: o.name + " (" + cardinal_names(o.x - pc.x, o.y - pc.y) + ")", targets)))
@@ -134,227 +111,184 @@ def attack_menu(pc):
         return None
 
 
-def move(thing, dx, dy):
-    # move by the given amount if not blocked
-    global dungeon_map
-    target_x = thing.x + dx
-    target_y = thing.y + dy
-    if not dungeon_map.is_blocked(target_x, target_y):
-        thing.x += dx
-        thing.y += dy
-    elif thing is player:
-        possible_blockers = dungeon_map.get_stuff(target_x, target_y)
-        blocker = None
-        if len(possible_blockers) > 0:
-            blocker = possible_blockers[0]
-        blocker_name = "a wall"
-        if blocker is not None:
-            blocker_name = str(blocker)
-        message("Ouch! You blunder into " + blocker_name + ".", libtcod.orange)
-        player.fighter.take_damage(random.randint(1, 5), "running into " + blocker_name)
-
-
-def pick_up(item):
-    global dungeon_map, player
-    # add to the player's inventory and remove from the map
-    if len(inventory) >= 26:
-        message('You attempt to pick up ' + item.owner.name + ', but are crushed under the weight of your load.',
-                libtcod.orange)
-        player.take_damage(111, "crushed to death")
-    else:
-        inventory.append(item.owner)
-        dungeon_map.objects.remove(item.owner)
-        message('You picked up ' + item.owner.name + '.', libtcod.white)
-
-        # special case: automatically equip, if the corresponding equipment slot is unused
-        equipment = item.owner.equipment
-        if equipment and player.get_equipped_in_slot(equipment.slot) is None:
-            equipment.equip()
-
-
-def drop(item):
-    global dungeon_map
-    # special case: if the object has the Equipment component, dequip it before dropping
-    if item.owner.equipment:
-        item.owner.equipment.dequip()
-
-    # add to the map and remove from the player's inventory. also, place it at the player's coordinates
-    dungeon_map.objects.append(item.owner)
-    inventory.remove(item.owner)
-    item.owner.x = player.x
-    item.owner.y = player.y
-    message('You dropped a ' + item.owner.name + '.', libtcod.yellow)
-
-
-def use(item):
-    global player
-    # special case: if the object has the Equipment component, the "use" action is to equip/dequip
-    if item.owner.equipment:
-        item.owner.equipment.toggle_equip()
-        return
-
-    # just call the "use_function" if it is defined
-    if item.use_function is None:
-        message('The ' + item.owner.name + ' cannot be used.')
-    else:
-        result = item.use_function(player)
-        if result != 'cancelled':
-            inventory.remove(item.owner)  # destroy after use, unless it was cancelled for some reason
-            for msg in result:
-                message(*msg.as_args())
-
-
-class Equipment:
-    # an object that can be equipped, yielding bonuses. automatically adds the Item component.
-    def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
-        self.power_bonus = power_bonus
-        self.defense_bonus = defense_bonus
-        self.max_hp_bonus = max_hp_bonus
-
-        self.slot = slot
-        self.is_equipped = False
-        self.owner = None
-
-    def toggle_equip(self):  # toggle equip/dequip status
-        if self.is_equipped:
-            self.dequip()
-        else:
-            self.equip()
-
-    def equip(self):
-        # if the slot is already being used, dequip whatever is there first
-        old_equipment = player.get_equipped_in_slot(self.slot)
-        if old_equipment is not None:
-            old_equipment.dequip()
-
-        # equip object and show a message about it
-        self.is_equipped = True
-        message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
-
-    def dequip(self):
-        # dequip object and show a message about it
-        if not self.is_equipped: return
-        self.is_equipped = False
-        message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
-
-
 # runtime functions
-def render_all():
-    global fov_map, color_dark_wall, color_light_wall
-    global color_dark_ground, color_light_ground
-    global fov_recompute, dungeon_map
-    if fov_recompute:
-        # recompute FOV if needed (the player moved or something)
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, MAX_LIGHT_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-        # go through all tiles, and set their background color according to the FOV
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = libtcod.map_is_in_fov(fov_map, x, y)
-                wall = dungeon_map.tiles[x][y].block_sight
-                if not visible:
-                    # if it's not visible right now, the player can only see it if it's explored
-                    if dungeon_map.tiles[x][y].explored:
-                        # it's out of the player's FOV
-                        if wall:
-                            libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-                else:
-                    # it's visible
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-                    dungeon_map.tiles[x][y].explored = True
-
-    # draw all objects in the list, except the player. we want it to
-    # always appear over all other objects! so it's drawn later.
-    cache = {}
-    for o in dungeon_map.objects:
-        if o != player:
-            coords = o.x, o.y
-            if coords not in cache or cache[coords].layer() <= o.layer():
-                o.draw(con, fov_map)
-                cache[coords] = o
-
-    player.draw(con, fov_map)
-
-    # blit the contents of "con" to the root console and present it
-    libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, MAP_Y)
-
-    # prepare to render the GUI panel
-    panel.clear(bg=libtcod.darkest_grey)
-    msg_panel.clear(bg=libtcod.black)
-
-    # print the game messages, one line at a time
-    m_y = 0
-    for (line, color) in game_msgs:
-        msg_panel.print(MSG_X, m_y, line, color)
-        m_y += 1
-
-    # show the player's stats
-    panel.print(1, 1, 'HP: ' + str(player.fighter.hp) + "/" + str(player.fighter.max_hp),
-                libtcod.white)
-    panel.print(1, 2, player.name + '     Score: ' + str(game.score))
-    panel.print(1, 3, 'Dungeon level ' + str(dungeon_map.dungeon_level))
-
-    # display names of objects under the mouse
-    panel.print(1, 0, get_names_under_mouse(), bg=libtcod.light_gray)
-
-    # blit the contents of "panel" to the root console
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
-    libtcod.console_blit(msg_panel, 0, 0, SCREEN_WIDTH, MSG_HEIGHT, 0, 0, 0)
-
-
-def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
-    # render a bar (HP, experience, etc). first calculate the width of the bar
-    bar_width = int(float(value) / maximum * total_width)
-
-    # render the background first
-    panel.draw_rect(x, y, total_width, 1, False, bg=back_color)
-
-    # now render the bar on top
-    if bar_width > 0:
-        panel.draw_rect(x, y, bar_width, 1, False, bg=back_color)
-
-    # finally, some centered text with the values
-    panel.print(int(x + total_width / 2), y, name + ': ' + str(value) + '/' + str(maximum), libtcod.white,
-                alignment=libtcod.CENTER)
-
-
-def get_names_under_mouse():
+def render_background(console, visible, floor, x1=0, y1=0, changed=None):
+    # explored tiles out of the player's FOV are drawn dark, visible ones lit. unexplored tiles are left alone.
+    # visible covers the part of the floor with its top left corner at (x1, y1), which goes to the top left of
+    # the console. with a changed mask, only those tiles are painted
+    width, height = visible.shape
+    area = (slice(x1, x1 + width), slice(y1, y1 + height))
+    shown = floor.explored[area]
+    if changed is not None:
+        shown = shown & changed
+    shade = visible * 2 + floor.block_sight[area]
+    console.bg[:width, :height][shown] = background_palette[shade[shown]]
+
+
+class Camera:
+    # the part of the floor the map console shows: width x height cells with their top left corner at (x, y).
+    # it stays put while the player is away from its edges, then centres on them again as far as the edges
+    # of the floor allow. scrolling repaints the whole view, so it shouldn't happen every step
+    def __init__(self, width=VIEW_WIDTH, height=VIEW_HEIGHT):
+        self.width = width
+        self.height = height
+        self.x = 0
+        self.y = 0
+
+    def follow(self, floor, x, y):
+        # returns True if the view had to move
+        new_x, new_y = self.x, self.y
+        if not self.x + self.width // 4 <= x < self.x + self.width - self.width // 4:
+            new_x = x - self.width // 2
+        if not self.y + self.height // 4 <= y < self.y + self.height - self.height // 4:
+            new_y = y - self.height // 2
+        new_x = min(max(new_x, 0), max(floor.width - self.width, 0))
+        new_y = min(max(new_y, 0), max(floor.height - self.height, 0))
+        moved = (new_x, new_y) != (self.x, self.y)
+        self.x, self.y = new_x, new_y
+        return moved
+
+    def bounds(self, floor):
+        # the floor cells in view, as x1, y1, x2, y2
+        return self.x, self.y, min(self.x + self.width, floor.width), min(self.y + self.height, floor.height)
+
+
+class TcodRenderer:
+    # draws a session onto tcod consoles. none of them has to be the window, so this works offscreen too.
+    # only redraws the map cells and panels that changed since the last frame, and only ever looks at the part
+    # of the floor the camera shows, so a frame costs the same on a floor of any size
+    def __init__(self, root, con, panel, msg_panel):
+        self.root = root
+        self.con = con
+        self.panel = panel
+        self.msg_panel = msg_panel
+        self.camera = Camera()
+        self.fov_version = None  # the FOV the map background was last painted for
+        self.visible = None  # and what was in view then, over the camera's cells
+        self.panel_state = None  # what the stats panel last showed
+        self.msg_version = None  # the message log the message panel last showed
+        self.frames = 0
+        self.touched = 0  # console cells the last frame drew
+        self.show_stats = False  # whether the panel shows the two above
+
+    def toggle_stats(self):
+        self.show_stats = not self.show_stats
+        self.panel_state = None  # repaint the panel, with or without them
+
+    def new_floor(self, session):
+        self.con.clear()  # unexplored areas start black (which is the default background color)
+        self.fov_version = None
+        self.visible = None
+        self.panel_state = None
+
+    def composite(self, floor, x1, y1, x2, y2):
+        # copy the floor's top glyphs in [x1, x2) x [y1, y2) onto the console in one go: the ones in view,
+        # and the always visible ones on explored tiles
+        area = (slice(x1, x2), slice(y1, y2))
+        screen = (slice(x1 - self.camera.x, x2 - self.camera.x), slice(y1 - self.camera.y, y2 - self.camera.y))
+        ch = floor.glyph_ch[area]
+        shown = (ch != 0) & (floor.visible_in(x1, y1, x2, y2) | (floor.glyph_always[area] & floor.explored[area]))
+        self.con.ch[screen] = np.where(shown, ch, ord(' '))
+        self.con.fg[screen][shown] = floor.glyph_fg[area][shown]
+        return ch.size
+
+    def render(self, session):
+        floor = session.floor
+        player = session.player
+        con = self.con
+        touched = 0
+        if self.camera.follow(floor, player.x, player.y):
+            # the view scrolled: everything on screen is somewhere else now
+            con.clear()
+            self.visible = None
+        x1, y1, x2, y2 = self.camera.bounds(floor)
+        cells = floor.dirty
+        floor.dirty = set()
+        xs = [x for x, y in cells if x1 <= x < x2 and y1 <= y < y2]
+        ys = [y for x, y in cells if x1 <= x < x2 and y1 <= y < y2]
+        if self.fov_version != session.fov_version or self.visible is None:
+            # set the background color of the tiles that came into or went out of view
+            self.fov_version = session.fov_version
+            visible = floor.visible_in(x1, y1, x2, y2)
+            if self.visible is None:
+                changed = np.ones(visible.shape, dtype=bool)
+            else:
+                changed = visible != self.visible
+            self.visible = visible
+            render_background(con, visible, floor, x1, y1, changed)
+            touched += int(np.count_nonzero(changed))
+            # their objects get redrawn along with those that changed
+            changed_x, changed_y = np.nonzero(changed)
+            if len(changed_x):
+                xs += [x1 + changed_x.min(), x1 + changed_x.max()]
+                ys += [y1 + changed_y.min(), y1 + changed_y.max()]
+        if xs:
+            touched += self.composite(floor, min(xs), min(ys), max(xs) + 1, max(ys) + 1)
+
+        # the GUI panels, when what they show changed
+        panel = self.panel
+        msg_panel = self.msg_panel
+        mouse_names = get_names_under_mouse(floor, self.camera)
+        panel_state = (player.fighter.hp, player.fighter.max_hp, player.name, session.game.score,
+                       floor.dungeon_level, mouse_names)
+        if panel_state != self.panel_state:
+            self.panel_state = panel_state
+            panel.clear(bg=libtcod.darkest_grey)
+            # show the player's stats
+            panel.print(1, 1, 'HP: ' + str(player.fighter.hp) + "/" + str(player.fighter.max_hp),
+                        libtcod.white)
+            panel.print(1, 2, player.name + '     Score: ' + str(session.game.score))
+            panel.print(1, 3, 'Dungeon level ' + str(floor.dungeon_level))
+            # display names of objects under the mouse
+            panel.print(1, 0, mouse_names, bg=libtcod.light_gray)
+            touched += SCREEN_WIDTH * PANEL_HEIGHT
+
+        if session.messages.version != self.msg_version:
+            self.msg_version = session.messages.version
+            msg_panel.clear(bg=libtcod.black)
+            # print the game messages, one line at a time
+            m_y = 0
+            for (line, color) in session.messages.lines(session.msg_width, session.msg_height):
+                msg_panel.print(MSG_X, m_y, line, color)
+                m_y += 1
+            touched += SCREEN_WIDTH * MSG_HEIGHT
+
+        if self.show_stats:
+            # the counters as of the frame before this one, over whatever the panel had there
+            stats = ('frame %d  drew %d cells' % (self.frames, self.touched)).rjust(STATS_WIDTH)
+            panel.print(SCREEN_WIDTH - STATS_WIDTH - 1, PANEL_HEIGHT - 1, stats, libtcod.light_grey,
+                        libtcod.darkest_grey)
+            touched += STATS_WIDTH
+
+        # blit everything to the root console and present it. always, since menus draw over the root console
+        con.blit(self.root, 0, MAP_Y, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        panel.blit(self.root, 0, PANEL_Y, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT)
+        msg_panel.blit(self.root, 0, 0, 0, 0, SCREEN_WIDTH, MSG_HEIGHT)
+        self.frames += 1
+        self.touched = touched
+
+
+def get_names_under_mouse(floor, camera):
     # return a string with the names of all objects under the mouse
-    global dungeon_map, fov_map
     mouse = libtcod.mouse_get_status()
-    (x, y) = (mouse.cx, mouse.cy)
+    (x, y) = (mouse.cx + camera.x, mouse.cy - MAP_Y + camera.y)
 
     # create a list with the names of all objects at the mouse's coordinates and in FOV
-    names = [obj.name for obj in dungeon_map.objects
-             if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+    stuff = floor.get_stuff(x, y)
+    names = []
+    if stuff and floor.is_in_fov(x, y):
+        names = [obj.name for obj in stuff]
 
     names = ', '.join(names)  # join the names, separated by commas
     return names.capitalize()
 
 
-def message(new_msg, color=libtcod.white):
-    # split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
-
-    for line in new_msg_lines:
-        # if the buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
-
-        # add the new line as a tuple, with the text and the color
-        game_msgs.append((line, color))
-
-
 def msgbox(text, width=50, wait_for_key=True):
     menu(text, [], width, wait_for_key=wait_for_key)  # use menu() as a sort of "message box"
 
 
-def text_entry(text, width=50):
+def text_entry(text, width=50, cancel=False):
+    # a line of text typed in by the player. with cancel, escape gives up and returns None
     text_height = 0
     if text != '':
         text_height = con.get_height_rect(0, 0, width, SCREEN_HEIGHT, text)
@@ -384,6 +318,8 @@ def text_entry(text, width=50):
         elif k.vk == tcod.KEY_ENTER:
             if text_len > 0:
                 return user_input
+        elif k.vk == tcod.KEY_ESCAPE and cancel:
+            return None
         window.clear()
         window.print(0, text_height + 2, user_input)
 
@@ -433,6 +369,7 @@ def menu(header, options, width=50, y_adjust=0, wait_for_key=True):
 
 def inventory_menu(header):
     # show a menu with each item of the inventory as an option
+    inventory = session.inventory
     if len(inventory) == 0:
         options = ['Inventory is empty.']
     else:
@@ -451,60 +388,56 @@ def inventory_menu(header):
     return inventory[index].item
 
 
+def took_turn(acted):
+    if acted:
+        return STRING_ACTION
+    return STRING_NO_ACTION
+
+
 def handle_keys():
-    global fov_recompute, screen, dungeon_map, player
+    global screen
 
+    player = session.player
     key = libtcod.console_wait_for_keypress(True)
 
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         # toggle fullscreen
         libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
 
+    elif key.vk == libtcod.KEY_F3:
+        # frame counters in the panel, for checking how much each frame redraws
+        session.renderer.toggle_stats()
+        return STRING_NO_ACTION
+
     elif key.vk == libtcod.KEY_ESCAPE:
         confirm = menu("Abandon the quest?", ["Yes", "No"], MENU_WIDTH)
         if confirm == 0:
             screen = Screen.MAIN_MENU
-            player_death(player, "quit")
+            session.quit()
             return STRING_EXIT
         return STRING_NO_ACTION
 
-    if game_state == GS_PLAYING:
+    if session.game_state == GS_PLAYING:
         # movement keys
         if key.vk == libtcod.KEY_UP:
-            move(player, 0, -1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(0, -1))
 
         elif libtcod.console_is_key_pressed(libtcod.KEY_DOWN):
-            move(player, 0, 1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(0, 1))
 
         elif libtcod.console_is_key_pressed(libtcod.KEY_LEFT):
-            move(player, -1, 0)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(-1, 0))
 
         elif libtcod.console_is_key_pressed(libtcod.KEY_RIGHT):
-            move(player, 1, 0)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(1, 0))
         elif libtcod.console_is_key_pressed(libtcod.KEY_INSERT):
-            move(player, -1, -1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(-1, -1))
         elif libtcod.console_is_key_pressed(libtcod.KEY_HOME):
-            move(player, 1, -1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(1, -1))
         elif libtcod.console_is_key_pressed(libtcod.KEY_END):
-            move(player, 1, 1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(1, 1))
         elif libtcod.console_is_key_pressed(libtcod.KEY_DELETE):
-            move(player, -1, 1)
-            fov_recompute = True
-            return STRING_ACTION
+            return took_turn(session.move(-1, 1))
         else:
             # test for other keys
             key_char = chr(key.c)
@@ -512,27 +445,19 @@ def handle_keys():
             if key_char == 'a':
                 target = attack_menu(player)
                 if target:
-                    for msg in player.fighter.attack(player, target):
-                        as_args = msg.as_args()
-                        message(*as_args)
-                    return STRING_ACTION
+                    return took_turn(session.attack(target))
                 else:
                     return STRING_NO_ACTION
 
             if key_char == 'g':
                 # pick up an item
-                for object in dungeon_map.objects:  # look for an item in the player's tile
-                    if object.x == player.x and object.y == player.y and object.item:
-                        pick_up(object.item)
-                        return STRING_ACTION
-                return STRING_NO_ACTION
+                return took_turn(session.pickup())
 
             if key_char == 'i':
                 # show the inventory; if an item is selected, use it
                 chosen_item = inventory_menu('Use item:\n')
                 if chosen_item is not None:
-                    use(chosen_item)
-                    return STRING_ACTION
+                    return took_turn(session.use(chosen_item))
                 else:
                     return STRING_NO_ACTION
 
@@ -540,8 +465,7 @@ def handle_keys():
                 # show the inventory; if an item is selected, drop it
                 chosen_item = inventory_menu('Drop item:\n')
                 if chosen_item is not None:
-                    drop(chosen_item)
-                    return STRING_ACTION
+                    return took_turn(session.drop(chosen_item))
                 else:
                     return STRING_NO_ACTION
 
@@ -554,6 +478,18 @@ def handle_keys():
                     '\nAttack: ' + str(player.fighter.power) + '\nDefense: ' + str(player.fighter.defense),
                     CHARACTER_SCREEN_WIDTH)
                 return STRING_NO_ACTION
+            if key_char == 'm':
+                show_history()
+                return STRING_NO_ACTION
+            if key_char == 's':
+                # save and quit to the main menu
+                try:
+                    session.save(SAVE_FILE_NAME)
+                except SaveError as e:
+                    msgbox("The game can't be saved: " + str(e) + ".")
+                    return STRING_NO_ACTION
+                screen = Screen.MAIN_MENU
+                return STRING_EXIT
             if key_char == 'l':
                 # while True:
                 #     render_all()
@@ -563,34 +499,47 @@ def handle_keys():
                 return STRING_NO_ACTION
             if key_char == '.' and key.shift:  # >
                 # go down stairs, if the player is on them
-                if dungeon_map.stairs_down.x == player.x and dungeon_map.stairs_down.y == player.y:
-                    next_level()
-                    return STRING_ACTION
-                else:
-                    message("You can't go down on that.", libtcod.white)
-                    return STRING_NO_ACTION
+                return took_turn(session.descend())
             if key_char == '.' and not key.shift:
-                return STRING_ACTION  # wait
+                return took_turn(session.wait())
 
             if key_char == ',' and key.shift:  # <
-                if dungeon_map.stairs_up.x == player.x and dungeon_map.stairs_up.y == player.y:
-                    message("You attempt to climb the stairs but the effort destroys your already frail body.",
-                            libtcod.yellow)
-                    player.fighter.take_damage(100, "collapsed from over-exertion")
-                    return STRING_ACTION
-                else:
-                    message("You can't get high here.", libtcod.white)
-                    return STRING_NO_ACTION
-            else:
-                print(key)
-                return STRING_NO_ACTION
-
-            return STRING_ACTION
-    elif game_state == GS_DEAD:
+                return took_turn(session.ascend())
+            return STRING_NO_ACTION
+    elif session.game_state == GS_DEAD:
         screen = Screen.TOMBSTONE
         return STRING_EXIT
 
 
+def show_history():
+    # scroll back through the message log, newest at the bottom
+    width = SCREEN_WIDTH - 2
+    height = SCREEN_HEIGHT - 2
+    total = session.messages.line_count(width)
+    offset = 0  # lines scrolled up from the newest
+    while not libtcod.console_is_window_closed():
+        root.clear(bg=libtcod.black)
+        root.print(1, 0, "MESSAGES   " + str(max(0, total - offset - height) + 1) + "-" + str(total - offset) +
+                   " of " + str(total) + " lines   up/down, pgup/pgdn: scroll   esc: back", libtcod.yellow)
+        lines = session.messages.lines(width, height, offset)
+        for i, (line, color) in enumerate(lines):
+            root.print(1, 1 + height - len(lines) + i, line, color)
+        libtcod.console_flush()
+
+        key = libtcod.console_wait_for_keypress(True)
+        if key.vk == libtcod.KEY_UP:
+            offset += 1
+        elif key.vk == libtcod.KEY_DOWN:
+            offset -= 1
+        elif key.vk == libtcod.KEY_PAGEUP:
+            offset += height
+        elif key.vk == libtcod.KEY_PAGEDOWN:
+            offset -= height
+        elif key.vk in (libtcod.KEY_ESCAPE, libtcod.KEY_ENTER) or chr(key.c) == 'm':
+            return
+        offset = max(0, min(offset, total - height))
+
+
 def show_help():
     msgbox("Controls:\n\n"
            "ARROWS    = NESW MOVEMENT\n"
@@ -603,81 +552,32 @@ def show_help():
            "c         = CHARACTER SCREEN\n"
            "g         = GET ITEMS\n"
            "d         = DROP ITEMS\n"
+           "m         = MESSAGE HISTORY\n"
+           "s         = SAVE AND QUIT\n"
            # "l      = LOOK (MOUSE)\n"
            "<         = GO UP\n"
            ">         = GO DOWN\n"
            ".         = NO ACTION\n"
            "?         = THIS MESSAGE\n"
-           "ALT+ENTER = FULL SCREEN\n")
+           "ALT+ENTER = FULL SCREEN\n"
+           "F3        = FRAME COUNTERS\n")
 
 
-def next_level():
-    # advance to the next level
-    global dungeon_map, player, game
+def save_score(dead_session):
+    # save to high score
+    open_scores().add(record_from_session(dead_session))
 
-    player.fighter.xp += DLEVEL_XP * dungeon_map.dungeon_level
-    game.score += DLEVEL_SCORE * dungeon_map.dungeon_level
-    next_dlevel = dungeon_map.dungeon_level + 1
-    if random.random() < 0.1:
-        message("You tumble down the stairs.", libtcod.orange)
-        player.fighter.take_damage(random.randint(1, 4), "fell down the stairs")
-    else:
-        message('You manage to avoid falling down the stairs.', libtcod.white)
-    dungeon_map = make_map(MAP_WIDTH, MAP_HEIGHT, player)
-    dungeon_map.dungeon_level = next_dlevel
-    initialize_fov()
-
-
-def initialize_fov():
-    global fov_recompute, fov_map
-    fov_recompute = True
-
-    # create the FOV map, according to the generated map
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not dungeon_map.tiles[x][y].block_sight,
-                                       not dungeon_map.tiles[x][y].blocked)
-
-    libtcod.console_clear(con)  # unexplored areas start black (which is the default background color)
-
-
-def player_death(pc, death_text):
-    # the game ended!
-    global game_state, dungeon_map
-    died_txt = 'You died!'
-    if random.random() < OBAMA_CHANCE:
-        died_txt = "THANKS OBAMA"
-    message(died_txt, libtcod.red)
-    game_state = GS_DEAD
-    player.death = Death(player, death_text, game, dungeon_map)
-    # corpse time
-    pc.char = '%'
-    pc.color = libtcod.dark_red
 
-    # save to high score
-    shelf = shelve.open(SCORES_FILE_NAME)
-    scores = []
-    if SCORE_KEY in shelf:
-        scores = shelf[SCORE_KEY]
-    scores.append(player)
-    scores.sort(reverse=True, key=lambda dead_person: (
-        dead_person.death.game.score, dead_person.level, dead_person.death.floor.dungeon_level, dead_person.name))
-    shelf[SCORE_KEY] = scores
-    shelf.close()
-
-
-def load_scores():
-    shelf = shelve.open(SCORES_FILE_NAME)
-    scores = []
-    if SCORE_KEY in shelf:
-        scores = shelf[SCORE_KEY]
-    shelf.close()
-    return scores
+def open_scores():
+    # the score store. while it's empty, scores from an old scores.json are brought over into it
+    store = ScoreStore(SCORES_FILE_NAME)
+    if store.count() == 0:
+        import_shelf(store, LEGACY_SCORES_FILE_NAME)
+    return store
 
 
 def tombstone():
-    global player, game, dungeon_map
+    player = session.player
     death = player.death
     death_screen = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
     death_screen.clear(bg=libtcod.black)
@@ -719,94 +619,102 @@ def tombstone():
 
 
 def show_scores():
-    root.clear(bg=libtcod.black)
-    msgbox("LOADING...", 10, False)
+    # the leaderboard, a page at a time. only the rows on screen are read from the score store
+    store = open_scores()
     x_coord = 1
-    y_start = 0
-    rank = 1
-    scores = load_scores()
-    for dead_person in scores:
-        y_coord = rank + y_start
-        num_txt = pad(str(rank) + ". ", 5)
-        score_txt = pad(str(dead_person.death.game.score) + "   ", 8)
-        name_txt = pad(dead_person.name + "   ", 18)
-        epitath_txt = pad(dead_person.death.epitath,
-                          SCREEN_WIDTH - x_coord - len(num_txt) - len(score_txt) - len(name_txt))
-        root.print(x_coord, y_coord, num_txt + score_txt + name_txt + epitath_txt, libtcod.white)
-        rank += 1
-    libtcod.console_flush()
-    libtcod.console_wait_for_keypress(True)
+    page_size = SCREEN_HEIGHT - 3
+    page = 0
+    filters = {}
+    while not libtcod.console_is_window_closed():
+        scores, total = store.query(page_size, page * page_size, **filters)
+        pages = max(1, (total + page_size - 1) // page_size)
+        root.clear(bg=libtcod.black)
+        filter_txt = ", ".join(key + ": " + str(value) for key, value in sorted(filters.items()))
+        root.print(x_coord, 0, "HIGH SCORES   page " + str(page + 1) + "/" + str(pages) + "   " +
+                   str(total) + " deaths   " + filter_txt, libtcod.yellow)
+        rank = page * page_size + 1
+        for i, record in enumerate(scores):
+            num_txt = pad(str(rank + i) + ". ", 8)
+            score_txt = pad(str(record.score) + "   ", 8)
+            name_txt = pad(record.name + "   ", 18)
+            depth_txt = pad(str(record.dlevel) + "  ", 4)
+            epitath_width = SCREEN_WIDTH - x_coord - len(num_txt) - len(score_txt) - len(name_txt) - len(depth_txt)
+            root.print(x_coord, i + 1, num_txt + score_txt + name_txt + depth_txt +
+                       record.epitaph[:epitath_width], libtcod.white)
+        root.print(x_coord, SCREEN_HEIGHT - 1, "up/down: page   n: name   d: depth   e: epitaph   c: clear   "
+                                               "esc: back", libtcod.grey)
+        libtcod.console_flush()
+
+        key = libtcod.console_wait_for_keypress(True)
+        key_char = chr(key.c)
+        if key.vk in (libtcod.KEY_DOWN, libtcod.KEY_PAGEDOWN, libtcod.KEY_RIGHT):
+            page = min(page + 1, pages - 1)
+        elif key.vk in (libtcod.KEY_UP, libtcod.KEY_PAGEUP, libtcod.KEY_LEFT):
+            page = max(page - 1, 0)
+        elif key.vk == libtcod.KEY_HOME:
+            page = 0
+        elif key.vk == libtcod.KEY_END:
+            page = pages - 1
+        elif key_char in SCORE_FILTERS:
+            field, label = SCORE_FILTERS[key_char]
+            value = text_entry("Only show deaths with this " + label + ":\n\n(esc: cancel)", cancel=True)
+            if value is not None and field == 'dlevel':
+                value = int(value) if value.strip().isdigit() else None
+            if value is not None and field == 'epitaph' and not words(value):
+                value = None  # nothing in it to search for
+            if value is not None:
+                filters[field] = value
+            page = 0
+        elif key_char == 'c':
+            filters = {}
+            page = 0
+        elif key.vk in (libtcod.KEY_ESCAPE, libtcod.KEY_ENTER):
+            return
 
 
 def new_game():
-    global player, fov_recompute, game_state, fov_map, game, game_msgs, inventory, dungeon_map, screen
+    global session
 
     root.clear(bg=libtcod.black)
     libtcod.console_flush()
     name = text_entry("You are an elderly adventurer, come to the dungeon for one last quest."
                       "\n\nWhat is your name, wizened one?")
 
-    inventory = []
-    dungeon_level = 1
-
-    # player
-    fighter_component = Fighter(hp=10, defense=1, power=2, xp=0, death_function=player_death)
-    player = Character(0, 0, '@', name, libtcod.white, fighter=fighter_component, inventory=inventory, player=True)
-    equipment_component = Equipment(slot='right hand', power_bonus=2)
-    obj = Object(0, 0, '/', 'rolled-up newspaper', libtcod.light_grey, equipment=equipment_component)
-    inventory.append(obj)
-    equipment_component.equip()
-    obj.always_visible = True
-
-    # generate map (at this point it's not drawn to the screen)
-    dungeon_map = make_map(MAP_WIDTH, MAP_HEIGHT, player)
-
-    # generate field of view map based on level map
-    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not dungeon_map.tiles[x][y].block_sight,
-                                       not dungeon_map.tiles[x][y].blocked)
-
-    # global variables
-    fov_recompute = True
-    game_state = GS_PLAYING
-    game = GameState()
-
-    game_msgs = []
-    message("Go, " + player.name + "! Recover the Golden Pigeon of Nyan!", libtcod.white)
-    message("Press '?' for help", libtcod.grey)
+    renderer = TcodRenderer(root, con, panel, msg_panel)
+    session = GameSession(name, renderer, on_death=save_score, map_width=MAP_WIDTH, map_height=MAP_HEIGHT,
+                          msg_width=MSG_WIDTH, msg_height=MSG_HEIGHT)
+    main_loop()
+
+
+def continue_game():
+    global session, screen
+
+    renderer = TcodRenderer(root, con, panel, msg_panel)
+    try:
+        session = GameSession(None, renderer, on_death=save_score, map_width=MAP_WIDTH, map_height=MAP_HEIGHT,
+                              msg_width=MSG_WIDTH, msg_height=MSG_HEIGHT, load_from=SAVE_FILE_NAME)
+    except SaveError as e:
+        session = None
+        msgbox("The saved game can't be continued: " + str(e) + ".")
+        screen = Screen.MAIN_MENU
+        return
+    # one life per save: it's gone once the run carries on
+    os.remove(SAVE_FILE_NAME)
     main_loop()
 
 
 def main_loop():
-    global dungeon_map, game
     while not libtcod.console_is_window_closed():
 
         # render the screen
-        render_all()
+        session.render()
         libtcod.console_flush()
 
-        # erase all objects at their old locations, before they move
-        for o in dungeon_map.objects:
-            o.clear(con)
-
-        # handle keys and exit game if needed
+        # handle keys and exit game if needed. the monsters take their turns inside the session
         player_action = handle_keys()
         if player_action == STRING_EXIT:
             break
-        elif player_action != STRING_NO_ACTION:
-            game.time += 1
-            if game.time % 10 == 0:  # Score from time survived
-                game.score += 1
-            # npc turns
-            for entity in dungeon_map.objects:
-                if entity.ai:
-                    enemy_turn_results = entity.ai.take_turn(player, fov_map, dungeon_map)
-                    for result in enemy_turn_results:
-                        message(*result.as_args())
-        else:
-            print("defer turn")
+    session.close()
 
 
 def print_title(img):
@@ -820,44 +728,58 @@ def print_title(img):
 #############################################
 # Initialization & Main Loop
 #############################################
-libtcod.console_set_custom_font(get_asset_filepath('arial10x10.png'), libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-root = libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "guess I'll die", False)
-msg_panel = libtcod.console_new(SCREEN_WIDTH, MSG_HEIGHT)
-con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-screen = Screen.MAIN_MENU
-while not libtcod.console_is_window_closed():
-    if screen == Screen.MAIN_MENU:
-        img = libtcod.image_load(get_asset_filepath('gidSmall.png'))
-        print_title(img)
-        title_text = "GUESS I'LL DIE"
-        x = int(SCREEN_WIDTH / 2) - (int(len(title_text) / 2))
-        y = SCREEN_HEIGHT - 18
-        con.clear(bg=libtcod.black)
-        con.print(x, y, title_text, libtcod.white, libtcod.black, libtcod.BKGND_OVERLAY)
-        con.blit(root, x - 1, y - 1, x - 1, y - 1, len(title_text) + 2, 3, bg_alpha=0.7)
-        libtcod.console_flush(clear_color=libtcod.white)
-        key = libtcod.console_wait_for_keypress(True)
-        con.clear(bg=libtcod.black)
-        print_title(img)
-
-        # create an off-screen console that represents the menu's window
-        choice = menu("\n " + title_text + "\n", ['NEW GAME', 'SCORES', 'QUIT'], 16, 10)
-        if choice is 0:
-            screen = Screen.GAME
-        elif choice is 1:
+def main():
+    global root, msg_panel, con, panel, screen, session
+    libtcod.console_set_custom_font(get_asset_filepath('arial10x10.png'), libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+    root = libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, "guess I'll die", False)
+    msg_panel = libtcod.console_new(SCREEN_WIDTH, MSG_HEIGHT)
+    con = tcod.console.Console(SCREEN_WIDTH, SCREEN_HEIGHT, order="F")  # x-major, like the floor's tile layers
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+    screen = Screen.MAIN_MENU
+    while not libtcod.console_is_window_closed():
+        if screen == Screen.MAIN_MENU:
+            img = libtcod.image_load(get_asset_filepath('gidSmall.png'))
+            print_title(img)
+            title_text = "GUESS I'LL DIE"
+            x = int(SCREEN_WIDTH / 2) - (int(len(title_text) / 2))
+            y = SCREEN_HEIGHT - 18
+            con.clear(bg=libtcod.black)
+            con.print(x, y, title_text, libtcod.white, libtcod.black, libtcod.BKGND_OVERLAY)
+            con.blit(root, x - 1, y - 1, x - 1, y - 1, len(title_text) + 2, 3, bg_alpha=0.7)
+            libtcod.console_flush(clear_color=libtcod.white)
+            key = libtcod.console_wait_for_keypress(True)
+            con.clear(bg=libtcod.black)
+            print_title(img)
+
+            # create an off-screen console that represents the menu's window
+            options = ['NEW GAME', 'SCORES', 'QUIT']
+            if os.path.exists(SAVE_FILE_NAME):
+                options.insert(0, 'CONTINUE')
+            choice = menu("\n " + title_text + "\n", options, 16, 10)
+            choice = options[choice] if choice is not None else None
+            if choice == 'CONTINUE':
+                screen = Screen.CONTINUE
+            elif choice == 'NEW GAME':
+                screen = Screen.GAME
+            elif choice == 'SCORES':
+                screen = Screen.SCORES
+            elif choice == 'QUIT':
+                break
+            # else:
+            #     display_test(root, SCREEN_WIDTH, SCREEN_HEIGHT)
+            #     screen = Screen.MAIN_MENU
+        elif screen == Screen.GAME:
+            new_game()
+        elif screen == Screen.CONTINUE:
+            continue_game()
+        elif screen == Screen.TOMBSTONE:
+            tombstone()
             screen = Screen.SCORES
-        elif choice is 2:
-            break
-        # else:
-        #     display_test(root, SCREEN_WIDTH, SCREEN_HEIGHT)
-        #     screen = Screen.MAIN_MENU
-    elif screen == Screen.GAME:
-        new_game()
-    elif screen == Screen.TOMBSTONE:
-        tombstone()
-        screen = Screen.SCORES
-    elif screen == Screen.SCORES:
-        show_scores()
-        player = None  # clean up
-        screen = Screen.MAIN_MENU
+        elif screen == Screen.SCORES:
+            show_scores()
+            session = None  # clean up
+            screen = Screen.MAIN_MENU
+
+
+if __name__ == '__main__':
+    main()
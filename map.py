@@ -1,45 +1,253 @@
+
+import numpy as np
 import tcod as libtcod
+import tcod.map
+import tcod.path
 
+from entities import EntityStore
 from model.character import make_enemy
 from model.item import Item
 from model.object import Object
+from pathing import ChaseField
+from rng import RunSeed, LAYOUT, SPAWNS
+from scheduler import Scheduler
+from storage import default_storage
 
 STAIRS_UP_NAME = 'stairs up'
 STAIRS_DOWN_NAME = 'stairs down'
 
 
 # map stuff
+# the per-cell layers of a floor: (name, shape past [x, y], dtype, fill). tile layers are the map itself
+TILE_LAYERS = (('blocked', (), bool, True),
+               ('block_sight', (), bool, True),
+               ('explored', (), bool, False))
+# layers kept up to date as objects come, go and change: the number of blocking objects standing on each cell,
+# then what the top object of each cell looks like: its character (0 where there's nothing), its color and
+# whether it stays visible out of FOV
+OBJECT_LAYERS = (('blockers', (), np.int16, 0),
+                 ('glyph_ch', (), np.int32, 0),
+                 ('glyph_fg', (3,), np.uint8, 0),
+                 ('glyph_always', (), bool, False))
+
+
 class Floor:
-    def __init__(self, tiles, objects, rooms, dlevel=1):
-        self.tiles = tiles
-        self.objects = objects
+    def __init__(self, width, height, objects, rooms, dlevel=1, storage=None):
+        self.width = width
+        self.height = height
+        # where the per-cell layers below live, see storage.py
+        if storage is None:
+            storage = default_storage(width, height)
+        self.storage = storage
+        # tile layers, indexed [x, y]. a new floor is solid rock
+        for name, depth, dtype, fill in TILE_LAYERS:
+            setattr(self, name, storage.tile_layer(name, (width, height) + depth, dtype, fill))
+        self.tiles = TileGrid(self)
+        # what the last compute_fov() saw: only the window around the viewer it looked at, whose top left
+        # corner is fov_origin. everything outside it is out of view
+        self.fov = np.zeros((0, 0), dtype=bool)
+        self.fov_origin = (0, 0)
+        # where monsters go to get at the player, worked out at most once a turn for all of them
+        self.chase = ChaseField(self)
+        # awake monsters, in the order they get to act
+        self.scheduler = Scheduler()
+        self.objects = []
         self.dungeon_level = dlevel
         self.rooms = rooms
+        self.start = None  # where the player arrives, set by the generator
+
+        # objects on each occupied cell, highest layer first
+        self.stacks = {}
+        # layers worked out from the objects, see OBJECT_LAYERS
+        for name, depth, dtype, fill in OBJECT_LAYERS:
+            setattr(self, name, storage.layer(name, (width, height) + depth, dtype, fill))
+        # cells whose objects changed since the renderer last looked
+        self.dirty = set()
+        # the objects as arrays, for floors with a lot of them. off until use_entities() is called
+        self.entities = None
+
         for o in objects:
-            if o.name is STAIRS_DOWN_NAME:
-                self.stairs_down = o
-            elif o.name is STAIRS_UP_NAME:
-                self.stairs_up = o
+            self.add_object(o)
+
+    def move_to(self, storage):
+        # put every layer in another storage, e.g. chunks for a floor that was generated in plain arrays
+        if storage is self.storage:
+            return
+        for layers, make in ((TILE_LAYERS, storage.tile_layer), (OBJECT_LAYERS, storage.layer)):
+            for name, depth, dtype, fill in layers:
+                layer = make(name, (self.width, self.height) + depth, dtype, fill)
+                old = getattr(self, name)
+                if type(old) is type(layer):
+                    # already kept the way the new storage keeps it
+                    continue
+                layer[...] = old
+                setattr(self, name, layer)
+        self.storage = storage
+
+    def use_entities(self):
+        # start keeping an EntityStore of this floor's objects, from here on kept in step by the methods below
+        if self.entities is None:
+            self.entities = EntityStore()
+            for o in self.objects:
+                self.entities.add(o)
+        return self.entities
+
+    def add_object(self, o):
+        self.objects.append(o)
+        o.floor = self
+        self.index(o)
+        if self.entities is not None:
+            self.entities.add(o)
+        if o.name == STAIRS_DOWN_NAME:
+            self.stairs_down = o
+        elif o.name == STAIRS_UP_NAME:
+            self.stairs_up = o
+
+    def enter(self, o, at=None):
+        # put someone arriving on this floor at its start, or wherever they came in
+        o.x, o.y = at or self.start
+        self.add_object(o)
+
+    def remove_object(self, o):
+        self.unindex(o)
+        if self.entities is not None:
+            self.entities.remove(o)
+        self.objects.remove(o)
+        o.floor = None
+
+    def move_object(self, o, x, y):
+        self.unindex(o)
+        o.x = x
+        o.y = y
+        self.index(o)
+
+    def index(self, o):
+        # put the object into its cell's stack, below anything on a higher or equal layer
+        stack = self.stacks.setdefault((o.x, o.y), [])
+        layer = o.layer
+        i = 0
+        while i < len(stack) and stack[i].layer >= layer:
+            i += 1
+        stack.insert(i, o)
+        if o.blocks:
+            self.blockers[o.x, o.y] += 1
+        if o.eid is not None:
+            self.entities.update(o)
+        self.refresh(o.x, o.y)
+
+    def unindex(self, o):
+        # call before changing anything the index depends on (position, blocks, layer)
+        coords = (o.x, o.y)
+        stack = self.stacks[coords]
+        stack.remove(o)
+        if not stack:
+            del self.stacks[coords]
+        if o.blocks:
+            self.blockers[o.x, o.y] -= 1
+        self.refresh(o.x, o.y)
+
+    def touch(self, x, y):
+        # something on the cell changed how it looks without moving
+        self.refresh(x, y)
+
+    def refresh(self, x, y):
+        stack = self.stacks.get((x, y))
+        if stack:
+            top = stack[0]
+            self.glyph_ch[x, y] = ord(top.char)
+            self.glyph_fg[x, y] = top.color
+            self.glyph_always[x, y] = top.always_visible
+        else:
+            self.glyph_ch[x, y] = 0
+        self.dirty.add((x, y))
+
+    def carve(self, x1, y1, x2, y2):
+        # make every tile in [x1, x2) x [y1, y2) passable
+        self.storage.touch()
+        self.blocked[x1:x2, y1:y2] = False
+        self.block_sight[x1:x2, y1:y2] = False
+
+    def set_tile(self, x, y, blocked, block_sight=None):
+        # change a single tile (digging, doors...). by default, if a tile is blocked, it also blocks sight
+        if block_sight is None:
+            block_sight = blocked
+        self.storage.touch()
+        self.blocked[x, y] = blocked
+        self.block_sight[x, y] = block_sight
+
+    def compute_fov(self, x, y, radius, light_walls, algorithm):
+        # nothing further than radius can be in view, so only the window around (x, y) that reaches that far
+        # gets looked at, however big the floor. returns what's in view in that window
+        if radius > 0:
+            x1, y1 = max(x - radius, 0), max(y - radius, 0)
+            x2, y2 = min(x + radius + 1, self.width), min(y + radius + 1, self.height)
+        else:
+            x1, y1, x2, y2 = 0, 0, self.width, self.height
+        transparent = ~self.block_sight[x1:x2, y1:y2]
+        self.fov = tcod.map.compute_fov(transparent, (x - x1, y - y1), radius, light_walls, algorithm)
+        self.fov_origin = (x1, y1)
+        return self.fov
+
+    def is_in_fov(self, x, y):
+        ox, oy = self.fov_origin
+        width, height = self.fov.shape
+        return 0 <= x - ox < width and 0 <= y - oy < height and bool(self.fov[x - ox, y - oy])
+
+    def visible_in(self, x1, y1, x2, y2):
+        # what's in view in [x1, x2) x [y1, y2)
+        visible = np.zeros((x2 - x1, y2 - y1), dtype=bool)
+        ox, oy = self.fov_origin
+        width, height = self.fov.shape
+        ax1, ay1 = max(x1, ox), max(y1, oy)
+        ax2, ay2 = min(x2, ox + width), min(y2, oy + height)
+        if ax1 < ax2 and ay1 < ay2:
+            visible[ax1 - x1:ax2 - x1, ay1 - y1:ay2 - y1] = self.fov[ax1 - ox:ax2 - ox, ay1 - oy:ay2 - oy]
+        return visible
+
+    def explore(self):
+        # whatever is in view right now becomes explored
+        x1, y1 = self.fov_origin
+        x2, y2 = x1 + self.fov.shape[0], y1 + self.fov.shape[1]
+        seen = self.explored[x1:x2, y1:y2]
+        if (self.fov & ~seen).any():
+            self.storage.touch()
+            self.explored[x1:x2, y1:y2] = seen | self.fov
+
+    def wake_visible(self):
+        # put dormant monsters standing on tiles in view on the turn queue. monsters always block,
+        # so only cells with a blocker need looking at
+        ox, oy = self.fov_origin
+        if self.entities is not None:
+            # the store knows who's dormant and where, without looking at the cells at all
+            for o in self.entities.get(self.entities.dormant_in(self.fov, ox, oy)):
+                self.scheduler.add(o)
+                self.entities.set_awake(o, True)
+            return
+        x2, y2 = ox + self.fov.shape[0], oy + self.fov.shape[1]
+        for x, y in zip(*np.nonzero(self.fov & (self.blockers[ox:x2, oy:y2] > 0))):
+            x, y = int(x) + ox, int(y) + oy
+            for o in self.stacks[(x, y)]:
+                if o.ai and o not in self.scheduler:
+                    self.scheduler.add(o)
 
     def is_blocked(self, x, y):
         # first test the map tile
-        if self.tiles[x][y].blocked:
+        if self.blocked[x, y]:
             return True
 
         # now check for any blocking objects
-        for o in self.objects:
-            if o.blocks and o.x == x and o.y == y:
-                return True
+        return bool(self.blockers[x, y] > 0)
 
-        return False
+    def get_blocker(self, x, y):
+        if self.blockers[x, y] > 0:
+            for o in self.stacks[(x, y)]:
+                if o.blocks:
+                    return o
+        return None
 
     def get_stuff(self, x, y):
-        stuff = []
-        for o in self.objects:
-            if o.x == x and o.y == y:
-                stuff.append(o)
-        stuff.sort(key=lambda thing: thing.layer(), reverse=True)
-        return stuff
+        # everything on the cell, highest layer first
+        return list(self.stacks.get((x, y), ()))
 
 
 def cardinal_names(dx, dy):
@@ -65,18 +273,72 @@ def cardinal_names(dx, dy):
 
 
 class Tile:
-    # a tile of the map and its properties
-    def __init__(self, blocked, block_sight=None):
-        self.explored = False
-        self.blocked = blocked
+    # a tile of the map and its properties, read from and written to the floor's tile layers
+    __slots__ = ('floor', 'x', 'y')
+
+    def __init__(self, floor, x, y):
+        self.floor = floor
+        self.x = x
+        self.y = y
+
+    @property
+    def blocked(self):
+        return bool(self.floor.blocked[self.x, self.y])
+
+    @blocked.setter
+    def blocked(self, value):
+        self.floor.set_tile(self.x, self.y, value, self.block_sight)
+
+    @property
+    def block_sight(self):
+        return bool(self.floor.block_sight[self.x, self.y])
+
+    @block_sight.setter
+    def block_sight(self, value):
+        self.floor.set_tile(self.x, self.y, self.blocked, value)
+
+    @property
+    def explored(self):
+        return bool(self.floor.explored[self.x, self.y])
 
-        # by default, if a tile is blocked, it also blocks sight
-        if block_sight is None: block_sight = blocked
-        self.block_sight = block_sight
+    @explored.setter
+    def explored(self, value):
+        self.floor.storage.touch()
+        self.floor.explored[self.x, self.y] = value
+
+
+class TileGrid:
+    # lets floor.tiles[x][y] keep working on top of the tile layers
+    __slots__ = ('floor',)
+
+    def __init__(self, floor):
+        self.floor = floor
+
+    def __len__(self):
+        return self.floor.width
+
+    def __getitem__(self, x):
+        return TileColumn(self.floor, x)
+
+
+class TileColumn:
+    __slots__ = ('floor', 'x')
+
+    def __init__(self, floor, x):
+        self.floor = floor
+        self.x = x
+
+    def __len__(self):
+        return self.floor.height
+
+    def __getitem__(self, y):
+        return Tile(self.floor, self.x, y)
 
 
 class Rect:
     # a rectangle on the map. used to characterize a room.
+    __slots__ = ('x1', 'y1', 'x2', 'y2')
+
     def __init__(self, x, y, w, h):
         self.x1 = x
         self.y1 = y
@@ -94,25 +356,93 @@ class Rect:
                 self.y1 <= other.y2 and self.y2 >= other.y1)
 
 
-def create_room(tiles, room):
-    # go through the tiles in the rectangle and make them passable
-    for x in range(room.x1 + 1, room.x2):
-        for y in range(room.y1 + 1, room.y2):
-            tiles[x][y].blocked = False
-            tiles[x][y].block_sight = False
-
-
-def create_h_tunnel(tiles, x1, x2, y):
-    for x in range(min(x1, x2), max(x1, x2) + 1):
-        tiles[x][y].blocked = False
-        tiles[x][y].block_sight = False
-
+class RoomGrid:
+    # the rooms of a map sorted into square buckets at least as big as a room, so a new room only gets
+    # checked against the rooms in the few buckets it covers instead of all of them. also keeps the buckets
+    # no room touches yet, so placement can aim for free space instead of trying spots that are taken
+    __slots__ = ('size', 'cols', 'rows', 'buckets', 'free', 'free_at')
+
+    def __init__(self, width, height, size):
+        self.size = size
+        self.cols = width // size + 1
+        self.rows = height // size + 1
+        self.buckets = [[] for i in range(self.cols * self.rows)]
+        self.free = list(range(self.cols * self.rows))  # buckets with no room in them, in no order
+        self.free_at = {b: i for i, b in enumerate(self.free)}  # bucket -> where it is in free
+
+    def covered(self, room):
+        # the buckets a room touches, edges included like in Rect.intersect
+        size = self.size
+        for by in range(max(0, room.y1 // size), min(self.rows - 1, room.y2 // size) + 1):
+            for bx in range(max(0, room.x1 // size), min(self.cols - 1, room.x2 // size) + 1):
+                yield by * self.cols + bx
+
+    def intersects(self, room):
+        for b in self.covered(room):
+            for other in self.buckets[b]:
+                if room.intersect(other):
+                    return True
+        return False
 
-def create_v_tunnel(tiles, y1, y2, x):
+    def add(self, room):
+        for b in self.covered(room):
+            self.buckets[b].append(room)
+            i = self.free_at.pop(b, None)
+            if i is not None:
+                # swap the last free bucket into its place
+                last = self.free.pop()
+                if last != b:
+                    self.free[i] = last
+                    self.free_at[last] = i
+
+    def nearest(self, x, y):
+        # a room close to (x, y): the closest one in the nearest ring of buckets around it that has any
+        bx, by = x // self.size, y // self.size
+        for ring in range(max(self.cols, self.rows)):
+            best = None
+            for b in self.ring(bx, by, ring):
+                for room in self.buckets[b]:
+                    rx, ry = room.center()
+                    d = (rx - x) ** 2 + (ry - y) ** 2
+                    if best is None or d < best[0]:
+                        best = (d, room)
+            if best is not None:
+                return best[1]
+        return None
+
+    def ring(self, bx, by, ring):
+        # the buckets exactly ring steps away from (bx, by), that are on the map
+        x1, x2 = max(0, bx - ring), min(self.cols - 1, bx + ring)
+        for cy in (by - ring, by + ring) if ring else (by,):
+            if 0 <= cy < self.rows:
+                for cx in range(x1, x2 + 1):
+                    yield cy * self.cols + cx
+        if ring:
+            for cx in (bx - ring, bx + ring):
+                if 0 <= cx < self.cols:
+                    for cy in range(max(0, by - ring + 1), min(self.rows - 1, by + ring - 1) + 1):
+                        yield cy * self.cols + cx
+
+    def sample_free(self, rng):
+        # the top left corner of a random free bucket, or None once every bucket has a room in it
+        if not self.free:
+            return None
+        b = self.free[rng.randrange(len(self.free))]
+        return (b % self.cols) * self.size, (b // self.cols) * self.size
+
+
+def create_room(floor, room):
+    # make the tiles inside the rectangle passable, leaving its edge as wall
+    floor.carve(room.x1 + 1, room.y1 + 1, room.x2, room.y2)
+
+
+def create_h_tunnel(floor, x1, x2, y):
+    floor.carve(min(x1, x2), y, max(x1, x2) + 1, y + 1)
+
+
+def create_v_tunnel(floor, y1, y2, x):
     # vertical tunnel
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        tiles[x][y].blocked = False
-        tiles[x][y].block_sight = False
+    floor.carve(x, min(y1, y2), x + 1, max(y1, y2) + 1)
 
 
 def from_dungeon_level(table, dungeon_level):
@@ -123,7 +453,7 @@ def from_dungeon_level(table, dungeon_level):
     return 0
 
 
-def place_objects(room, dungeon_level):
+def place_objects(room, dungeon_level, rng):
     #     # this is where we decide the chance of each monster or item appearing.
     #
     #     # maximum number of monsters per room
@@ -144,17 +474,17 @@ def place_objects(room, dungeon_level):
     #                     'shield': from_dungeon_level([[15, 8]])}
     #
     #     # choose random number of monsters
-    num_monsters = libtcod.random_get_int(None, 0, max_monsters)
+    num_monsters = rng.randint(0, max_monsters)
     #
     for i in range(num_monsters):
         # choose random spot for this monster
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = rng.randint(room.x1 + 1, room.x2 - 1)
+        y = rng.randint(room.y1 + 1, room.y2 - 1)
 
-        #         # only place it if the tile is not blocked
-        if not dungeon_level.is_blocked(x, y):
-            mook = make_enemy(x, y, dungeon_level)
-            dungeon_level.objects.append(mook)
+        #         # only place it if the tile is not blocked, and not where the player will arrive
+        if not dungeon_level.is_blocked(x, y) and (x, y) != dungeon_level.start:
+            mook = make_enemy(x, y, dungeon_level, rng)
+            dungeon_level.add_object(mook)
 
     #             choice = random_choice(monster_chances)
     #             if choice == 'orc':
@@ -176,12 +506,12 @@ def place_objects(room, dungeon_level):
     #             objects.append(monster)
     #
     #     # choose random number of items
-    num_items = libtcod.random_get_int(None, 0, max_items)
+    num_items = rng.randint(0, max_items)
     #
     for i in range(num_items):
         # choose random spot for this item
-        x = libtcod.random_get_int(0, room.x1 + 1, room.x2 - 1)
-        y = libtcod.random_get_int(0, room.y1 + 1, room.y2 - 1)
+        x = rng.randint(room.x1 + 1, room.x2 - 1)
+        y = rng.randint(room.y1 + 1, room.y2 - 1)
         #
         # only place it if the tile is not blocked
         if not dungeon_level.is_blocked(x, y):
@@ -202,111 +532,259 @@ def place_objects(room, dungeon_level):
         #                 equipment_component = Equipment(slot='left hand', defense_bonus=1)
         #                 item = Object(x, y, '[', 'shield', libtcod.darker_orange, equipment=equipment_component)
         #
-            dungeon_level.objects.append(item)
             # item.send_to_back()  # items appear below other objects
             item.always_visible = True  # items are visible even out-of-FOV, if in an explored area
+            dungeon_level.add_object(item)
 
 
 # Map generation
 
-def make_map(width, height, player):
-    return make_map_rand_room(width, height, player)
-
-
-def make_map_rand_room(width, height, player, max_rooms=30, min_room_size=6, max_room_size=10):
-    # the list of objects starting with the player
-    objects = [player]
-
-    # fill map with "blocked" tiles
-    map = [[Tile(True)
-            for y in range(height)]
-           for x in range(width)]
-
+MAX_ROOMS = 30  # room attempts on a map of the standard size
+STANDARD_AREA = 80 * 43
+
+
+def room_attempts(width, height):
+    # bigger maps get proportionally more rooms, the standard map keeps its 30
+    return max(MAX_ROOMS, MAX_ROOMS * width * height // STANDARD_AREA)
+
+
+# caves: how much of the map's width the passage can take up, and how it's roughened
+CAVE_MIN_WIDTH = 3
+CAVE_MAX_WIDTH_SHARE = 4  # the passage is at most a quarter of the map wide
+CAVE_MAX_DRIFT = 2  # cells the passage can shift sideways from one row to the next
+CAVE_SMOOTHING = 2  # cellular automaton passes over the roughened edges
+CAVE_ROUGHNESS = 0.4
+CAVE_WINDINESS = 0.5
+CAVE_SPAWN_ROWS = 8  # rows of cave that get the monsters and items of one room
+
+
+def rooms_generator(width, height, player, dlevel, rng, spawn_rng, storage):
+    max_rooms = room_attempts(width, height)
+    # maps bigger than the standard one aim their rooms at free space. the standard one places them the way it
+    # always has, so its floors stay the same for the same seed
+    return make_map_rand_room(width, height, player, max_rooms=max_rooms, dlevel=dlevel, rng=rng,
+                              spawn_rng=spawn_rng, sample_free=max_rooms > MAX_ROOMS, storage=storage)
+
+
+def cave_generator(width, height, player, dlevel, rng, spawn_rng, storage):
+    # one cave running the whole height of the map
+    return make_map_dir_cave(width, height, player, height, CAVE_ROUGHNESS, CAVE_WINDINESS, dlevel=dlevel,
+                             rng=rng, spawn_rng=spawn_rng, storage=storage)
+
+
+# floor generators by name: function(width, height, player, dlevel, layout rng, spawn rng, storage) -> Floor
+GENERATORS = {
+    'rooms': rooms_generator,
+    'cave': cave_generator,
+}
+DEFAULT_GENERATOR = 'rooms'
+LEVEL_GENERATORS = {}  # dungeon level -> name of its generator, for the levels that don't use the default
+
+
+def make_map(width, height, player=None, dlevel=1, seed=None, storage=None, generator=None):
+    # floor dlevel of a seed is always the same. without a seed, it's a fresh one every time.
+    # without a player, the floor is left for them to enter() later. storage is where the floor keeps its
+    # layers (see storage.py), by default picked by its size. generator is one of GENERATORS, by default the
+    # one LEVEL_GENERATORS picks for the level
+    if seed is None:
+        seed = RunSeed()
+    if generator is None:
+        generator = LEVEL_GENERATORS.get(dlevel, DEFAULT_GENERATOR)
+    if storage is None:
+        storage = default_storage(width, height)
+    # carving goes a lot faster in plain arrays than in chunks, so the floor is generated in whatever the
+    # storage says to and only moved into it once it's done
+    floor = GENERATORS[generator](width, height, player, dlevel, seed.stream(LAYOUT, dlevel),
+                                  seed.stream(SPAWNS, dlevel), storage.staging())
+    floor.move_to(storage)
+    return floor
+
+
+def make_map_rand_room(width, height, player, max_rooms=MAX_ROOMS, min_room_size=6, max_room_size=10, dlevel=1, *,
+                       rng, spawn_rng, sample_free=False, storage=None):
     rooms = []
     num_rooms = 0
+    # accepted rooms by where they are, so checking a new one doesn't mean going through all of them
+    grid = RoomGrid(width, height, max_room_size + 1)
 
-    floor = Floor(map, objects, rooms)
+    # the map starts filled with "blocked" tiles
+    floor = Floor(width, height, [], rooms, dlevel, storage)
 
     for r in range(max_rooms):
         # random width and height
-        w = libtcod.random_get_int(0, min_room_size, max_room_size)
-        h = libtcod.random_get_int(0, min_room_size, max_room_size)
-        # random position without going out of the boundaries of the map
-        x = libtcod.random_get_int(0, 0, width - w - 1)
-        y = libtcod.random_get_int(0, 0, height - h - 1)
+        w = rng.randint(min_room_size, max_room_size)
+        h = rng.randint(min_room_size, max_room_size)
+        if sample_free:
+            # somewhere in a bucket no room has got to yet, nudged back onto the map if it sticks out
+            corner = grid.sample_free(rng)
+            if corner is None:
+                break  # the map is full
+            x = min(corner[0] + rng.randint(0, grid.size - 1), width - w - 1)
+            y = min(corner[1] + rng.randint(0, grid.size - 1), height - h - 1)
+        else:
+            # random position without going out of the boundaries of the map
+            x = rng.randint(0, width - w - 1)
+            y = rng.randint(0, height - h - 1)
 
         # "Rect" class makes rectangles easier to work with
         new_room = Rect(x, y, w, h)
 
-        # run through the other rooms and see if they intersect with this one
-        failed = False
-        for other_room in rooms:
-            if new_room.intersect(other_room):
-                failed = True
-                break
-
-        if not failed:  # this room is valid
+        # see if it intersects with any of the rooms near it
+        if not grid.intersects(new_room):  # this room is valid
 
             # "paint" it to the map's tiles
-            create_room(map, new_room)
-
-            # add some contents to this room, such as monsters
-            place_objects(new_room, floor)
+            create_room(floor, new_room)
 
             # center coordinates of new room, will be useful later
             (new_x, new_y) = new_room.center()
 
             if num_rooms == 0:
-                # pass
-                # this is the first room, where the player starts at
-                player.x = new_x
-                player.y = new_y
+                # this is the first room, where the player starts at. nothing spawns on top of them
+                floor.start = (new_x, new_y)
+                if player is not None:
+                    floor.enter(player)
                 up = Object(new_x, new_y, '<', STAIRS_UP_NAME, libtcod.white, always_visible=True)
-                objects.append(up)
+                floor.add_object(up)
             else:
                 # all rooms after the first:
                 # connect it to the previous room with a tunnel
 
-                # center coordinates of previous room
-                (prev_x, prev_y) = rooms[num_rooms - 1].center()
+                # center coordinates of previous room. when rooms are spread over free space, the previous one
+                # can be anywhere, so join the closest one instead to keep the tunnels short
+                if sample_free:
+                    (prev_x, prev_y) = grid.nearest(new_x, new_y).center()
+                else:
+                    (prev_x, prev_y) = rooms[num_rooms - 1].center()
 
                 # draw a coin (random number that is either 0 or 1)
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if rng.randint(0, 1) == 1:
                     # first move horizontally, then vertically
-                    create_h_tunnel(map, prev_x, new_x, prev_y)
-                    create_v_tunnel(map, prev_y, new_y, new_x)
+                    create_h_tunnel(floor, prev_x, new_x, prev_y)
+                    create_v_tunnel(floor, prev_y, new_y, new_x)
                 else:
                     # first move vertically, then horizontally
-                    create_v_tunnel(map, prev_y, new_y, prev_x)
-                    create_h_tunnel(map, prev_x, new_x, new_y)
+                    create_v_tunnel(floor, prev_y, new_y, prev_x)
+                    create_h_tunnel(floor, prev_x, new_x, new_y)
+
+            # add some contents to this room, such as monsters
+            place_objects(new_room, floor, spawn_rng)
 
             # finally, append the new room to the list
             rooms.append(new_room)
+            grid.add(new_room)
             num_rooms += 1
 
     # create stairs at the center of the last room
     stairs = Object(new_x, new_y, '>', STAIRS_DOWN_NAME, libtcod.white, always_visible=True)
-    objects.append(stairs)
-    return Floor(map, objects, rooms)
-
-
-def make_map_dir_cave(width, height, player, length, roughness, windiness, start_x=-1, start_y=2):
-    pass
-
-
-def make_map_test(width, height, player):
-    # fill map with "blocked" tiles
-    map = [[Tile(True)
-            for y in range(height)]
-           for x in range(width)]
-
+    floor.add_object(stairs)
+    return floor
+
+
+def reflect(walk, lo, hi):
+    # fold a walk back and forth between lo and hi, as if it bounced off them
+    span = hi - lo
+    if span <= 0:
+        return np.full_like(walk, lo)
+    t = (walk - lo) % (2 * span)
+    return lo + np.where(t > span, 2 * span - t, t)
+
+
+def open_neighbours(cells):
+    # how many of each cell's 8 neighbours are open, as a sum of the shifted grid
+    padded = np.pad(cells.astype(np.int8), 1)
+    w, h = cells.shape
+    total = np.zeros((w, h), dtype=np.int8)
+    for dx in (0, 1, 2):
+        for dy in (0, 1, 2):
+            if dx != 1 or dy != 1:
+                total += padded[dx:dx + w, dy:dy + h]
+    return total
+
+
+def make_map_dir_cave(width, height, player, length, roughness, windiness, start_x=-1, start_y=2, dlevel=1, *,
+                      rng, spawn_rng, storage=None):
+    # a cave winding down the map from row start_y for length rows. from one row to the next its width changes
+    # with a chance of roughness and it drifts sideways with a chance of windiness; roughness also sets how
+    # ragged its walls are. start_x -1 starts it anywhere. all of it is worked out a whole row or grid at a time
+    noise = np.random.default_rng(rng.getrandbits(64))
+    start_y = min(max(start_y, 2), height - 2)
+    rows = max(1, min(length, height - 1 - start_y))
+    max_width = max(CAVE_MIN_WIDTH, width // CAVE_MAX_WIDTH_SHARE)
+    lo = max(2, 1 + max_width // 2)  # the passage's middle, far enough from the edges for it to fit
+    hi = max(lo, width - 2 - max_width // 2)
+
+    # width and middle of the passage on every row, as random walks
+    widths = reflect(noise.integers(CAVE_MIN_WIDTH, max_width + 1) +
+                     np.cumsum(noise.integers(-2, 3, rows) * (noise.random(rows) < roughness)),
+                     CAVE_MIN_WIDTH, max_width)
+    if start_x < 0:
+        start_x = int(noise.integers(lo, hi + 1))
+    start_x = min(max(start_x, lo), hi)
+    middles = reflect(start_x + np.cumsum(noise.integers(-CAVE_MAX_DRIFT, CAVE_MAX_DRIFT + 1, rows) *
+                                          (noise.random(rows) < windiness)), lo, hi)
+    middles[0] = start_x
+    lefts = middles - widths // 2
+
+    # everything happens inside the box around the passage, with a wall all round
+    x1, x2 = max(int(lefts.min()) - 2, 0), min(int((lefts + widths).max()) + 2, width)
+    y1, y2 = max(start_y - 2, 0), min(start_y + rows + 2, height)
+    xs = np.arange(x1, x2)[:, None]
+    ys = np.arange(y1, y2)[None, :]
+    row = np.clip(ys - start_y, 0, rows - 1)
+    in_rows = (ys >= start_y) & (ys < start_y + rows)
+    cave = in_rows & (xs >= lefts[row]) & (xs < lefts[row] + widths[row])
+    # the cells down its middle, which stay open whatever the smoothing does so it never gets cut in two
+    spine = in_rows & (abs(xs - middles[row]) <= 1)
+
+    # ragged walls: open up some of the wall cells along the edge, then smooth the result
+    edge = ~cave & (open_neighbours(cave) > 0)
+    cave |= edge & (noise.random(cave.shape) < roughness)
+    for i in range(CAVE_SMOOTHING):
+        around = open_neighbours(cave)
+        cave = np.where(around >= 5, True, np.where(around <= 3, False, cave))
+    # the box's edge is either the map's border or at least a cell clear of the passage, so walling it up
+    # never touches the spine or the start
+    cave[[0, -1], :] = False
+    cave[:, [0, -1]] = False
+    cave |= spine
+
+    # only keep what can be walked to from the start, and put the stairs down as far from it as it gets
+    start = (start_x - x1, start_y - y1)
+    distance = np.full(cave.shape, np.iinfo(np.int32).max, dtype=np.int32)
+    distance[start] = 0
+    tcod.path.dijkstra2d(distance, cave.view(np.int8), 1, 1, out=distance)
+    cave &= distance != np.iinfo(np.int32).max
+    far_x, far_y = np.unravel_index(np.argmax(np.where(cave, distance, -1)), cave.shape)
+
+    floor = Floor(width, height, [], [], dlevel, storage)
+    floor.blocked[x1:x2, y1:y2] = ~cave
+    floor.block_sight[x1:x2, y1:y2] = ~cave
+    floor.start = (start_x, start_y)
+    if player is not None:
+        floor.enter(player)
+    floor.add_object(Object(start_x, start_y, '<', STAIRS_UP_NAME, libtcod.white, always_visible=True))
+
+    # monsters and items, a room's worth for every few rows of cave
+    for top in range(start_y, start_y + rows, CAVE_SPAWN_ROWS):
+        bottom = min(top + CAVE_SPAWN_ROWS, start_y + rows)
+        left = int(lefts[top - start_y:bottom - start_y].min())
+        right = int((lefts + widths)[top - start_y:bottom - start_y].max())
+        place_objects(Rect(left - 1, top - 1, right - left + 1, bottom - top + 1), floor, spawn_rng)
+
+    floor.add_object(Object(int(far_x) + x1, int(far_y) + y1, '>', STAIRS_DOWN_NAME, libtcod.white,
+                            always_visible=True))
+    return floor
+
+
+def make_map_test(width, height, player, storage=None):
     # create two rooms
     room1 = Rect(20, 15, 10, 15)
     room2 = Rect(50, 15, 10, 15)
-    create_room(map, room1)
-    create_room(map, room2)
-    create_h_tunnel(map, 25, 55, 23)
-    player.x = 23
-    player.y = 25
-
-    return Floor(map, [player], [room1, room2])
+    floor = Floor(width, height, [], [room1, room2], storage=storage)
+    floor.start = (23, 25)
+    floor.enter(player)
+    create_room(floor, room1)
+    create_room(floor, room2)
+    create_h_tunnel(floor, 25, 55, 23)
+
+    return floor
@@ -1,29 +1,41 @@
 import math
-import random
 
 import tcod as libtcod
+import tcod.map
 
 from model.object import Object, Layer
 from msg import Message
+from pathing import MAX_CHASE_STEPS
+from scheduler import NORMAL_SPEED
 from util import random_choice_index
 
 
 def default_death(monster, death_text):
     death_message = Message('{0} dies.'.format(monster.name.capitalize()), libtcod.red)
 
+    # corpses stop blocking and drop to a lower layer, so take it out of the floor's index while it changes
+    floor = monster.floor
+    if floor:
+        floor.unindex(monster)
     monster.char = '%'
     # monster.color = libtcod.dark_red
     monster.blocks = False
     monster.fighter = None
     monster.ai = None
     monster.name = 'corpse (' + monster.name + ')'
-    monster.render_order = Layer.TRASH
+    monster.layer = Layer.TRASH
+    if floor:
+        floor.scheduler.remove(monster)
+        floor.index(monster)
 
     return death_message
 
 
 class Character(Object):
-    def __init__(self, x, y, char, name, color, fighter, ai=None, inventory=None, player=False):
+    __slots__ = ('inventory', 'player', 'speed', 'level', 'death', 'equipped', 'power_bonus', 'defense_bonus',
+                 'max_hp_bonus')
+
+    def __init__(self, x, y, char, name, color, fighter, ai=None, inventory=None, player=False, speed=NORMAL_SPEED):
         super().__init__(x, y, char, name, color, True, fighter=fighter)
         if self.fighter:
             fighter.owner = self
@@ -33,6 +45,7 @@ class Character(Object):
             inventory = []
         self.inventory = inventory
         self.player = player
+        self.speed = speed
         self.ai = ai
         if self.ai:
             self.ai.owner = self
@@ -40,24 +53,41 @@ class Character(Object):
         self.level = 1
         self.death = None
 
+        # what's equipped in each slot, and the bonuses it all adds up to. kept by add_equipped/remove_equipped.
+        # most monsters never wear anything, so the slot map only gets made for the first piece
+        self.equipped = None
+        self.power_bonus = 0
+        self.defense_bonus = 0
+        self.max_hp_bonus = 0
+
     def __str__(self):
         return self.name
 
     def get_all_equipped(self):  # returns a list of equipped items
-        equipped_list = []
-        for item in self.inventory:
-            if item.equipment and item.equipment.is_equipped:
-                equipped_list.append(item.equipment)
-        return equipped_list
+        return list(self.equipped.values()) if self.equipped else []
 
     def get_equipped_in_slot(self, slot):  # returns the equipment in a slot, or None if it's empty
-        for obj in self.inventory:
-            if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-                return obj.equipment
-        return None
-
-    def move_towards(self, target_x, target_y, dungeon_map):
-        entities = dungeon_map.objects
+        return self.equipped.get(slot) if self.equipped else None
+
+    def add_equipped(self, equipment):
+        if self.equipped is None:
+            self.equipped = {}
+        self.equipped[equipment.slot] = equipment
+        self.power_bonus += equipment.power_bonus
+        self.defense_bonus += equipment.defense_bonus
+        self.max_hp_bonus += equipment.max_hp_bonus
+        if self.eid is not None:
+            self.floor.entities.set_stats(self)
+
+    def remove_equipped(self, equipment):
+        del self.equipped[equipment.slot]
+        self.power_bonus -= equipment.power_bonus
+        self.defense_bonus -= equipment.defense_bonus
+        self.max_hp_bonus -= equipment.max_hp_bonus
+        if self.eid is not None:
+            self.floor.entities.set_stats(self)
+
+    def move_towards(self, target_x, target_y, dungeon_map, rng):
         dx = target_x - self.x
         dy = target_y - self.y
         distance = math.sqrt(dx ** 2 + dy ** 2)
@@ -66,17 +96,16 @@ class Character(Object):
         dy = int(round(dy / distance))
 
         if not (dungeon_map.is_blocked(self.x + dx, self.y + dy) or
-                get_blocking_entities_at_location(entities, self.x + dx, self.y + dy)):
-            return self.move(dx, dy, dungeon_map)
+                dungeon_map.get_blocker(self.x + dx, self.y + dy)):
+            return self.move(dx, dy, dungeon_map, rng)
         return []
 
-    def move(self, dx, dy, dungeon_map):
-        # move by the given amount if not blocked
+    def move(self, dx, dy, dungeon_map, rng):
+        # move by the given amount if not blocked. rng rolls the damage of running into something
         target_x = self.x + dx
         target_y = self.y + dy
         if not dungeon_map.is_blocked(target_x, target_y):
-            self.x += dx
-            self.y += dy
+            dungeon_map.move_object(self, target_x, target_y)
         else:
             possible_blockers = dungeon_map.get_stuff(target_x, target_y)
             blocker = None
@@ -86,7 +115,7 @@ class Character(Object):
             if blocker is not None:
                 blocker_name = str(blocker)
             msgs = [Message(self.name + "slams into " + blocker_name + ".", libtcod.orange)]
-            msgs.extend(self.fighter.take_damage(random.randint(1, 5), "running into " + blocker_name))
+            msgs.extend(self.fighter.take_damage(rng.randint(1, 5), "running into " + blocker_name))
             return msgs
         return []
 
@@ -98,99 +127,123 @@ class Character(Object):
         dy = other.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
 
-    def move_astar(self, target, dungeon_map):
+    def move_chase(self, target, dungeon_map, rng):
+        # take the next step along the floor's shared chase field instead of running a search of our own
+        field = dungeon_map.chase
+        field.update(target)
+        step = field.step_from(self.x, self.y)
+        if step is not None:
+            dungeon_map.move_object(self, *step)
+            return []
+        # Same backup as move_astar: no short path (for example another monster blocks a corridor),
+        # so still try to move towards the player (closer to the corridor opening)
+        return self.move_towards(target.x, target.y, dungeon_map, rng)
+
+    def move_astar(self, target, dungeon_map, rng):
         msgs = []
-        game_map = dungeon_map.tiles
-        entities = dungeon_map.objects
-        # Create a FOV map that has the dimensions of the map
-        width = len(game_map)
-        height = len(game_map[0])
-        fov = libtcod.map_new(width, height)
-
-        # Scan the current map each turn and set all the walls as unwalkable
-        for y1 in range(height):
-            for x1 in range(width):
-                libtcod.map_set_properties(fov, x1, y1, not game_map[x1][y1].block_sight,
-                                           not game_map[x1][y1].blocked)
-
-        # Scan all the objects to see if there are objects that must be navigated around
-        # Check also that the object isn't self or the target (so that the start and the end points are free)
+        # Only paths shorter than MAX_CHASE_STEPS count, so only the tiles that close need to be in the search
+        reach = MAX_CHASE_STEPS
+        x1, y1 = max(self.x - reach, 0), max(self.y - reach, 0)
+        x2, y2 = min(self.x + reach + 1, dungeon_map.width), min(self.y + reach + 1, dungeon_map.height)
+
+        # Mark the tiles of other blocking objects unwalkable for this search, so they must be navigated around
+        # Skip self and the target (so that the start and the end points are free)
         # The AI class handles the situation if self is next to the target so it will not use this A* function anyway
-        for entity in entities:
-            if entity.blocks and entity != self and entity != target:
-                # Set the tile as a wall so it must be navigated around
-                libtcod.map_set_properties(fov, entity.x, entity.y, True, False)
+        walkable = ~dungeon_map.blocked[x1:x2, y1:y2] & (dungeon_map.blockers[x1:x2, y1:y2] == 0)
+        walkable[self.x - x1, self.y - y1] = True
+        if x1 <= target.x < x2 and y1 <= target.y < y2:
+            walkable[target.x - x1, target.y - y1] = True
+        fov = tcod.map.Map(x2 - x1, y2 - y1, order="F")
+        fov.walkable[...] = walkable
 
         # Allocate a A* path
         # The 1.41 is the normal diagonal cost of moving, it can be set as 0.0 if diagonal moves are prohibited
         my_path = libtcod.path_new_using_map(fov, 1.41)
 
         # Compute the path between self's coordinates and the target's coordinates
-        libtcod.path_compute(my_path, self.x, self.y, target.x, target.y)
+        libtcod.path_compute(my_path, self.x - x1, self.y - y1, target.x - x1, target.y - y1)
 
         # Check if the path exists, and in this case, also the path is shorter than 25 tiles
         # The path size matters if you want the monster to use alternative longer paths (for example through other rooms) if for example the player is in a corridor
         # It makes sense to keep path size relatively low to keep the monsters from running around the map if there's an alternative path really far away
+        step = None
         if not libtcod.path_is_empty(my_path) and libtcod.path_size(my_path) < 25:
             # Find the next coordinates in the computed full path
-            x, y = libtcod.path_walk(my_path, True)
-            if x or y:
+            step = libtcod.path_walk(my_path, True)
+
+        # Delete the path to free memory
+        libtcod.path_delete(my_path)
+
+        if step is not None:
+            x, y = step
+            if x is not None:
                 # Set self's coordinates to the next path tile
-                self.x = x
-                self.y = y
+                dungeon_map.move_object(self, x + x1, y + y1)
         else:
             # Keep the old move function as a backup so that if there are no paths (for example another monster blocks a corridor)
             # it will still try to move towards the player (closer to the corridor opening)
-            msgs = self.move_towards(target.x, target.y, dungeon_map)
-
-            # Delete the path to free memory
-        libtcod.path_delete(my_path)
+            msgs = self.move_towards(target.x, target.y, dungeon_map, rng)
         return msgs
 
 
 class Fighter:
     # combat-related properties and methods (monster, player, NPC).
+    __slots__ = ('base_max_hp', 'current_hp', 'base_defense', 'base_power', 'xp', 'death_function', 'owner')
+
     def __init__(self, hp, defense, power, xp, death_function=default_death, owner=None):
+        self.owner = owner
         self.base_max_hp = hp
         self.hp = hp
         self.base_defense = defense
         self.base_power = power
         self.xp = xp
         self.death_function = death_function
-        self.owner = owner
 
     @property
-    def power(self):  # return actual power, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.power_bonus for equipment in self.owner.get_all_equipped())
-        return self.base_power + bonus
+    def hp(self):
+        return self.current_hp
+
+    @hp.setter
+    def hp(self, hp):
+        # a floor keeping an EntityStore has everyone's hp in it as well
+        self.current_hp = hp
+        owner = self.owner
+        if owner is not None and owner.eid is not None:
+            owner.floor.entities.hp[owner.eid] = hp
 
     @property
-    def defense(self):  # return actual defense, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.defense_bonus for equipment in self.owner.get_all_equipped())
-        return self.base_defense + bonus
+    def power(self):  # return actual power, with the bonuses from all equipped items
+        return self.base_power + self.owner.power_bonus
 
     @property
-    def max_hp(self):  # return actual max_hp, by summing up the bonuses from all equipped items
-        bonus = sum(equipment.max_hp_bonus for equipment in self.owner.get_all_equipped())
-        return self.base_max_hp + bonus
+    def defense(self):  # return actual defense, with the bonuses from all equipped items
+        return self.base_defense + self.owner.defense_bonus
+
+    @property
+    def max_hp(self):  # return actual max_hp, with the bonuses from all equipped items
+        return self.base_max_hp + self.owner.max_hp_bonus
 
     def take_damage(self, damage, death_text="died", killer=None):
         # apply damage if possible
         if damage > 0:
             self.hp -= damage
 
-            # check for death. if there's a death function, call it
+            # check for death
             if self.hp <= 0:
+                return self.die(death_text, killer)
+        return []
 
-                if killer is not None and killer.fighter is not None and killer.xp is not None:  # yield experience
-                    killer.fighter.xp += self.xp
-
-                function = self.death_function
-                if function is not None:
-                    msg = function(self.owner, death_text)
-                    self.death_function = None  # you can only die once
-                    if msg:
-                        return [msg]
+    def die(self, death_text="died", killer=None):
+        # out of hp. if there's a death function, call it
+        if killer is not None and killer.fighter is not None and killer.xp is not None:  # yield experience
+            killer.fighter.xp += self.xp
+
+        function = self.death_function
+        if function is not None:
+            msg = function(self.owner, death_text)
+            self.death_function = None  # you can only die once
+            if msg:
+                return [msg]
         return []
 
     def heal(self, amount):
@@ -199,11 +252,11 @@ class Fighter:
         if self.hp > self.max_hp:
             self.hp = self.max_hp
 
-    def attack(self, attacker, target):
+    def attack(self, attacker, target, rng):
         # a simple formula for attack damage
         msgs = []
-        attack = random.randint(0, attacker.fighter.power)
-        defense = random.randint(0, target.fighter.defense)
+        attack = rng.randint(0, attacker.fighter.power)
+        defense = rng.randint(0, target.fighter.defense)
         damage = attack - defense
 
         if damage > 0:
@@ -220,23 +273,27 @@ class Fighter:
 
 
 class BasicMonster:
-    def take_turn(self, target, fov_map, game_map):
+    __slots__ = ('owner',)
+
+    def take_turn(self, target, game_map, rng):
         results = []
 
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if game_map.is_in_fov(monster.x, monster.y):
 
             if monster.distance_to(target) >= 2:
-                results.extend(monster.move_astar(target, game_map))
+                results.extend(monster.move_chase(target, game_map, rng))
 
             elif target.fighter.hp > 0:
-                attack_results = monster.fighter.attack(monster, target)
+                attack_results = monster.fighter.attack(monster, target, rng)
                 results.extend(attack_results)
 
         return results
 
 
 class MT:
+    __slots__ = ('name', 'char', 'color')
+
     def __init__(self, name, char, color):
         self.name = name
         self.char = char
@@ -349,8 +406,8 @@ templates = [MT("orc", 'O', libtcod.dark_green),
              ]
 
 
-def make_enemy(x, y, floor):
-    template = random_choice_index(templates)
+def make_enemy(x, y, floor, rng):
+    template = random_choice_index(templates, rng)
     fighter_component = Fighter(hp=10, defense=0, power=2, xp=35)
     ai_component = BasicMonster()
     enemy = Character(x, y, fighter=fighter_component, *template.to_args(), ai=ai_component)
@@ -371,10 +428,3 @@ def display_test(con, width, height):
     libtcod.console_flush()
     libtcod.console_wait_for_keypress(True)
 
-
-def get_blocking_entities_at_location(entities, destination_x, destination_y):
-    for entity in entities:
-        if entity.blocks and entity.x == destination_x and entity.y == destination_y:
-            return entity
-
-    return None
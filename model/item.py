@@ -5,6 +5,8 @@ from msg import Message
 
 class Item:
     # an item that can be picked up and used.
+    __slots__ = ('use_function', 'owner')
+
     def __init__(self, use_function=None, owner=None):
         self.use_function = use_function
         self.owner = owner
@@ -12,3 +14,45 @@ class Item:
     def heal(self, user, amount=10):
         user.fighter.heal(amount)
         return [Message("You have " + self.owner.name + ", as a treat.", libtcod.green)]
+
+
+class Equipment:
+    # an object that can be equipped, yielding bonuses. automatically adds the Item component.
+    __slots__ = ('power_bonus', 'defense_bonus', 'max_hp_bonus', 'slot', 'is_equipped', 'holder', 'owner')
+
+    def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
+        self.power_bonus = power_bonus
+        self.defense_bonus = defense_bonus
+        self.max_hp_bonus = max_hp_bonus
+
+        self.slot = slot
+        self.is_equipped = False
+        self.holder = None  # the character wearing it
+        self.owner = None
+
+    def toggle_equip(self, holder):  # toggle equip/dequip status
+        if self.is_equipped:
+            return self.dequip()
+        return self.equip(holder)
+
+    def equip(self, holder):
+        # if the slot is already being used, dequip whatever is there first
+        msgs = []
+        old_equipment = holder.get_equipped_in_slot(self.slot)
+        if old_equipment is not None:
+            msgs.extend(old_equipment.dequip())
+
+        # equip object and show a message about it
+        self.is_equipped = True
+        self.holder = holder
+        holder.add_equipped(self)
+        msgs.append(Message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green))
+        return msgs
+
+    def dequip(self):
+        # dequip object and show a message about it
+        if not self.is_equipped: return []
+        self.is_equipped = False
+        self.holder.remove_equipped(self)
+        self.holder = None
+        return [Message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)]
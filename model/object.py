@@ -1,13 +1,15 @@
 from enum import auto, IntEnum
 
-import tcod as libtcod
-
 from model.item import Item
 
 
 class Object:
     # this is a generic object: the player, a monster, an item, the stairs...
     # it's always represented by a character on screen.
+    # slots rather than a __dict__ each, since a floor can hold thousands of them
+    __slots__ = ('name', 'blocks', 'x', 'y', 'char', 'color', 'item', 'always_visible', 'fighter', 'ai', 'floor',
+                 'equipment', 'layer', 'eid')
+
     def __init__(self, x, y, char, name, color, blocks=False, item=None, equipment=None, always_visible=False, fighter=None):
         self.name = name
         self.blocks = blocks
@@ -19,6 +21,8 @@ class Object:
         self.always_visible = always_visible
         self.fighter = fighter
         self.ai = None
+        self.floor = None  # set by the Floor the object is placed on
+        self.eid = None  # its id in the floor's EntityStore, if the floor keeps one
         if self.item:  # let the Item component know who owns it
             self.item.owner = self
 
@@ -29,7 +33,11 @@ class Object:
             # there must be an Item component for the Equipment component to work properly
             self.item = Item()
             self.item.owner = self
-            
+
+        # where it goes in its cell's stack. stored rather than worked out on every lookup, so whatever
+        # changes it (like dying) has to take the object out of the floor's index first and set it again
+        self.layer = self.derive_layer()
+
     def __str__(self):
         return str(self.name)
 
@@ -42,17 +50,7 @@ class Object:
     #         message("Ouch! You blunder into a wall.", libtcod.orange)
     #         player.fighter.take_damage(random.randint(1, 10), "running into a wall")
 
-    def draw(self, con, fov_map):
-        if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-            # set the color and then draw the character that represents this object at its position
-            libtcod.console_set_default_foreground(con, self.color)
-            libtcod.console_put_char(con, self.x, self.y, self.char, libtcod.BKGND_NONE)
-
-    def clear(self, con):
-        # erase the character that represents this object
-        libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
-
-    def layer(self):
+    def derive_layer(self):
         if self.fighter:
             return Layer.CHARACTER
         if self.item:
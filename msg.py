@@ -1,3 +1,7 @@
+import textwrap
+from collections import deque
+
+
 class Message:
     def __init__(self, text, color):
         self.text = text
@@ -5,3 +9,51 @@ class Message:
 
     def as_args(self):
         return self.text, self.color
+
+
+MESSAGE_HISTORY = 2000  # messages kept for the scrollback, older ones fall off the end
+
+
+class MessageLog:
+    # the messages of a run, newest last. a ring buffer of raw messages: the same message twice in a row is
+    # counted instead of stored again, and each message is only wrapped once per width it is shown at
+    def __init__(self, capacity=MESSAGE_HISTORY):
+        self.entries = deque(maxlen=capacity)  # [text, color, count, {width: wrapped lines}]
+        self.version = 0  # goes up with every message, so renderers know to repaint
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, text, color):
+        self.version += 1
+        if self.entries:
+            last = self.entries[-1]
+            if last[0] == text and last[1] == color:
+                last[2] += 1
+                last[3] = {}
+                return
+        self.entries.append([text, color, 1, {}])
+
+    def wrapped(self, entry, width):
+        lines = entry[3].get(width)
+        if lines is None:
+            text, color, count = entry[0], entry[1], entry[2]
+            if count > 1:
+                text += ' x' + str(count)
+            lines = entry[3][width] = [(line, color) for line in textwrap.wrap(text, width)]
+        return lines
+
+    def lines(self, width, height, offset=0):
+        # the last height lines at this width, skipping the offset newest ones. only wraps what it shows
+        picked = []
+        wanted = height + offset
+        for entry in reversed(self.entries):
+            picked.extend(reversed(self.wrapped(entry, width)))
+            if len(picked) >= wanted:
+                break
+        picked = picked[offset:wanted]
+        picked.reverse()
+        return picked
+
+    def line_count(self, width):
+        return sum(len(self.wrapped(entry, width)) for entry in self.entries)
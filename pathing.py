@@ -0,0 +1,63 @@
+import numpy as np
+import tcod.path
+
+# monsters only chase along paths shorter than this many steps, otherwise they just head straight for the target
+MAX_CHASE_STEPS = 25
+
+# neighbouring tiles, cardinal directions first so that ties prefer straight moves
+NEIGHBOURS = ((0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1))
+
+UNREACHABLE = np.iinfo(np.int32).max
+
+
+class ChaseField:
+    # a Dijkstra map of steps to the thing being chased, shared by every monster on the floor.
+    # it only covers the tiles a path shorter than MAX_CHASE_STEPS could pass through
+    def __init__(self, floor):
+        self.floor = floor
+        self.distance = None
+        self.origin = (0, 0)  # floor coordinates of distance[0, 0]
+        self.target = None  # where the target stood when the field was computed
+        self.stale = True
+
+    def invalidate(self):
+        # call once per turn, before the monsters act
+        self.stale = True
+
+    def update(self, target):
+        if not self.stale and self.target == (target.x, target.y):
+            return
+        floor = self.floor
+        reach = MAX_CHASE_STEPS
+        x1 = max(target.x - reach, 0)
+        y1 = max(target.y - reach, 0)
+        x2 = min(target.x + reach + 1, floor.width)
+        y2 = min(target.y + reach + 1, floor.height)
+
+        # walls and blocking objects (as they stand at the start of the turn) can't be walked through
+        cost = ~floor.blocked[x1:x2, y1:y2] & (floor.blockers[x1:x2, y1:y2] == 0)
+        distance = np.full(cost.shape, UNREACHABLE, dtype=np.int32)
+        distance[target.x - x1, target.y - y1] = 0
+        tcod.path.dijkstra2d(distance, cost.view(np.int8), 1, 1, out=distance)
+
+        self.distance = distance
+        self.origin = (x1, y1)
+        self.target = (target.x, target.y)
+        self.stale = False
+
+    def step_from(self, x, y):
+        # the free neighbouring tile on the shortest path to the target, or None if there's no short enough path
+        ox, oy = self.origin
+        width, height = self.distance.shape
+        best = None
+        best_distance = MAX_CHASE_STEPS - 1  # taking the step is one more move on top of the neighbour's distance
+        for dx, dy in NEIGHBOURS:
+            nx = x + dx - ox
+            ny = y + dy - oy
+            if 0 <= nx < width and 0 <= ny < height:
+                d = self.distance[nx, ny]
+                # monsters that already moved this turn may be standing in the way
+                if d < best_distance and not self.floor.is_blocked(x + dx, y + dy):
+                    best = (x + dx, y + dy)
+                    best_distance = d
+        return best
@@ -0,0 +1,44 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from map import make_map
+
+
+class FloorPregen:
+    # builds the next floor in a worker thread while the player is still on the current one, so going down
+    # the stairs only has to swap it in. floors don't depend on anything that happens during play (see rng.py),
+    # so a floor built early is the same one that would have been built on the spot
+    def __init__(self, width, height, seed, storage_for=None):
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.storage_for = storage_for  # dungeon level -> where that floor keeps its layers, if not the default
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pregen')
+        self.pending = {}  # dungeon level -> future of its floor
+
+    def request(self, dlevel):
+        # start building a floor, if it isn't already on its way
+        if dlevel not in self.pending:
+            self.pending[dlevel] = self.executor.submit(self.build, dlevel)
+
+    def take(self, dlevel):
+        # returns the floor and how many seconds the caller had to wait for it
+        start = time.perf_counter()
+        future = self.pending.pop(dlevel, None)
+        if future is None or future.cancel():
+            # never asked for, or the worker hasn't got to it yet: quicker to build it right here
+            floor = self.build(dlevel)
+        else:
+            # already being built (or done), finishing it beats starting over
+            floor = future.result()
+        return floor, time.perf_counter() - start
+
+    def build(self, dlevel):
+        storage = self.storage_for(dlevel) if self.storage_for else None
+        return make_map(self.width, self.height, None, dlevel, self.seed, storage)
+
+    def close(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,22 @@
+import hashlib
+import random
+
+# the independent random streams of a run
+LAYOUT = 'layout'  # walls, rooms, corridors, stairs
+SPAWNS = 'spawns'  # which monsters and items appear where
+COMBAT = 'combat'  # attack rolls, damage and other mishaps during play
+
+
+class RunSeed:
+    # the seed of a run. each subsystem draws from its own stream derived from it, so one of them using
+    # more or fewer numbers never changes what the others get, and floor N of a seed always comes out the same
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(63)
+        self.seed = seed
+
+    def stream(self, name, *keys):
+        # e.g. stream(LAYOUT, dungeon_level)
+        text = ':'.join(str(part) for part in (self.seed, name) + keys)
+        digest = hashlib.sha256(text.encode('utf-8')).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
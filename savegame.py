@@ -0,0 +1,351 @@
+import json
+import mmap
+import os
+import struct
+import traceback
+
+import numpy as np
+import tcod as libtcod
+
+from map import Floor, Rect
+from model.character import Character, Fighter, BasicMonster, default_death
+from model.item import Item, Equipment
+from model.object import Object
+from storage import NO_STAMP
+
+# save files: a header, a table of sections, then the sections. one META section with the session as JSON,
+# and one FLOR section per floor with its tile layers as raw arrays and its objects as packed records
+MAGIC = b'7DRLSAVE'
+VERSION = 3
+HEADER = struct.Struct('<8sHI')  # magic, version, number of sections
+SECTION = struct.Struct('<4siQQ')  # tag, key, offset, length
+META = b'META'
+FLOOR = b'FLOR'
+
+# floor sections: a header, the rooms, the tile layers, the objects, then the strings they refer to
+# size, dlevel, start, scheduler time and counter, counts, then the stamp of the tiles in the floor's tile file
+FLOOR_HEADER = struct.Struct('<iiiiiqqiii32s')
+FLOOR_HEADER_2 = struct.Struct('<iiiiiqqiii')  # before version 3, without the stamp
+ROOM_DTYPE = np.dtype('<i4')  # x1, y1, x2, y2 per room
+LAYERS = ('blocked', 'block_sight', 'explored')
+
+# object kinds
+KIND_OBJECT = 0
+KIND_CHARACTER = 1  # anything that still has a fighter. corpses are plain objects
+
+# object flags
+BLOCKS = 1
+ALWAYS_VISIBLE = 2
+PLAYER = 4
+EQUIPPED = 8
+AI = 16
+
+# item use functions
+USE_NONE = 0
+USE_HEAL = 1
+
+# fighter death functions
+DEATH_NONE = 0
+DEATH_DEFAULT = 1
+DEATH_PLAYER = 2
+
+NO_ITEM = -1
+NOWHERE = -1  # container of an object lying on the floor, slot of an object that isn't equipment
+
+ENTITY_DTYPE = np.dtype([('kind', 'u1'), ('flags', 'u1'), ('item', 'i1'), ('death', 'i1'),
+                         ('x', '<i4'), ('y', '<i4'), ('char', '<u4'),
+                         ('r', 'u1'), ('g', 'u1'), ('b', 'u1'),
+                         ('name', '<i4'), ('container', '<i4'), ('queued', '<i4'), ('when', '<i8'),
+                         ('hp', '<i4'), ('max_hp', '<i4'), ('defense', '<i4'), ('power', '<i4'), ('xp', '<i4'),
+                         ('level', '<i4'), ('speed', '<i4'),
+                         ('slot', '<i4'), ('power_bonus', '<i4'), ('defense_bonus', '<i4'),
+                         ('max_hp_bonus', '<i4')])
+
+def messages_with_counts(meta, sections):
+    # 1 -> 2: the message log went from wrapped lines to whole messages with a repeat count
+    meta['messages'] = [(line, color, 1) for line, color in meta['messages']]
+    return meta, sections
+
+
+def tile_stamps(meta, sections):
+    # 2 -> 3: floor headers got the stamp of their tile file. older floors have none, so never reuse one
+    for key, data in sections.items():
+        if key[0] == FLOOR:
+            sections[key] = b''.join((data[:FLOOR_HEADER_2.size], NO_STAMP, data[FLOOR_HEADER_2.size:]))
+    return meta, sections
+
+
+# older versions of the format, upgraded one step at a time when loaded: version -> function(meta, sections)
+# returning the meta and sections of the next version
+MIGRATIONS = {
+    1: messages_with_counts,
+    2: tile_stamps,
+}
+
+
+class SaveError(Exception):
+    pass
+
+
+# what reading a cut short or garbled save file runs into, turned into a SaveError by load_session
+DAMAGED = (struct.error, ValueError, KeyError, IndexError)
+
+
+def color_of(color):
+    return libtcod.Color(*color)
+
+
+# floors
+def encode_floor(floor, player_death=None):
+    strings = []
+    string_ids = {}
+
+    def string_id(text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+
+    entities = []
+    ids = {}
+    queue = sorted(floor.scheduler.entries.values())
+    queued = {entry[2]: i for i, entry in enumerate(queue)}
+
+    def add(o, container):
+        ids[o] = len(entities)
+        entities.append(None)
+        flags = 0
+        if o.blocks:
+            flags |= BLOCKS
+        if o.always_visible:
+            flags |= ALWAYS_VISIBLE
+        kind = KIND_OBJECT
+        hp = max_hp = defense = power = xp = level = speed = 0
+        death = DEATH_NONE
+        if o.fighter:
+            kind = KIND_CHARACTER
+            fighter = o.fighter
+            hp, max_hp, defense, power, xp = (fighter.hp, fighter.base_max_hp, fighter.base_defense,
+                                              fighter.base_power, fighter.xp)
+            level = o.level
+            speed = o.speed
+            if o.player:
+                flags |= PLAYER
+            if o.ai:
+                flags |= AI
+            if fighter.death_function is default_death:
+                death = DEATH_DEFAULT
+            elif fighter.death_function is not None and fighter.death_function == player_death:
+                death = DEATH_PLAYER
+            elif fighter.death_function is not None:
+                raise SaveError("can't save the death function of " + o.name)
+        item = NO_ITEM
+        if o.item:
+            item = USE_NONE
+            if o.item.use_function is not None:
+                if o.item.use_function != o.item.heal:
+                    raise SaveError("can't save the use function of " + o.name)
+                item = USE_HEAL
+        slot = NOWHERE
+        bonuses = (0, 0, 0)
+        if o.equipment:
+            slot = string_id(o.equipment.slot)
+            bonuses = (o.equipment.power_bonus, o.equipment.defense_bonus, o.equipment.max_hp_bonus)
+            if o.equipment.is_equipped:
+                flags |= EQUIPPED
+        when = queue[queued[o]][0] if o in queued else 0
+        entities[ids[o]] = (kind, flags, item, death, o.x, o.y, ord(o.char), o.color[0], o.color[1], o.color[2],
+                            string_id(o.name), container, queued.get(o, NOWHERE), when,
+                            hp, max_hp, defense, power, xp, level, speed, slot) + bonuses
+        if kind == KIND_CHARACTER:
+            for held in o.inventory:
+                add(held, ids[o])
+
+    for o in floor.objects:
+        add(o, NOWHERE)
+
+    rooms = np.array([(r.x1, r.y1, r.x2, r.y2) for r in floor.rooms], dtype=ROOM_DTYPE).reshape(-1, 4)
+    layers = np.stack([getattr(floor, name) for name in LAYERS]).astype(np.uint8)
+    text = '\0'.join(strings).encode('utf-8')
+    start = floor.start or (-1, -1)
+    header = FLOOR_HEADER.pack(floor.width, floor.height, floor.dungeon_level, start[0], start[1],
+                               floor.scheduler.time, floor.scheduler.counter, len(rooms), len(entities), len(text),
+                               floor.storage.seal())
+    return b''.join((header, rooms.tobytes(), layers.tobytes(),
+                     np.array(entities, dtype=ENTITY_DTYPE).tobytes(), text))
+
+
+def decode_floor(data, player_death=None, inventory=None, storage=None):
+    # data can be any buffer, e.g. part of a memory mapped save file. player_death and inventory are given to
+    # the player, if they're on this floor. a storage that kept the floor's tiles from when it was saved is left
+    # alone
+    (width, height, dlevel, start_x, start_y, time, counter, room_count, entity_count,
+     text_length, stamp) = FLOOR_HEADER.unpack_from(data, 0)
+    offset = FLOOR_HEADER.size
+    rooms = np.frombuffer(data, dtype=ROOM_DTYPE, count=room_count * 4, offset=offset).reshape(-1, 4)
+    offset += rooms.nbytes
+    layers = np.frombuffer(data, dtype=np.uint8, count=len(LAYERS) * width * height, offset=offset)
+    layers = layers.reshape(len(LAYERS), width, height)
+    offset += layers.nbytes
+    entities = np.frombuffer(data, dtype=ENTITY_DTYPE, count=entity_count, offset=offset)
+    offset += entities.nbytes
+    strings = bytes(data[offset:offset + text_length]).decode('utf-8').split('\0')
+
+    if storage is not None:
+        storage.expect(stamp)
+    floor = Floor(width, height, [], [Rect(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in rooms.tolist()], dlevel,
+                  storage)
+    if not floor.storage.reused:
+        for name, layer in zip(LAYERS, layers):
+            getattr(floor, name)[...] = layer
+    if start_x >= 0:
+        floor.start = (start_x, start_y)
+
+    objects = []
+    queue = []
+    for (kind, flags, item, death, x, y, char, r, g, b, name, container, queued, when,
+         hp, max_hp, defense, power, xp, level, speed, slot, power_bonus, defense_bonus,
+         max_hp_bonus) in entities.tolist():
+        equipment = None
+        if slot != NOWHERE:
+            equipment = Equipment(strings[slot], power_bonus, defense_bonus, max_hp_bonus)
+        color = color_of((r, g, b))
+        if kind == KIND_CHARACTER:
+            death_function = {DEATH_NONE: None, DEATH_DEFAULT: default_death, DEATH_PLAYER: player_death}[death]
+            fighter = Fighter(hp=max_hp, defense=defense, power=power, xp=xp, death_function=death_function)
+            fighter.hp = hp
+            player = bool(flags & PLAYER)
+            o = Character(x, y, chr(char), strings[name], color, fighter, ai=BasicMonster() if flags & AI else None,
+                          inventory=inventory if player and inventory is not None else [], player=player,
+                          speed=speed)
+            o.level = level
+        else:
+            # the item component goes in up front, since it decides the object's layer
+            o = Object(x, y, chr(char), strings[name], color, blocks=bool(flags & BLOCKS),
+                       item=Item() if item != NO_ITEM and equipment is None else None, equipment=equipment,
+                       always_visible=bool(flags & ALWAYS_VISIBLE))
+        o.blocks = bool(flags & BLOCKS)
+        o.always_visible = bool(flags & ALWAYS_VISIBLE)
+        if item == USE_HEAL:
+            o.item.use_function = o.item.heal
+        objects.append(o)
+        if container == NOWHERE:
+            floor.add_object(o)
+        else:
+            holder = objects[container]
+            holder.inventory.append(o)
+            if flags & EQUIPPED:
+                equipment.is_equipped = True
+                equipment.holder = holder
+                holder.add_equipped(equipment)
+        if queued != NOWHERE:
+            queue.append((queued, when, o))
+
+    # back onto the scheduler in the order they were queued, so ties still go the same way
+    for queued, when, o in sorted(queue, key=lambda entry: entry[0]):
+        floor.scheduler.push(o, when)
+    floor.scheduler.time = time
+    floor.scheduler.counter = max(counter, floor.scheduler.counter)
+    return floor
+
+
+# sessions
+def save_session(session, path):
+    # written next to the old save then renamed over it, so a crash never leaves half a save behind
+    floors = [(session.floor.dungeon_level, encode_floor(session.floor, session.player_death))]
+    cached = []
+    for dlevel, data in session.floors.encoded():
+        floors.append((dlevel, data))
+        cached.append(dlevel)
+    meta = {'seed': session.seed.seed,
+            'combat_rng': session.combat_rng.getstate(),
+            'score': session.game.score,
+            'time': session.game.time,
+            'discovered': session.game.discovered,
+            'game_state': session.game_state,
+            'deepest': session.deepest,
+            'messages': [(text, list(color), count) for text, color, count, wrapped in session.messages.entries],
+            'floor': session.floor.dungeon_level,
+            'cached': cached}
+    sections = [(META, 0, json.dumps(meta).encode('utf-8'))] + [(FLOOR, dlevel, data) for dlevel, data in floors]
+
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for tag, key, data in sections:
+        table.append(SECTION.pack(tag, key, offset, len(data)))
+        offset += len(data)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+        f.write(b''.join(table))
+        for tag, key, data in sections:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def read_sections(view):
+    magic, version, count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise SaveError("not a save file")
+    if version > VERSION:
+        raise SaveError("save file is from a newer version of the game")
+    sections = {}
+    for i in range(count):
+        tag, key, offset, length = SECTION.unpack_from(view, HEADER.size + i * SECTION.size)
+        if offset + length > len(view):
+            raise SaveError("save file is cut short")
+        sections[(tag, key)] = view[offset:offset + length]
+    meta = json.loads(bytes(sections.pop((META, 0))).decode('utf-8'))
+    while version < VERSION:
+        meta, sections = MIGRATIONS[version](meta, sections)
+        version += 1
+    return meta, sections
+
+
+def load_session(session, path):
+    # fill in a GameSession that was made without a run of its own. a save file that can't be read raises
+    # SaveError
+    if os.path.getsize(path) < HEADER.size:
+        raise SaveError("not a save file")
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            floor = read_session(session, view)
+        except Exception as e:
+            # the frames the error went through can still hold slices of the view, and the map can't be
+            # closed while they do. let go of them, so the error is the one that gets seen, not a BufferError
+            traceback.clear_frames(e.__traceback__)
+            if isinstance(e, DAMAGED):
+                raise SaveError("save file is damaged (%s)" % e) from e
+            raise
+        finally:
+            view.release()
+    session.player = next((o for o in floor.objects if getattr(o, 'player', False)), None)
+    if session.player is None:
+        raise SaveError("save file has no player in it")
+    session.enter_floor(floor)
+
+
+def read_session(session, view):
+    # the session's state and its floors from the file, returning the floor the player is on
+    meta, sections = read_sections(view)
+    session.seed.seed = meta['seed']
+    session.game.score = meta['score']
+    session.game.time = meta['time']
+    session.game.discovered = meta['discovered']
+    session.game_state = meta['game_state']
+    session.deepest = meta['deepest']
+    for text, color, count in meta['messages']:
+        session.messages.add(text, color_of(color))
+        session.messages.entries[-1][2] = count
+    version, state, gauss = meta['combat_rng']
+    session.combat_rng.setstate((version, tuple(state), gauss))
+
+    floor = decode_floor(sections[(FLOOR, meta['floor'])], session.player_death, session.inventory,
+                         session.tile_storage(meta['floor'], reuse=True))
+    for dlevel in meta['cached']:
+        session.floors.put(decode_floor(sections[(FLOOR, dlevel)],
+                                        storage=session.tile_storage(dlevel, reuse=True)))
+    return floor
@@ -0,0 +1,53 @@
+import heapq
+
+# time one action takes at normal speed. an actor with twice the speed acts twice as often
+ACTION_COST = 100
+NORMAL_SPEED = 100
+
+
+def action_delay(actor):
+    return max(1, ACTION_COST * NORMAL_SPEED // actor.speed)
+
+
+class Scheduler:
+    # the actors of a floor that are awake, queued by the time of their next action.
+    # dormant monsters stay off the queue until something wakes them
+    def __init__(self):
+        self.time = 0
+        self.queue = []
+        self.entries = {}  # actor -> its live entry in the queue
+        self.counter = 0  # keeps actors due at the same time in the order they were queued
+
+    def __contains__(self, actor):
+        return actor in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, actor, delay=0):
+        self.push(actor, self.time + delay)
+
+    def push(self, actor, when):
+        self.remove(actor)
+        entry = [when, self.counter, actor]
+        self.counter += 1
+        self.entries[actor] = entry
+        heapq.heappush(self.queue, entry)
+
+    def remove(self, actor):
+        entry = self.entries.pop(actor, None)
+        if entry is not None:
+            # left in the heap and skipped when it comes up
+            entry[2] = None
+
+    def advance(self, duration):
+        # move the clock on and yield every actor whose turn comes up before it, in order
+        self.time += duration
+        while self.queue and self.queue[0][0] < self.time:
+            when, _, actor = heapq.heappop(self.queue)
+            if actor is None:
+                continue
+            del self.entries[actor]
+            # queue the next action before this one happens, so an actor removed during its turn stays removed
+            self.push(actor, when + action_delay(actor))
+            yield actor
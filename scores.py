@@ -0,0 +1,293 @@
+import dbm
+import io
+import os
+import pickle
+import re
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# high scores: one small fixed-size record per death, appended to a data file, plus an index file that
+# keeps the record numbers in rank order
+MAGIC = b'7DRLSCR1'
+INDEX_MAGIC = b'7DRLIDX1'
+NAME_BYTES = 32
+EPITAPH_BYTES = 96
+
+RECORD_DTYPE = np.dtype([('score', '<i8'),
+                         ('level', '<i4'),
+                         ('dlevel', '<i4'),
+                         ('time', '<f8'),
+                         ('name', 'S%d' % NAME_BYTES),
+                         ('epitaph', 'S%d' % EPITAPH_BYTES)])
+
+ScoreRecord = namedtuple('ScoreRecord', 'score level dlevel name epitaph time')
+
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def encode(text, size):
+    # utf-8, cut down to size without splitting a character
+    return text.encode('utf-8')[:size].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def words(text):
+    return set(WORD.findall(text.lower()))
+
+
+def group(keys, key_of=None):
+    # key -> array of the record numbers that have it, in record order. records mostly share the same few
+    # names and epitaphs, so key_of only gets called once for each different raw value
+    raw = {}
+    for recno, value in enumerate(keys.tolist()):
+        raw.setdefault(value, []).append(recno)
+    if key_of is None:
+        return {value: np.array(recnos, dtype=np.intp) for value, recnos in raw.items()}
+    index = {}
+    for value, recnos in raw.items():
+        for key in key_of(value):
+            index.setdefault(key, []).append(recnos)
+    return {key: np.sort(np.concatenate(parts)) for key, parts in index.items()}
+
+
+def name_key(value):
+    return [value.decode('utf-8').lower()]
+
+
+def epitaph_keys(value):
+    return words(value.decode('utf-8'))
+
+
+def record_from_session(session):
+    # dlevel is the deepest level the player got to, not the one they died on: they can go back up
+    player = session.player
+    return ScoreRecord(session.game.score, player.level, session.deepest, player.name, player.death.epitath,
+                       time.time())
+
+
+class ScoreStore:
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.order = None  # record numbers, best first. read from the index file when first needed
+        self.records = None  # the data file, mapped read-only
+        self.rank = None  # record number -> its place in order
+        # secondary indexes, built the first time a query filters on them
+        self.by_name = None  # lower case name -> record numbers
+        self.by_dlevel = None  # dungeon level -> record numbers
+        self.by_word = None  # word of the epitaph -> record numbers
+
+    def count(self):
+        if not os.path.exists(self.path):
+            return 0
+        return max(0, os.path.getsize(self.path) - len(MAGIC)) // RECORD_DTYPE.itemsize
+
+    def rank_key(self, recno):
+        # highest score first, then character level, then depth, then whoever got there first
+        r = self.records[recno]
+        return -int(r['score']), -int(r['level']), -int(r['dlevel']), recno
+
+    def add(self, record):
+        # append one record. if the ranking is loaded, slot it in: a binary search finds the place in O(log n)
+        # comparisons, but the list insert still moves every record number after it along, so O(n) in all
+        row = np.zeros(1, dtype=RECORD_DTYPE)
+        row['score'] = record.score
+        row['level'] = record.level
+        row['dlevel'] = record.dlevel
+        row['time'] = record.time
+        row['name'] = encode(record.name, NAME_BYTES)
+        row['epitaph'] = encode(record.epitaph, EPITAPH_BYTES)
+        recno = self.count()
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(MAGIC)
+            # drop whatever is left of a record a crash cut short
+            f.truncate(len(MAGIC) + recno * RECORD_DTYPE.itemsize)
+            f.write(row.tobytes())
+        if self.order is not None:
+            self.map_records()
+            self.insert(recno)
+            self.rank = None
+            self.index_record(recno, record)
+        return recno
+
+    def index_record(self, recno, record):
+        # keep the secondary indexes that have been built up to date
+        keys = []
+        if self.by_name is not None:
+            keys.append((self.by_name, name_key(encode(record.name, NAME_BYTES))[0]))
+        if self.by_dlevel is not None:
+            keys.append((self.by_dlevel, record.dlevel))
+        if self.by_word is not None:
+            for word in epitaph_keys(encode(record.epitaph, EPITAPH_BYTES)):
+                keys.append((self.by_word, word))
+        for index, key in keys:
+            index[key] = np.append(index.get(key, np.zeros(0, dtype=np.intp)), recno)
+
+    def map_records(self):
+        count = self.count()
+        if count == 0:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        else:
+            self.records = np.memmap(self.path, dtype=RECORD_DTYPE, mode='r', offset=len(MAGIC), shape=(count,))
+
+    def insert(self, recno):
+        # O(n): a single memmove of the list, about 180us at a million records
+        key = self.rank_key(recno)
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.rank_key(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        self.order.insert(lo, recno)
+
+    def load(self):
+        # read the ranking, catching it up with any records added since it was last saved
+        self.map_records()
+        count = len(self.records)
+        order = self.read_index()
+        if order is None or len(order) > count:
+            self.rebuild()
+        else:
+            self.order = order
+            if len(order) < count:
+                for recno in range(len(order), count):
+                    self.insert(recno)
+                self.save_index()
+
+    def read_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            return np.fromfile(f, dtype='<i4').tolist()
+
+    def rebuild(self):
+        r = self.records
+        recnos = np.arange(len(r))
+        self.order = np.lexsort((recnos, -r['dlevel'], -r['level'], -r['score'])).tolist()
+        self.save_index()
+
+    def save_index(self):
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(INDEX_MAGIC)
+            np.asarray(self.order, dtype='<i4').tofile(f)
+        os.replace(temp_path, self.index_path)
+
+    def record(self, recno):
+        r = self.records[recno]
+        return ScoreRecord(int(r['score']), int(r['level']), int(r['dlevel']), r['name'].decode('utf-8'),
+                           r['epitaph'].decode('utf-8'), float(r['time']))
+
+    def top(self, limit, offset=0):
+        # the records ranked offset+1 to offset+limit
+        return self.query(limit, offset)[0]
+
+    def query(self, limit, offset=0, name=None, dlevel=None, epitaph=None):
+        # one page of the ranking, only counting records that match every filter given. an epitaph matches
+        # when it has all the words of the epitaph filter, which has to have some.
+        # returns the records and how many match in total
+        if self.order is None:
+            self.load()
+        matches = None
+        if name is not None:
+            if self.by_name is None:
+                self.by_name = group(self.records['name'], name_key)
+            # stored names are cut to NAME_BYTES, so a long name has to be cut the same way to find them
+            matches = self.narrow(matches, self.by_name.get(name_key(encode(name, NAME_BYTES))[0]))
+        if dlevel is not None:
+            if self.by_dlevel is None:
+                self.by_dlevel = group(self.records['dlevel'])
+            matches = self.narrow(matches, self.by_dlevel.get(dlevel))
+        if epitaph is not None:
+            if not words(epitaph):
+                raise ValueError("no words to look for in epitaph %r" % epitaph)
+            if self.by_word is None:
+                self.by_word = group(self.records['epitaph'], epitaph_keys)
+            for word in words(epitaph):
+                matches = self.narrow(matches, self.by_word.get(word))
+        if matches is None:
+            return [self.record(recno) for recno in self.order[offset:offset + limit]], len(self.order)
+        if self.rank is None:
+            self.rank = np.empty(len(self.order), dtype=np.intp)
+            self.rank[np.asarray(self.order, dtype=np.intp)] = np.arange(len(self.order))
+        # only the matches get sorted, never the whole ranking
+        ranked = matches[np.argsort(self.rank[matches], kind='stable')]
+        return [self.record(recno) for recno in ranked[offset:offset + limit]], len(ranked)
+
+    @staticmethod
+    def narrow(matches, recnos):
+        if recnos is None:
+            return np.zeros(0, dtype=np.intp)
+        if matches is None:
+            return recnos
+        return np.intersect1d(matches, recnos, assume_unique=True)
+
+
+# scores.json, the shelve scores were kept in before: a list of whole pickled player Characters, best first.
+# their classes have changed since (and GameState was pickled from __main__), so the game's own classes are
+# read back as LegacyObjects that just keep whatever attributes they were saved with
+LEGACY_KEY = b'score'
+GAME_MODULES = ('__main__', 'gid', 'map', 'model', 'msg', 'util')
+
+
+class LegacyObject:
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):  # (__dict__, __slots__ values)
+            state = {name: value for part in state if part for name, value in part.items()}
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+
+
+def legacy_getattr(o, name, *default):
+    # bound methods are pickled as getattr(owner, name), and a LegacyObject has no methods
+    return getattr(o, name, None)
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module.split('.')[0] in GAME_MODULES:
+            return LegacyObject
+        if (module, name) == ('builtins', 'getattr'):
+            return legacy_getattr
+        return super().find_class(module, name)
+
+
+def legacy_record(player):
+    # the old entries have no time of death
+    death = player.death
+    return ScoreRecord(int(death.game.score), int(player.level), int(death.floor.dungeon_level), str(player.name),
+                       str(death.epitath), 0.0)
+
+
+def import_shelf(store, path):
+    # add the scores of an old scores.json shelve to store, keeping their order. returns how many came over.
+    # a shelve that can't be read is left as it is
+    if not dbm.whichdb(path):
+        return 0
+    try:
+        with dbm.open(path, 'r') as db:
+            players = LegacyUnpickler(io.BytesIO(db[LEGACY_KEY])).load() if LEGACY_KEY in db else []
+    except Exception:
+        # anything can come out of unpickling a file written by an older game
+        return 0
+    count = 0
+    for player in players:
+        try:
+            record = legacy_record(player)
+        except (AttributeError, TypeError, ValueError):
+            continue
+        store.add(record)
+        count += 1
+    return count
@@ -0,0 +1,275 @@
+import os
+import struct
+
+import numpy as np
+
+# where a floor keeps its per-cell layers. tile_layer() makes the layers of the map itself (walls, what's been
+# explored), layer() the ones worked out from the floor's objects (glyphs, blockers), which get rebuilt with
+# them. small floors use plain arrays; big ones keep them in chunks that only get allocated once something is
+# carved, explored or put there. a MemmapStorage keeps the tile layers in a file instead
+CHUNK_BITS = 6
+CHUNK_SIZE = 1 << CHUNK_BITS  # cells along each side of a chunk
+CHUNKED_AREA = 256 * 256  # floors bigger than this are chunked by default
+
+# tile files: a header, then the tile layers one after the other, in the order the floor makes them
+TILE_MAGIC = b'7DRLTILE'
+TILE_HEADER = struct.Struct('<8s32sii')  # magic, stamp of the tiles, width, height
+NO_STAMP = bytes(32)  # what floors whose tiles aren't in a file of their own are saved with
+
+
+def new_stamp():
+    return os.urandom(16).hex().encode('ascii')
+
+
+class DenseStorage:
+    reused = False  # never has tiles from before
+
+    def layer(self, name, shape, dtype, fill):
+        return np.full(shape, fill, dtype=dtype)
+
+    tile_layer = layer
+
+    # the tiles are only ever in the save itself, see MemmapStorage for the rest
+    def expect(self, stamp):
+        pass
+
+    def seal(self):
+        return NO_STAMP
+
+    def touch(self):
+        pass
+
+    def staging(self):
+        # where to generate a floor that's going to end up here (see map.make_map)
+        return self
+
+    def flush(self):
+        pass
+
+
+class ChunkedStorage:
+    reused = False
+
+    def __init__(self, dense_tiles=False):
+        # dense_tiles keeps the tile layers in plain arrays, for generating a floor in (see staging())
+        self.dense_tiles = dense_tiles
+
+    def layer(self, name, shape, dtype, fill):
+        return ChunkedLayer(shape, dtype, fill)
+
+    def tile_layer(self, name, shape, dtype, fill):
+        if self.dense_tiles:
+            return np.full(shape, fill, dtype=dtype)
+        return ChunkedLayer(shape, dtype, fill)
+
+    def expect(self, stamp):
+        pass
+
+    def seal(self):
+        return NO_STAMP
+
+    def touch(self):
+        pass
+
+    def staging(self):
+        # carving chunk by chunk is slow, so the tiles are carved in plain arrays and chunked once the floor is
+        # done. the layers worked out from the objects only ever get written a cell at a time, so they go
+        # into chunks straight away
+        return ChunkedStorage(dense_tiles=True)
+
+    def flush(self):
+        pass
+
+
+class MemmapStorage:
+    # the tile layers of one floor in a file of their own, mapped into memory: the OS only reads in the parts
+    # that get used and writes changes back by itself, so they take next to no memory while the floor isn't
+    # being played. the file's stamp is a random token that tells one state of the tiles from another: seal()
+    # gives the stamp of the tiles as they are when the floor is saved, and the first change after that
+    # (see touch()) stamps the file anew. with reuse, a file that still has the stamp the floor was saved with
+    # (see expect()) is mapped as it was left, tiles and all, and reused is set so nobody writes them over again
+    def __init__(self, path, reuse=False):
+        self.path = path
+        self.reuse = reuse
+        self.reused = False
+        self.expected = None  # stamp a file has to have to be reused
+        self.stamp = None
+        self.sealed = False  # whether the tiles are still the ones the stamp was given out for
+        self.shape = None
+        self.offset = None  # where the next tile layer goes, once the file is open
+        self.memory = None  # for the layers that aren't tiles
+        self.tiles = []
+
+    def expect(self, stamp):
+        # the floor coming back is the one saved with stamp. call before the floor makes its layers
+        self.expected = stamp
+
+    def open(self, width, height):
+        self.shape = (width, height)
+        if self.reuse and self.expected not in (None, NO_STAMP) and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.reused = f.read(TILE_HEADER.size) == TILE_HEADER.pack(TILE_MAGIC, self.expected, width, height)
+        if self.reused:
+            self.stamp = self.expected
+            self.sealed = True
+        else:
+            self.stamp = new_stamp()
+            with open(self.path, 'wb') as f:
+                f.write(TILE_HEADER.pack(TILE_MAGIC, self.stamp, width, height))
+        self.offset = TILE_HEADER.size
+
+    def tile_layer(self, name, shape, dtype, fill):
+        if self.offset is None:
+            self.open(shape[0], shape[1])
+        dtype = np.dtype(dtype)
+        offset = self.offset
+        self.offset += int(np.prod(shape)) * dtype.itemsize
+        # a layer the file doesn't have yet (a new file, or one from before the layer existed) starts as fill
+        fresh = os.path.getsize(self.path) < self.offset
+        if fresh:
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.offset)
+        tiles = np.memmap(self.path, dtype=dtype, mode='r+', offset=offset, shape=shape)
+        if fresh and fill:
+            tiles[...] = fill
+        self.tiles.append(tiles)
+        return tiles
+
+    def layer(self, name, shape, dtype, fill):
+        if self.memory is None:
+            self.memory = default_storage(shape[0], shape[1])
+        return self.memory.layer(name, shape, dtype, fill)
+
+    def staging(self):
+        # the tiles are plain arrays already, just on disk
+        return self
+
+    def flush(self):
+        # get the tiles onto the disk now
+        for tiles in self.tiles:
+            tiles.flush()
+
+    def seal(self):
+        # the tiles as they are now are going into a save: get them onto the disk and give the stamp that
+        # stands for them
+        self.flush()
+        self.sealed = True
+        return self.stamp
+
+    def touch(self):
+        # the tiles are about to change. if they were sealed, the save that has them must not pick up the
+        # file any more, so it gets a new stamp
+        if self.sealed:
+            self.sealed = False
+            self.stamp = new_stamp()
+            with open(self.path, 'r+b') as f:
+                f.write(TILE_HEADER.pack(TILE_MAGIC, self.stamp, *self.shape))
+
+
+def default_storage(width, height):
+    if width * height > CHUNKED_AREA:
+        return ChunkedStorage()
+    return DenseStorage()
+
+
+class ChunkedLayer:
+    # a layer indexed [x, y] like the plain arrays, stored as CHUNK_SIZE x CHUNK_SIZE chunks. chunks nothing was
+    # written to read as fill and take no memory. takes a single cell, a rectangle of slices or [...]; reading
+    # a rectangle gives a copy, so changes have to be written back
+    def __init__(self, shape, dtype, fill):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        self.chunks = {}  # (x, y) >> CHUNK_BITS -> array of the chunk
+
+    @property
+    def nbytes(self):
+        return sum(chunk.nbytes for chunk in self.chunks.values())
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.read(0, 0, self.shape[0], self.shape[1])
+        return array if dtype is None else array.astype(dtype)
+
+    def rect(self, key):
+        # the rectangle a key with slices in it covers
+        if key is Ellipsis:
+            return 0, 0, self.shape[0], self.shape[1]
+        kx, ky = key
+        x1, x2, _ = (kx if isinstance(kx, slice) else slice(kx, kx + 1)).indices(self.shape[0])
+        y1, y2, _ = (ky if isinstance(ky, slice) else slice(ky, ky + 1)).indices(self.shape[1])
+        return x1, y1, max(x1, x2), max(y1, y2)
+
+    def __getitem__(self, key):
+        if key is not Ellipsis:
+            x, y = key
+            if not (isinstance(x, slice) or isinstance(y, slice)):
+                chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+                if chunk is None:
+                    if len(self.shape) == 2:
+                        return self.dtype.type(self.fill)
+                    return np.full(self.shape[2:], self.fill, self.dtype)
+                return chunk[x & (CHUNK_SIZE - 1), y & (CHUNK_SIZE - 1)]
+        return self.read(*self.rect(key))
+
+    def __setitem__(self, key, value):
+        if key is not Ellipsis:
+            x, y = key
+            if not (isinstance(x, slice) or isinstance(y, slice)):
+                chunk = self.chunks.get((x >> CHUNK_BITS, y >> CHUNK_BITS))
+                if chunk is None:
+                    if np.all(np.asarray(value) == self.fill):
+                        return
+                    chunk = self.allocate(x >> CHUNK_BITS, y >> CHUNK_BITS)
+                chunk[x & (CHUNK_SIZE - 1), y & (CHUNK_SIZE - 1)] = value
+                return
+        self.write(*self.rect(key), value)
+
+    def allocate(self, cx, cy):
+        chunk = np.full((CHUNK_SIZE, CHUNK_SIZE) + self.shape[2:], self.fill, dtype=self.dtype)
+        self.chunks[(cx, cy)] = chunk
+        return chunk
+
+    def pieces(self, x1, y1, x2, y2):
+        # (chunk key, part of the chunk, part of the rectangle) for every chunk the rectangle overlaps
+        for cx in range(x1 >> CHUNK_BITS, ((x2 - 1) >> CHUNK_BITS) + 1):
+            left = cx << CHUNK_BITS
+            ax1, ax2 = max(x1, left), min(x2, left + CHUNK_SIZE)
+            for cy in range(y1 >> CHUNK_BITS, ((y2 - 1) >> CHUNK_BITS) + 1):
+                top = cy << CHUNK_BITS
+                ay1, ay2 = max(y1, top), min(y2, top + CHUNK_SIZE)
+                yield ((cx, cy), (slice(ax1 - left, ax2 - left), slice(ay1 - top, ay2 - top)),
+                       (slice(ax1 - x1, ax2 - x1), slice(ay1 - y1, ay2 - y1)))
+
+    def read(self, x1, y1, x2, y2):
+        out = np.full((x2 - x1, y2 - y1) + self.shape[2:], self.fill, dtype=self.dtype)
+        if x2 > x1 and y2 > y1:
+            for key, inside, outside in self.pieces(x1, y1, x2, y2):
+                chunk = self.chunks.get(key)
+                if chunk is not None:
+                    out[outside] = chunk[inside]
+        return out
+
+    def write(self, x1, y1, x2, y2, value):
+        if x2 <= x1 or y2 <= y1:
+            return
+        value = np.asarray(value, dtype=self.dtype)
+        if value.shape == self.shape[2:]:
+            # the same value all over, like carving out a room
+            is_fill = bool(np.all(value == self.fill))
+            for key, inside, outside in self.pieces(x1, y1, x2, y2):
+                chunk = self.chunks.get(key)
+                if chunk is None:
+                    if is_fill:
+                        continue
+                    chunk = self.allocate(*key)
+                chunk[inside] = value
+            return
+        value = np.broadcast_to(value, (x2 - x1, y2 - y1) + self.shape[2:])
+        for key, inside, outside in self.pieces(x1, y1, x2, y2):
+            chunk = self.chunks.get(key)
+            part = value[outside]
+            if chunk is None:
+                if np.all(part == self.fill):
+                    continue
+                chunk = self.allocate(*key)
+            chunk[inside] = part
@@ -0,0 +1,9 @@
+import os
+import sys
+import warnings
+
+# the game's modules sit at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# tcod warns about its color constants, which the game uses all over
+warnings.filterwarnings('ignore', category=FutureWarning, module='tcod')
@@ -0,0 +1,86 @@
+import random
+
+import numpy as np
+
+from map import make_map
+from model.character import make_enemy
+from model.item import Equipment
+from model.object import Object
+from rng import RunSeed
+
+
+def crowded_floor(seed, monsters):
+    # a floor with monsters on random open tiles, of all sorts of hp and defense
+    rng = random.Random(seed)
+    floor = make_map(80, 43, None, 1, RunSeed(seed))
+    cells = [(x, y) for x in range(floor.width) for y in range(floor.height) if not floor.is_blocked(x, y)]
+    rng.shuffle(cells)
+    for x, y in cells[:monsters]:
+        monster = make_enemy(x, y, floor, rng)
+        monster.fighter.hp = rng.randint(1, 10)
+        if rng.random() < 0.5:
+            armor = Object(x, y, '[', 'armor', (0, 0, 0), equipment=Equipment('body', defense_bonus=rng.randint(1, 4)))
+            monster.inventory.append(armor)
+            armor.equipment.equip(monster)
+        floor.add_object(monster)
+    return floor
+
+
+def check(floor):
+    # the store says what the objects say
+    store = floor.entities
+    assert len(store) == len(floor.objects)
+    for o in floor.objects:
+        fighter = o.fighter
+        stats = (fighter.hp, fighter.power, fighter.defense) if fighter else (0, 0, 0)
+        assert (store.hp[o.eid], store.power[o.eid], store.defense[o.eid]) == stats, o.name
+        assert (store.x[o.eid], store.y[o.eid], store.layer[o.eid]) == (o.x, o.y, o.layer), o.name
+
+
+def describe(floor):
+    return [(o.name, o.x, o.y, o.layer, o.fighter and o.fighter.hp) for o in floor.objects]
+
+
+def test_damage_matches_take_damage():
+    for seed in (1, 2, 3):
+        by_object = crowded_floor(seed, 300)
+        by_array = crowded_floor(seed, 300)
+        store = by_array.use_entities()
+        check(by_array)
+        rng = random.Random(seed)
+        for blast in range(10):
+            x, y, radius, amount = rng.randrange(80), rng.randrange(43), rng.randint(3, 20), rng.randint(1, 6)
+            ids = store.within(x, y, radius)
+            expected = []
+            for i in [by_array.objects.index(o) for o in store.get(ids)]:
+                fighter = by_object.objects[i].fighter
+                expected.extend(fighter.take_damage(amount - fighter.defense, "blown up"))
+            msgs = store.damage(ids, amount, "blown up")
+            assert [m.text for m in msgs] == [m.text for m in expected]
+            assert describe(by_array) == describe(by_object)
+            check(by_array)
+
+
+def test_store_follows_hp_and_equipment():
+    floor = crowded_floor(4, 50)
+    store = floor.use_entities()
+    monsters = [o for o in floor.objects if o.fighter]
+    for monster in monsters[:10]:
+        monster.fighter.hp = 99
+        monster.fighter.heal(5)
+        monster.fighter.take_damage(3)
+    for monster in monsters[10:20]:
+        sword = Object(monster.x, monster.y, '/', 'sword', (0, 0, 0), equipment=Equipment('right hand', power_bonus=3))
+        monster.inventory.append(sword)
+        sword.equipment.equip(monster)
+    for monster in monsters[20:30]:
+        for item in monster.inventory:
+            item.equipment.dequip()
+    check(floor)
+    # and leaves the ones that leave alone
+    gone = monsters[0]
+    floor.remove_object(gone)
+    gone.fighter.hp = 1
+    assert gone.eid is None
+    check(floor)
+    assert np.count_nonzero(store.used[:store.count]) == len(floor.objects)
@@ -0,0 +1,67 @@
+import inspect
+import random
+
+import pytest
+
+from engine import GameSession
+from map import place_objects, make_map_rand_room, make_map_dir_cave
+from model.character import Character, Fighter, BasicMonster, make_enemy
+from util import random_choice_index
+
+DIRECTIONS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+
+
+def wall_next_to(floor, o):
+    # a step that runs o into a wall, if there is one
+    for dx, dy in DIRECTIONS:
+        if floor.blocked[o.x + dx, o.y + dy]:
+            return dx, dy
+    return None
+
+
+def run(seed, noise):
+    # a crowd of monsters around the player, one of them shoved into the walls every turn. noise seeds the
+    # global random module, which nothing in a run should be drawing from
+    random.seed(noise)
+    session = GameSession('tester', seed=seed, pregenerate=False)
+    floor = session.floor
+    player = session.player
+    player.fighter.death_function = None
+    rng = random.Random(seed)
+    spots = [(player.x + dx * 2, player.y + dy * 2) for dx, dy in DIRECTIONS]
+    monsters = []
+    for x, y in spots + [(x + 1, y) for x, y in spots]:
+        if 0 < x < floor.width - 1 and 0 < y < floor.height - 1 and not floor.is_blocked(x, y):
+            monster = make_enemy(x, y, floor, rng)
+            floor.add_object(monster)
+            floor.scheduler.add(monster)
+            monsters.append(monster)
+    for turn in range(60):
+        random.random()
+        for monster in monsters:
+            if monster.fighter and monster.floor:
+                step = wall_next_to(floor, monster)
+                if step:
+                    session.log(monster.move(*step, floor, session.combat_rng))
+                    break
+        session.wait()
+    return ([(text, count) for text, color, count, wrapped in session.messages.entries],
+            [(o.name, o.x, o.y, o.fighter and o.fighter.hp) for o in floor.objects])
+
+
+@pytest.mark.parametrize('seed', [3, 8])
+def test_same_seed_same_combat(seed):
+    messages, objects = run(seed, 1)
+    assert any('slams into' in text for text, count in messages)
+    assert any('attacks' in text for text, count in messages)
+    assert run(seed, 2) == (messages, objects)
+
+
+@pytest.mark.parametrize('function', [Character.move, Character.move_towards, Character.move_chase,
+                                      Character.move_astar, Fighter.attack, BasicMonster.take_turn, make_enemy,
+                                      place_objects, make_map_rand_room, make_map_dir_cave, random_choice_index])
+def test_no_default_rng(function):
+    # falling back on the global random module would let the same seed play out differently
+    for name, parameter in inspect.signature(function).parameters.items():
+        if 'rng' in name:
+            assert parameter.default is inspect.Parameter.empty, name
@@ -0,0 +1,183 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+from engine import GameSession
+from savegame import (encode_floor, decode_floor, SaveError, HEADER, SECTION, META, FLOOR, FLOOR_HEADER,
+                      FLOOR_HEADER_2, MAGIC, VERSION, LAYERS)
+
+
+def play(session, turns, rng):
+    # wander about, going down the stairs now and then, without dying
+    session.player.fighter.death_function = None
+    for turn in range(turns):
+        session.player.fighter.hp = session.player.fighter.max_hp
+        if turn % 40 == 39:
+            stairs = session.floor.stairs_down
+            session.floor.move_object(session.player, stairs.x, stairs.y)
+            session.descend()
+        else:
+            session.move(rng.choice((-1, 0, 1)), rng.choice((-1, 0, 1)))
+
+
+def describe(floor):
+    # everything about a floor that a save has to keep
+    objects = [(o.name, o.x, o.y, o.char, tuple(o.color), o.blocks, o.always_visible, o.layer,
+                o.fighter and (o.fighter.hp, o.fighter.max_hp, o.fighter.power, o.fighter.defense),
+                getattr(o, 'inventory', None) and [i.name for i in o.inventory])
+               for o in floor.objects]
+    # only the order the queue is in is kept, not the counters behind it
+    queue = [(when, actor.name, actor.x, actor.y) for when, counter, actor in sorted(floor.scheduler.entries.values())]
+    return {'size': (floor.width, floor.height, floor.dungeon_level, floor.start),
+            'rooms': [(r.x1, r.y1, r.x2, r.y2) for r in floor.rooms],
+            'layers': [np.asarray(getattr(floor, name)).tolist() for name in LAYERS],
+            'objects': objects,
+            'queue': queue,
+            'time': floor.scheduler.time}
+
+
+def describe_session(session):
+    return {'seed': session.seed.seed,
+            'score': session.game.score,
+            'deepest': session.deepest,
+            'messages': [(text, tuple(color), count) for text, color, count, wrapped in session.messages.entries],
+            'combat': session.combat_rng.getstate(),
+            'floor': describe(session.floor),
+            'cached': {dlevel: describe(decode_floor(data)) for dlevel, data in session.floors.encoded()}}
+
+
+@pytest.fixture
+def session():
+    s = GameSession('tester', seed=5, pregenerate=False)
+    play(s, 130, random.Random(2))
+    yield s
+    s.close()
+
+
+def test_floor_round_trip(session):
+    data = encode_floor(session.floor, session.player_death)
+    floor = decode_floor(data, session.player_death, [])
+    assert describe(floor) == describe(session.floor)
+    assert encode_floor(floor, session.player_death) == data
+
+
+def test_session_round_trip(session, tmp_path):
+    path = str(tmp_path / 'run.sav')
+    session.save(path)
+    loaded = GameSession(None, load_from=path, pregenerate=False)
+    assert loaded.player.name == 'tester'
+    assert describe_session(loaded) == describe_session(session)
+    # and it plays on the same way
+    play(session, 30, random.Random(3))
+    play(loaded, 30, random.Random(3))
+    assert describe_session(loaded) == describe_session(session)
+
+
+def rewrite(path, version, change):
+    # the save at path as an older version would have written it: change(meta, sections) undoes what the
+    # migrations since that version do
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, current, count = HEADER.unpack_from(data, 0)
+    sections = {}
+    for i in range(count):
+        tag, key, offset, length = SECTION.unpack_from(data, HEADER.size + i * SECTION.size)
+        sections[(tag, key)] = data[offset:offset + length]
+    meta = json.loads(sections.pop((META, 0)).decode('utf-8'))
+    meta, sections = change(meta, sections)
+    sections = [((META, 0), json.dumps(meta).encode('utf-8'))] + list(sections.items())
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = []
+    for (tag, key), body in sections:
+        table.append(SECTION.pack(tag, key, offset, len(body)))
+        offset += len(body)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, version, len(sections)))
+        f.write(b''.join(table))
+        f.write(b''.join(body for key, body in sections))
+
+
+def without_stamps(meta, sections):
+    # version 2 floors had no tile stamp
+    for key, body in sections.items():
+        if key[0] == FLOOR:
+            sections[key] = body[:FLOOR_HEADER_2.size] + body[FLOOR_HEADER.size:]
+    return meta, sections
+
+
+def without_counts(meta, sections):
+    # version 1 kept the message log as lines, without repeat counts
+    meta, sections = without_stamps(meta, sections)
+    meta['messages'] = [(text, color) for text, color, count in meta['messages']]
+    return meta, sections
+
+
+@pytest.mark.parametrize('version, change', [(2, without_stamps), (1, without_counts)])
+def test_migrations(session, tmp_path, version, change):
+    assert VERSION == 3  # a new version needs its own case here
+    path = str(tmp_path / 'old.sav')
+    session.save(path)
+    expected = describe_session(session)
+    rewrite(path, version, change)
+    loaded = GameSession(None, load_from=path, pregenerate=False)
+    found = describe_session(loaded)
+    if version == 1:
+        # version 1 didn't count repeats, so every message comes back once
+        expected['messages'] = [(text, color) for text, color, count in expected['messages']]
+        found['messages'] = [(text, color) for text, color, count in found['messages']]
+    assert found == expected
+
+
+def test_damaged_files(session, tmp_path):
+    path = str(tmp_path / 'run.sav')
+    session.save(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, count = HEADER.unpack_from(data, 0)
+    table = HEADER.size + SECTION.size * count
+    damaged = [b'', b'nonsense' * 10, HEADER.pack(MAGIC, VERSION + 1, 0) + data[HEADER.size:]]
+    # cut short anywhere
+    damaged += [data[:length] for length in (HEADER.size - 1, HEADER.size + 5, table - 1, table + 10,
+                                             len(data) // 2, len(data) - 1)]
+    # a garbled section table or meta section
+    damaged.append(data[:HEADER.size] + b'\xff' * SECTION.size * count + data[table:])
+    damaged.append(data[:table] + b'}' + data[table + 1:])
+    for broken in damaged:
+        with open(path, 'wb') as f:
+            f.write(broken)
+        with pytest.raises(SaveError):
+            GameSession(None, load_from=path, pregenerate=False)
+
+
+def test_no_player(session, tmp_path):
+    path = str(tmp_path / 'run.sav')
+    session.floor.remove_object(session.player)
+    session.save(path)
+    with pytest.raises(SaveError):
+        GameSession(None, load_from=path, pregenerate=False)
+
+
+def test_tile_files_only_reused_while_unchanged(tmp_path):
+    floor_dir = tmp_path / 'floors'
+    floor_dir.mkdir()
+    path = str(tmp_path / 'run.sav')
+    s = GameSession('tester', seed=11, floor_dir=str(floor_dir), pregenerate=False)
+    play(s, 50, random.Random(1))
+    s.save(path)
+    saved = np.asarray(s.floor.explored).copy()
+
+    loaded = GameSession(None, floor_dir=str(floor_dir), load_from=path, pregenerate=False)
+    assert loaded.floor.storage.reused
+    assert np.array_equal(np.asarray(loaded.floor.explored), saved)
+
+    # playing on after the save changes the files under it: off across the floor, seeing new parts of it
+    stairs = loaded.floor.stairs_down
+    loaded.floor.move_object(loaded.player, stairs.x, stairs.y)
+    loaded.fov_recompute = True
+    loaded.wait()
+    assert not np.array_equal(np.asarray(loaded.floor.explored), saved)
+    again = GameSession(None, floor_dir=str(floor_dir), load_from=path, pregenerate=False)
+    assert not again.floor.storage.reused
+    assert np.array_equal(np.asarray(again.floor.explored), saved)
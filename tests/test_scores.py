@@ -0,0 +1,139 @@
+import os
+import random
+import shelve
+import sys
+import types
+
+import pytest
+
+import map
+from scores import ScoreStore, ScoreRecord, words, import_shelf, NAME_BYTES
+
+NAMES = ('Ann', 'ann', 'Bob', 'Zoë', 'Obama')
+EPITAPHS = ('killed by an orc', 'killed by a hydra', 'fell down the stairs', "quit", 'collapsed from over-exertion',
+            "killed by the orc's hydra")
+QUERY_WORDS = ('killed', 'orc', 'hydra', 'by', "orc's", 'stairs', 'KILLED by', 'nothing', 'quit')
+
+
+def random_record(rng):
+    # few different values of everything, so there are plenty of ties to break
+    return ScoreRecord(rng.randrange(5), rng.randrange(1, 4), rng.randrange(1, 4), rng.choice(NAMES),
+                       rng.choice(EPITAPHS), rng.random())
+
+
+def brute_force(records, limit, offset=0, name=None, dlevel=None, epitaph=None):
+    # what query should come up with: filter everything, sort everything
+    matches = [(recno, r) for recno, r in enumerate(records)
+               if (name is None or r.name.lower() == name.lower())
+               and (dlevel is None or r.dlevel == dlevel)
+               and (epitaph is None or words(epitaph) <= words(r.epitaph))]
+    matches.sort(key=lambda match: (-match[1].score, -match[1].level, -match[1].dlevel, match[0]))
+    return [r for recno, r in matches[offset:offset + limit]], len(matches)
+
+
+def random_query(rng):
+    return dict(limit=rng.choice((1, 3, 10, 100)),
+                offset=rng.choice((0, 0, 1, 5, 50)),
+                name=rng.choice((None, None) + NAMES + ('ANN', 'nobody')),
+                dlevel=rng.choice((None, None, 1, 2, 3, 9)),
+                epitaph=rng.choice((None, None) + QUERY_WORDS))
+
+
+def check(store, records, rng, queries=200):
+    for i in range(queries):
+        query = random_query(rng)
+        assert store.query(**query) == brute_force(records, **query), query
+    assert store.top(len(records) + 1) == brute_force(records, len(records) + 1)[0]
+
+
+def test_query_matches_brute_force(tmp_path):
+    path = str(tmp_path / 'scores')
+    rng = random.Random(1)
+    records = [random_record(rng) for i in range(300)]
+    store = ScoreStore(path)
+    for record in records:
+        store.add(record)
+    check(store, records, rng)
+
+    # added while the ranking and the indexes are loaded
+    for i in range(100):
+        records.append(random_record(rng))
+        store.add(records[-1])
+        if i % 10 == 0:
+            check(store, records, rng, queries=20)
+    check(store, records, rng)
+
+    # a new store catches up with the records added since the index file was written
+    check(ScoreStore(path), records, rng)
+
+    # and one without an index file builds it again
+    os.remove(path + '.idx')
+    check(ScoreStore(path), records, rng)
+
+
+def test_empty_store(tmp_path):
+    store = ScoreStore(str(tmp_path / 'scores'))
+    assert store.query(10) == ([], 0)
+    assert store.query(10, name='Ann', dlevel=1, epitaph='orc') == ([], 0)
+
+
+def test_epitaph_filter_needs_words(tmp_path):
+    store = ScoreStore(str(tmp_path / 'scores'))
+    store.add(ScoreRecord(1, 1, 1, 'Ann', 'killed by an orc', 0.0))
+    for epitaph in ('', '   ', '!?'):
+        with pytest.raises(ValueError):
+            store.query(10, epitaph=epitaph)
+
+
+def test_long_names(tmp_path):
+    store = ScoreStore(str(tmp_path / 'scores'))
+    name = 'Sir ' + 'Longname ' * 10
+    assert len(name.encode('utf-8')) > NAME_BYTES
+    store.add(ScoreRecord(1, 1, 1, name, 'quit', 0.0))
+    store.add(ScoreRecord(2, 1, 1, 'Ann', 'quit', 0.0))
+    records, total = store.query(10, name=name.upper())
+    assert total == 1 and name.startswith(records[0].name)
+
+
+def legacy_class(module, name, *fields):
+    # a class like the ones the old game pickled its scores with, under the name it had then
+    cls = type(name, (), {'__init__': lambda self, *values: self.__dict__.update(zip(fields, values))})
+    cls.__module__ = module
+    return cls
+
+
+def test_import_shelf(tmp_path, monkeypatch):
+    GameState = legacy_class('__main__', 'GameState', 'score', 'time', 'discovered')
+    Floor = legacy_class('map', 'Floor', 'dungeon_level', 'objects')
+    Death = legacy_class('model.death', 'Death', 'player', 'epitath', 'game', 'floor')
+    Character = legacy_class('model.character', 'Character', 'name', 'level', 'death')
+    monkeypatch.setattr(sys.modules['__main__'], 'GameState', GameState, raising=False)
+    monkeypatch.setattr(map, 'Floor', Floor, raising=False)
+    monkeypatch.setitem(sys.modules, 'model.death', types.ModuleType('model.death'))
+    monkeypatch.setattr(sys.modules['model.death'], 'Death', Death, raising=False)
+    monkeypatch.setattr(sys.modules['model.character'], 'Character', Character)
+
+    rng = random.Random(5)
+    players = []
+    for i in range(40):
+        player = Character(rng.choice(NAMES), rng.randrange(1, 4), None)
+        floor = Floor(rng.randrange(1, 4), [player])
+        player.death = Death(player, rng.choice(EPITAPHS), GameState(rng.randrange(5), 0, {}), floor)
+        players.append(player)
+    # the way the old game kept them
+    players.sort(reverse=True, key=lambda p: (p.death.game.score, p.level, p.death.floor.dungeon_level, p.name))
+    players.append(Character('unfinished', 1, None))
+    path = str(tmp_path / 'scores.json')
+    with shelve.open(path) as shelf:
+        shelf['score'] = players
+    monkeypatch.undo()
+
+    store = ScoreStore(str(tmp_path / 'scores.dat'))
+    assert import_shelf(store, path) == 40
+    records = [ScoreRecord(p.death.game.score, p.level, p.death.floor.dungeon_level, p.name, p.death.epitath, 0.0)
+               for p in players[:40]]
+    assert store.top(100) == brute_force(records, 100)[0]
+    assert [store.record(recno) for recno in range(40)] == records
+    check(store, records, rng)
+
+    assert import_shelf(ScoreStore(str(tmp_path / 'other.dat')), str(tmp_path / 'missing.json')) == 0
@@ -0,0 +1,125 @@
+import gc
+import random
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from map import make_map, GENERATORS, TILE_LAYERS, OBJECT_LAYERS
+from rng import RunSeed
+from storage import ChunkedLayer, ChunkedStorage, DenseStorage, CHUNK_SIZE
+
+# not a whole number of chunks either way, so the edges get covered
+WIDTH = CHUNK_SIZE * 2 + 21
+HEIGHT = CHUNK_SIZE + 37
+
+LAYERS = [((), bool, True), ((), np.int16, 0), ((), np.int32, -1), ((3,), np.uint8, 0)]
+
+
+def random_value(rng, depth, dtype, fill):
+    # fill now and then, which mustn't allocate anything
+    if rng.random() < 0.2:
+        return np.full(depth, fill, dtype=dtype)
+    if depth:
+        return np.array([rng.randrange(256) for i in range(depth[0])], dtype=dtype)
+    if dtype is bool:
+        return np.array(rng.random() < 0.5)
+    return np.array(rng.randrange(-5, 5), dtype=dtype)
+
+
+def random_block(rng, width, height, depth, dtype, fill):
+    # a different value for every cell, mostly fill so some chunks stay empty
+    if rng.random() < 0.5:
+        return np.full((width, height) + depth, fill, dtype=dtype)
+    return np.array([[random_value(rng, depth, dtype, fill) for y in range(height)] for x in range(width)],
+                    dtype=dtype).reshape((width, height) + depth)
+
+
+def random_slice(rng, size):
+    a, b = sorted((rng.randrange(size + 1), rng.randrange(size + 1)))
+    return rng.choice((slice(a, b), slice(a, None), slice(None, b), slice(None), slice(b, a)))
+
+
+def random_key(rng):
+    # a cell, a rectangle or everything
+    kind = rng.random()
+    if kind < 0.5:
+        return rng.randrange(WIDTH), rng.randrange(HEIGHT)
+    if kind < 0.95:
+        return random_slice(rng, WIDTH), random_slice(rng, HEIGHT)
+    return Ellipsis
+
+
+@pytest.mark.parametrize('depth, dtype, fill', LAYERS)
+def test_chunked_layer_matches_dense(depth, dtype, fill):
+    rng = random.Random(repr((depth, dtype, fill)))
+    shape = (WIDTH, HEIGHT) + depth
+    chunked = ChunkedLayer(shape, dtype, fill)
+    dense = np.full(shape, fill, dtype=dtype)
+    for step in range(2000):
+        key = random_key(rng)
+        if rng.random() < 0.6:
+            value = random_value(rng, depth, dtype, fill)
+            if key is not Ellipsis and isinstance(key[0], slice) and rng.random() < 0.5:
+                value = random_block(rng, *dense[key].shape[:2], depth, dtype, fill)
+            chunked[key] = value
+            dense[key] = value
+        else:
+            np.testing.assert_array_equal(chunked[key], dense[key])
+        if step % 100 == 0:
+            np.testing.assert_array_equal(np.asarray(chunked), dense)
+    np.testing.assert_array_equal(np.asarray(chunked), dense)
+    assert chunked.nbytes == sum(chunk.nbytes for chunk in chunked.chunks.values())
+    for chunk in chunked.chunks.values():
+        assert chunk.shape == (CHUNK_SIZE, CHUNK_SIZE) + depth
+
+
+def test_fill_takes_no_memory():
+    layer = ChunkedLayer((WIDTH, HEIGHT), bool, True)
+    layer[...] = True
+    layer[3, 4] = True
+    layer[10:100, 5:50] = True
+    layer[:, 7:9] = np.ones((WIDTH, 2), dtype=bool)
+    assert layer.chunks == {}
+    assert layer.nbytes == 0
+    assert layer[3, 4] and layer[WIDTH - 1, HEIGHT - 1]
+    layer[CHUNK_SIZE + 1, 2] = False
+    assert list(layer.chunks) == [(1, 0)]
+    assert not layer[CHUNK_SIZE + 1, 2]
+    assert np.asarray(layer).sum() == WIDTH * HEIGHT - 1
+
+
+def describe(floor):
+    layers = [np.asarray(getattr(floor, name)) for name, depth, dtype, fill in TILE_LAYERS + OBJECT_LAYERS]
+    objects = [(o.name, o.x, o.y, o.char, o.blocks) for o in floor.objects]
+    return layers, objects, [(r.x1, r.y1, r.x2, r.y2) for r in floor.rooms], floor.start
+
+
+@pytest.mark.parametrize('generator', sorted(GENERATORS))
+def test_chunked_floor_matches_dense(generator):
+    for seed in (1, 2, 3):
+        dense = make_map(WIDTH * 2, HEIGHT * 2, None, 3, RunSeed(seed), DenseStorage(), generator)
+        chunked = make_map(WIDTH * 2, HEIGHT * 2, None, 3, RunSeed(seed), ChunkedStorage(), generator)
+        assert isinstance(chunked.blocked, ChunkedLayer)
+        dense_layers, *dense_rest = describe(dense)
+        chunked_layers, *chunked_rest = describe(chunked)
+        for a, b in zip(dense_layers, chunked_layers):
+            np.testing.assert_array_equal(a, b)
+        assert dense_rest == chunked_rest
+
+
+def peak_memory(make):
+    gc.collect()
+    tracemalloc.start()
+    made = make()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, made
+
+
+def test_chunked_generation_peak():
+    # a cave leaves most of a big map untouched: it shouldn't be built in full-size arrays on the way either
+    dense_peak, dense = peak_memory(lambda: make_map(1000, 1000, None, 1, RunSeed(3), DenseStorage(), 'cave'))
+    chunked_peak, chunked = peak_memory(lambda: make_map(1000, 1000, None, 1, RunSeed(3), ChunkedStorage(), 'cave'))
+    assert chunked_peak < dense_peak * 0.6
+    assert chunked.blocked.nbytes < dense.blocked.nbytes / 2
@@ -1,20 +1,19 @@
 import json
-import random
 from collections import namedtuple
 
 
-def random_choice_index(chances):  # choose one option from list of chances, returning its index
+def random_choice_index(chances, rng):  # choose one option from list of chances, returning its index
     # the dice will land on some number between 1 and the sum of the chances
     # dice = libtcod.random_get_int(None, 1, sum(chances))
-    return chances[random.randint(0, len(chances) -1)]
+    return chances[rng.randint(0, len(chances) -1)]
 
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, rng):
     # choose one option from dictionary of chances, returning its key
     chances = chances_dict.values()
     strings = chances_dict.keys()
 
-    return strings[random_choice_index(chances)]
+    return strings[random_choice_index(chances, rng)]
 
 
 # https://stackoverflow.com/questions/6578986/how-to-convert-json-data-into-a-python-object